@@ -0,0 +1,290 @@
+"""
+    Diffs between worlds, and incremental backups made of delta files.
+
+    Worlds are compared a region at a time: first the location and timestamp
+    tables, then hashes of the compressed chunk data, and chunks are only
+    decompressed when a semantic diff is asked for.
+
+    Usage: python backup.py <region directory> <mirror directory>
+           [--delta <file>]
+           python backup.py --apply <delta file> <region directory>
+"""
+import hashlib
+import io
+import os
+import os.path
+import struct
+import sys
+import zlib
+import mclevel
+import nbt
+
+# kinds of change
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+_MAGIC = b'NBTDELTA\x01'
+# chunkX, chunkZ, op, timestamp, compression type, length of data
+_RECORD = struct.Struct('>iiBIBI')
+_REMOVE = 0
+_PUT = 1
+
+def diff(worldA, worldB, semantic=False, checkAll=False, processes=None):
+    """ -> sorted list of (chunkX, chunkZ, kind, detail) of the chunks that
+        differ between two worlds (MinecraftWorlds or region directories);
+        kind is how the chunk in worldB differs from worldA.
+
+        Chunks with the same timestamp in both worlds are assumed to be the
+        same unless checkAll is True. Other chunks are compared by a hash
+        of their compressed data.
+        semantic - also decompress the chunks that differ, dropping those
+        whose NBT is the same; detail is then a list of the paths of the
+        tags that differ, otherwise it is None
+        processes - see mclevel.mapRegions
+    """
+    pathA, pathB = _regionDir(worldA), _regionDir(worldB)
+    regions = set(_listRegions(pathA)) | set(_listRegions(pathB))
+    jobs = [(mclevel.regionPath(pathA, *r), mclevel.regionPath(pathB, *r),
+             r, semantic, checkAll) for r in sorted(regions)]
+    changes = []
+    for found in mclevel.mapRegions(diffRegion, jobs, processes):
+        changes.extend(found)
+    return sorted(changes, key=lambda c: (c[1], c[0]))
+
+def diffRegion(pathA, pathB, region, semantic=False, checkAll=False):
+    """ -> list of (chunkX, chunkZ, kind, detail) between two region files,
+        either of which may not exist. See diff.
+    """
+    rx, rz = region
+    fileA, fileB = _open(pathA), _open(pathB)
+    try:
+        tablesA, tablesB = _tables(fileA), _tables(fileB)
+        if tablesA == tablesB and not checkAll:
+            # nothing has been written to either since they were the same
+            return []
+        locationsA, timestampsA = _unpackTables(tablesA)
+        locationsB, timestampsB = _unpackTables(tablesB)
+        changes = []
+        for i in range(1024):
+            x, z = rx*32 + (i & 31), rz*32 + (i >> 5)
+            a, b = locationsA[i], locationsB[i]
+            if a == 0 and b == 0:
+                continue
+            elif a == 0:
+                changes.append((x, z, ADDED, None))
+                continue
+            elif b == 0:
+                changes.append((x, z, REMOVED, None))
+                continue
+            if timestampsA[i] == timestampsB[i] and not checkAll:
+                continue
+            payloadA, payloadB = _payload(fileA, a), _payload(fileB, b)
+            if _hash(payloadA) == _hash(payloadB):
+                continue
+            detail = None
+            if semantic:
+                detail = diffTags(_parse(payloadA), _parse(payloadB))
+                if not detail:
+                    continue
+            changes.append((x, z, CHANGED, detail))
+        return changes
+    finally:
+        for f in (fileA, fileB):
+            if f is not None:
+                f.close()
+
+def diffTags(a, b, path=''):
+    """ -> list of the paths of the tags that differ between two Tags """
+    if a.id != b.id:
+        return [path or '/']
+    if a.id == nbt.Tag.TAG_Compound:
+        out = []
+        for name in sorted(set(a.value) | set(b.value)):
+            if name not in a.value or name not in b.value:
+                out.append(path + '/' + name)
+            else:
+                out.extend(diffTags(a.value[name], b.value[name],
+                                    path + '/' + name))
+        return out
+    if a.id == nbt.Tag.TAG_List:
+        if (a.listType != b.listType or len(a.value) != len(b.value)
+                or a.pythonify() != b.pythonify()):
+            return [path]
+        return []
+    return [] if a.value == b.value else [path or '/']
+
+def writeDelta(worldA, worldB, deltaFile, changes=None, processes=None):
+    """ Write the chunks of worldB which differ from worldA to deltaFile,
+        so that applyDelta turns a copy of worldA into worldB.
+        changes - the result of diff(worldA, worldB), if it is known
+        -> number of chunks in the delta
+    """
+    if changes is None:
+        changes = diff(worldA, worldB, processes=processes)
+    count = 0
+    with open(deltaFile, mode='wb') as out:
+        out.write(_MAGIC)
+        for record in _records(changes, _regionDir(worldB)):
+            _writeRecord(out, *record)
+            count += 1
+    return count
+
+def applyDelta(deltaFile, world):
+    """ Apply a delta file made by writeDelta to a world, in place.
+        -> number of chunks changed
+    """
+    with open(deltaFile, mode='rb') as file:
+        if file.read(len(_MAGIC)) != _MAGIC:
+            raise ValueError('Not a delta file: ' + str(deltaFile))
+        return _applyRecords(_readRecords(file), _regionDir(world))
+
+def backupWorld(world, mirrorPath, deltaFile=None, checkAll=False,
+                processes=None):
+    """ Bring a mirror (a copy of the world's region files) up to date,
+        only reading and writing the chunks which changed. The mirror is
+        created if it does not exist.
+        deltaFile - also keep the changes in this delta file
+        -> list of changes, as returned by diff
+    """
+    if not os.path.exists(mirrorPath):
+        os.makedirs(mirrorPath)
+    changes = diff(mirrorPath, world, checkAll=checkAll, processes=processes)
+    if deltaFile is not None:
+        writeDelta(mirrorPath, world, deltaFile, changes)
+        applyDelta(deltaFile, mirrorPath)
+    else:
+        _applyRecords(_records(changes, _regionDir(world)), mirrorPath)
+    return changes
+
+def _records(changes, sourcePath):
+    """ Yield (x, z, op, timestamp, compression, data) for every change,
+        reading the new chunks from sourcePath a region at a time
+    """
+    region = None
+    file = None
+    try:
+        for x, z, kind, detail in sorted(
+                changes, key=lambda c: mclevel.getRegionPos(c[0], c[1])):
+            if kind == REMOVED:
+                yield x, z, _REMOVE, 0, 0, b''
+                continue
+            if mclevel.getRegionPos(x, z) != region:
+                if file is not None:
+                    file.close()
+                region = mclevel.getRegionPos(x, z)
+                file = open(mclevel.regionPath(sourcePath, *region), mode='rb')
+                header = mclevel.RegionHeader(region[0], region[1], file)
+            offset, size, timestamp = header.getChunkInfo(x, z)
+            compression, data = mclevel.readCompressedChunk(x, z, header)
+            yield x, z, _PUT, timestamp, compression, data
+    finally:
+        if file is not None:
+            file.close()
+
+def _writeRecord(out, x, z, op, timestamp, compression, data):
+    out.write(_RECORD.pack(x, z, op, timestamp, compression, len(data)))
+    out.write(data)
+
+def _readRecords(file):
+    while True:
+        raw = file.read(_RECORD.size)
+        if not raw:
+            return
+        if len(raw) < _RECORD.size:
+            raise ValueError('Delta file is truncated')
+        x, z, op, timestamp, compression, length = _RECORD.unpack(raw)
+        data = file.read(length)
+        if len(data) < length:
+            raise ValueError('Delta file is truncated')
+        yield x, z, op, timestamp, compression, data
+
+def _applyRecords(records, regionPath):
+    """ Write records to the region files in regionPath, keeping the
+        timestamps from the records. -> number of records applied
+    """
+    region = None
+    file = None
+    count = 0
+    try:
+        for x, z, op, timestamp, compression, data in records:
+            if mclevel.getRegionPos(x, z) != region:
+                if file is not None:
+                    file.close()
+                region = mclevel.getRegionPos(x, z)
+                path = mclevel.regionPath(regionPath, *region)
+                file = open(path, mode='r+b' if os.path.exists(path)
+                            else 'w+b')
+                header = mclevel.RegionHeader(region[0], region[1], file)
+            if op == _REMOVE:
+                header.setChunkInfo(x, z, 0, 0)
+                header.markUpdate(x, z, 0)
+            else:
+                if compression != 2:
+                    # region files written here are always zlib
+                    data = zlib.compress(
+                        mclevel.decompressChunk(compression, data))
+                mclevel.writeCompressedChunk(x, z, data, header)
+                header.markUpdate(x, z, timestamp)
+            count += 1
+    finally:
+        if file is not None:
+            file.close()
+    return count
+
+def _regionDir(world):
+    return getattr(world, 'path', world)
+
+def _listRegions(regionPath):
+    if not os.path.exists(regionPath):
+        return []
+    return mclevel.listRegions(regionPath)
+
+def _open(path):
+    try:
+        return open(path, mode='rb')
+    except FileNotFoundError:
+        return None
+
+def _tables(file):
+    """ -> the 8 KiB of location and timestamp tables of a region file """
+    if file is None:
+        return bytes(4096*2)
+    file.seek(0)
+    return file.read(4096*2).ljust(4096*2, b'\x00')
+
+def _unpackTables(tables):
+    return (struct.unpack('>1024I', tables[:4096]),
+            struct.unpack('>1024I', tables[4096:]))
+
+def _payload(file, location):
+    """ -> the stored (compressed) bytes of the chunk at a location entry """
+    file.seek((location >> 8) * 4096)
+    length = int.from_bytes(file.read(4), 'big')
+    return file.read(length)
+
+def _hash(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+def _parse(payload):
+    data = mclevel.decompressChunk(payload[0], payload[1:])
+    return nbt.NbtReader(io.BytesIO(data)).read()
+
+def main(argv):
+    if len(argv) >= 3 and argv[0] == '--apply':
+        print(str(applyDelta(argv[1], argv[2])) + ' chunks applied')
+        return 0
+    paths = [a for i, a in enumerate(argv)
+             if not a.startswith('--') and (i == 0 or argv[i - 1] != '--delta')]
+    if len(paths) != 2:
+        print(__doc__)
+        return 2
+    deltaFile = None
+    if '--delta' in argv:
+        deltaFile = argv[argv.index('--delta') + 1]
+    changes = backupWorld(paths[0], paths[1], deltaFile)
+    print(str(len(changes)) + ' chunks changed')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,153 @@
+"""
+    An optional SQLite index of chunk metadata and block counts, kept next to
+    the region files, so questions about a whole world can be answered
+    without decompressing every chunk.
+"""
+import os
+import os.path
+import sqlite3
+from collections import Counter
+import mclevel
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chunks (
+        x INTEGER, z INTEGER, rx INTEGER, rz INTEGER,
+        timestamp INTEGER,
+        terrainPopulated INTEGER, lightPopulated INTEGER,
+        inhabitedTime INTEGER, lastUpdate INTEGER,
+        PRIMARY KEY (x, z)
+    );
+    CREATE INDEX IF NOT EXISTS chunksByRegion ON chunks (rx, rz);
+    CREATE TABLE IF NOT EXISTS blocks (
+        x INTEGER, z INTEGER, id INTEGER, count INTEGER,
+        PRIMARY KEY (x, z, id)
+    );
+    CREATE INDEX IF NOT EXISTS blocksById ON blocks (id);
+"""
+
+class ChunkIndex:
+    """ Per chunk metadata and block id histograms for one dimension.
+
+        Blocks are counted by numeric id, except in sections with a palette
+        (from the flattening on) where they are counted by the name of their
+        block state, e.g. 'minecraft:stone', ignoring its properties.
+
+        Each row remembers the region header timestamp of the chunk it was
+        built from; refresh compares these against the region files and only
+        re-reads the chunks that changed.
+    """
+    def __init__(self, regionPath, fileName='chunks.sqlite'):
+        self.path = regionPath
+        self.db = sqlite3.connect(os.path.join(regionPath, fileName))
+        self.db.executescript(_SCHEMA)
+    def updateChunk(self, chunk, timestamp):
+        """ Record a chunk as it was written with the given header timestamp
+        """
+        x, z = chunk.x, chunk.z
+        rx, rz = mclevel.getRegionPos(x, z)
+        counts = Counter()
+        for section in chunk.sections.values():
+            if section.palette is None:
+                counts.update(section.ids)
+                continue
+            # ids are indices into the palette
+            for i, n in Counter(section.ids).items():
+                counts[section.palette[i]['Name']] += n
+        self.db.execute("INSERT OR REPLACE INTO chunks VALUES "
+                        "(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (x, z, rx, rz, timestamp, chunk.terrainPopulated,
+                         chunk.lightPopulated, chunk.inhabitedTime,
+                         chunk.lastUpdate))
+        self.db.execute("DELETE FROM blocks WHERE x = ? AND z = ?", (x, z))
+        self.db.executemany("INSERT INTO blocks VALUES (?, ?, ?, ?)",
+                            ((x, z, id, n) for id, n in counts.items()))
+    def updateCounts(self, x, z, timestamp, changes):
+        """ Apply changes (dict of id -> change in count) to the block counts
+            of a chunk that was rewritten in place with the given header
+            timestamp, e.g. by MinecraftWorld.replaceBlocks. The chunk is
+            marked as needing light. Chunks that are not in the index are
+            left to refresh.
+        """
+        cursor = self.db.execute("UPDATE chunks SET timestamp = ?, "
+                                 "lightPopulated = 0 WHERE x = ? AND z = ?",
+                                 (timestamp, x, z))
+        if cursor.rowcount == 0:
+            return
+        for id, n in changes.items():
+            if n == 0:
+                continue
+            self.db.execute("INSERT OR IGNORE INTO blocks VALUES "
+                            "(?, ?, ?, 0)", (x, z, id))
+            self.db.execute("UPDATE blocks SET count = count + ? "
+                            "WHERE x = ? AND z = ? AND id = ?", (n, x, z, id))
+        self.db.execute("DELETE FROM blocks WHERE x = ? AND z = ? "
+                        "AND count <= 0", (x, z))
+    def removeChunk(self, x, z):
+        self.db.execute("DELETE FROM chunks WHERE x = ? AND z = ?", (x, z))
+        self.db.execute("DELETE FROM blocks WHERE x = ? AND z = ?", (x, z))
+    def refresh(self):
+        """ Bring the index up to date with the region files.
+            -> number of chunks that had to be re-read
+        """
+        updated = 0
+        for rx, rz in mclevel.listRegions(self.path):
+            updated += self.refreshRegion(rx, rz)
+        self.commit()
+        return updated
+    def refreshRegion(self, rx, rz):
+        path = mclevel.regionPath(self.path, rx, rz)
+        known = dict(((x, z), t) for x, z, t in self.db.execute(
+            "SELECT x, z, timestamp FROM chunks WHERE rx = ? AND rz = ?",
+            (rx, rz)))
+        if os.path.getsize(path) < 4096*2:
+            # an empty or broken region has no chunks
+            for c in known:
+                self.removeChunk(*c)
+            return 0
+        updated = 0
+        with open(path, mode='rb') as file:
+            header = mclevel.RegionHeader(rx, rz, file)
+            locations = header.getLocations()
+            timestamps = header.getTimestamps()
+            for i in range(1024):
+                x, z = rx*32 + (i & 31), rz*32 + (i >> 5)
+                if locations[i] == (0, 0):
+                    if (x, z) in known:
+                        self.removeChunk(x, z)
+                    continue
+                if known.get((x, z), None) == timestamps[i]:
+                    continue
+                chunk = mclevel.nbtToChunk(mclevel.readChunk(x, z, header))
+                self.updateChunk(chunk, timestamps[i])
+                updated += 1
+        return updated
+    def commit(self):
+        self.db.commit()
+    def close(self):
+        self.db.commit()
+        self.db.close()
+    # queries
+    def query(self, sql, parameters=()):
+        """ -> list of rows from any SQL query on the chunks/blocks tables """
+        return self.db.execute(sql, parameters).fetchall()
+    def unpopulated(self):
+        """ -> list of (x, z) of chunks with TerrainPopulated = 0 """
+        return self.query("SELECT x, z FROM chunks WHERE terrainPopulated = 0")
+    def inhabitedTimeByRegion(self):
+        """ -> dict of (rx, rz) -> total InhabitedTime """
+        return dict(((rx, rz), t) for rx, rz, t in self.query(
+            "SELECT rx, rz, SUM(inhabitedTime) FROM chunks GROUP BY rx, rz"))
+    def findBlock(self, id):
+        """ -> dict of (x, z) -> count for chunks containing block id, a
+            numeric id or a block state name
+        """
+        return dict(((x, z), n) for x, z, n in self.query(
+            "SELECT x, z, count FROM blocks WHERE id = ?", (id,)))
+    def countBlock(self, id):
+        """ -> total number of blocks with id in the indexed world """
+        return self.query("SELECT COALESCE(SUM(count), 0) FROM blocks "
+                          "WHERE id = ?", (id,))[0][0]
+    def __enter__(self):
+        return self
+    def __exit__(self, exctype, exc, trace):
+        self.close()
@@ -0,0 +1,340 @@
+"""
+    Export of world block data to dense arrays, and import back into chunks.
+
+    Every region becomes one (256, 512, 512) array per field, indexed
+    [y, z, x] in block coordinates within the region, written as a .npy
+    file or as a raw file which can be memory mapped. A manifest.json in
+    the output directory describes the arrays. Regions are streamed a
+    chunk at a time, so only one chunk is ever held in memory.
+
+    Usage: python export.py <region directory> <output directory>
+           [--raw] [--fields ids,data,skyLight,blockLight]
+           python export.py --import <output directory> <region directory>
+"""
+import json
+import mmap
+import os
+import os.path
+import sys
+from array import array
+import mclevel
+
+# dtype of every field, as numpy names them
+FIELDS = {
+    'ids': '<u2',
+    'data': '|u1',
+    'skyLight': '|u1',
+    'blockLight': '|u1'
+}
+SHAPE = (256, 512, 512)
+MANIFEST = 'manifest.json'
+
+def exportWorld(regionPath, outputDir, fields=('ids',), format='npy',
+                processes=None):
+    """ Export every region in regionPath to outputDir, see exportRegion.
+        processes - see mclevel.mapRegions
+        -> the manifest, which is also written to outputDir/manifest.json
+    """
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    jobs = [(mclevel.regionPath(regionPath, x, z), outputDir, fields, format)
+            for x, z in sorted(mclevel.listRegions(regionPath))]
+    manifest = {
+        'format': format,
+        'order': 'YZX',
+        'shape': list(SHAPE),
+        'fields': dict((f, FIELDS[f]) for f in fields),
+        'regions': [r for r in mclevel.mapRegions(exportRegion, jobs,
+                                                   processes)
+                    if r is not None]
+    }
+    with open(os.path.join(outputDir, MANIFEST), mode='w') as file:
+        json.dump(manifest, file, indent=4)
+    return manifest
+
+def exportRegion(regionFile, outputDir, fields=('ids',), format='npy'):
+    """ Write the fields of every section of a region file to
+        outputDir/r.x.z.<field>.npy (or .raw if format is 'raw').
+        Missing chunks and sections are zero (air). Sections with a palette
+        are exported as indices into a palette of the whole region, which
+        is kept in the manifest entry. Sections below y=0 or above y=255
+        are left out.
+        -> manifest entry of the region, None if it has no chunks
+    """
+    x, z = mclevel.regionCoords(regionFile)
+    if os.path.getsize(regionFile) < 4096*2:
+        return None
+    entry = {'x': x, 'z': z, 'files': {}, 'offset': 0}
+    outputs = {}
+    try:
+        for field in fields:
+            name = 'r.' + str(x) + '.' + str(z) + '.' + field + '.' + format
+            entry['files'][field] = name
+            outputs[field], entry['offset'] = _createArray(
+                os.path.join(outputDir, name), FIELDS[field], format)
+        palette = []
+        states = {}
+        with open(regionFile, mode='rb') as file:
+            header = mclevel.RegionHeader(x, z, file)
+            locations = header.getLocations()
+            for i in range(1024):
+                if locations[i] == (0, 0):
+                    continue
+                chunk = mclevel.nbtToChunk(mclevel.readChunk(
+                    x*32 + (i & 31), z*32 + (i >> 5), header))
+                entry['dataVersion'] = chunk.dataVersion
+                for sectionY, section in chunk.sections.items():
+                    if not 0 <= sectionY < 16:
+                        continue
+                    if section.palette is not None:
+                        ids = _toRegionPalette(section, palette, states)
+                    else:
+                        ids = section.ids
+                    for field, memory in outputs.items():
+                        _writeSection(memory, entry['offset'], i & 31, i >> 5,
+                                      sectionY,
+                                      _fieldBytes(section, field, ids))
+        if palette:
+            entry['palette'] = palette
+    finally:
+        for memory in outputs.values():
+            memory.close()
+    return entry
+
+def importWorld(exportDir, regionPath, processes=None):
+    """ Write exported arrays back into the chunks of the region files in
+        regionPath, see importRegion. -> number of chunks written
+    """
+    with open(os.path.join(exportDir, MANIFEST)) as file:
+        manifest = json.load(file)
+    if not os.path.exists(regionPath):
+        os.makedirs(regionPath)
+    jobs = [(exportDir, manifest, r,
+             mclevel.regionPath(regionPath, r['x'], r['z']))
+            for r in manifest['regions']]
+    return sum(mclevel.mapRegions(importRegion, jobs, processes))
+
+def importRegion(exportDir, manifest, entry, regionFile):
+    """ Replace the sections of the chunks in a region file with the
+        exported arrays of one manifest entry, through chunkToNbt. Fields
+        which were not exported are left as they were. Chunks and sections
+        which do not exist are only created where there are blocks other
+        than air. Only chunks that differ from the arrays are written, and
+        they are marked as needing light.
+        -> number of chunks written
+    """
+    x, z = entry['x'], entry['z']
+    palette = entry.get('palette', None)
+    states = dict((json.dumps(state, sort_keys=True), i)
+                  for i, state in enumerate(palette or ()))
+    inputs = {}
+    written = 0
+    try:
+        for field, name in entry['files'].items():
+            with open(os.path.join(exportDir, name), mode='rb') as file:
+                inputs[field] = mmap.mmap(file.fileno(), 0,
+                                          access=mmap.ACCESS_READ)
+        mode = 'r+b' if os.path.exists(regionFile) else 'w+b'
+        with open(regionFile, mode=mode) as file:
+            header = mclevel.RegionHeader(x, z, file)
+            locations = header.getLocations()
+            for lz in range(32):
+                # a row of 32 chunks is read from the arrays at once
+                layers = dict(((field, sectionY), _readLayer(
+                    memory, entry['offset'], lz, sectionY, _width(field)))
+                    for field, memory in inputs.items()
+                    for sectionY in range(16))
+                for lx in range(32):
+                    cx, cz = x*32 + lx, z*32 + lz
+                    if locations[lz*32 + lx] == (0, 0):
+                        chunk = mclevel.Chunk(cx, cz, dataVersion=entry.get(
+                            'dataVersion', 169))
+                    else:
+                        chunk = mclevel.nbtToChunk(
+                            mclevel.readChunk(cx, cz, header))
+                    if not _importChunk(chunk, layers, palette, states):
+                        continue
+                    chunk.lightPopulated = 0
+                    mclevel.writeCompressedChunk(
+                        cx, cz,
+                        mclevel.compressChunk(mclevel.chunkToNbt(chunk)),
+                        header)
+                    written += 1
+    finally:
+        for memory in inputs.values():
+            memory.close()
+    return written
+
+def _importChunk(chunk, layers, palette, states):
+    """ Fill the sections of a chunk from the layers of its row of chunks,
+        leaving the fields which are already the same alone.
+        states - dict of the JSON of each state in palette -> its index
+        -> True if the chunk changed and has to be written
+    """
+    lx = chunk.x & 31
+    changed = False
+    for sectionY in range(16):
+        raw = dict((field, _fromLayer(layer, lx, _width(field)))
+                   for (field, y), layer in layers.items() if y == sectionY)
+        section = chunk.sections.get(sectionY, None)
+        new = section is None
+        if new:
+            ids = raw.get('ids', b'')
+            if ids.count(0) == len(ids):
+                # only air
+                continue
+            if palette is not None:
+                section = mclevel.Section(palette=[])
+            else:
+                section = mclevel.Section()
+            chunk.addSection(sectionY, section)
+            changed = True
+        for field, values in raw.items():
+            if field == 'ids':
+                ids = array('H')
+                ids.frombytes(values)
+                if sys.byteorder != 'little':
+                    ids.byteswap()
+                if section.palette is not None:
+                    if not new and _regionIds(section, states) == ids:
+                        continue
+                    _fromRegionPalette(section, ids, palette)
+                elif section.ids == ids:
+                    continue
+                else:
+                    section.ids = ids
+            elif field == 'data' and section.palette is not None:
+                continue
+            elif bytes(getattr(section, field)) == values:
+                continue
+            else:
+                setattr(section, field, bytearray(values))
+            changed = True
+    if changed:
+        chunk.heightmap = None
+    return changed
+
+def _toRegionPalette(section, palette, states):
+    """ -> array('H') of the ids of a section with a palette as indices into
+        the palette of the region, which is extended as needed
+    """
+    mapping = []
+    for state in section.palette:
+        key = json.dumps(state, sort_keys=True)
+        if key not in states:
+            states[key] = len(palette)
+            palette.append(state)
+        mapping.append(states[key])
+    return array('H', [mapping[i] for i in section.ids])
+
+def _regionIds(section, states):
+    """ -> array('H') of the ids of a section with a palette as indices into
+        the palette of the region, or None if it has a state the region's
+        palette does not
+    """
+    try:
+        mapping = [states[json.dumps(state, sort_keys=True)]
+                   for state in section.palette]
+    except KeyError:
+        return None
+    return array('H', [mapping[i] for i in section.ids])
+
+def _fromRegionPalette(section, ids, palette):
+    """ Set the ids and palette of a section from indices into the palette
+        of the region
+    """
+    used = sorted(set(ids))
+    local = dict((id, i) for i, id in enumerate(used))
+    section.palette = [palette[id] for id in used]
+    section.ids = array('H', [local[id] for id in ids])
+
+def _fieldBytes(section, field, ids):
+    """ -> little endian bytes of a field of a section, ordered YZX """
+    if field == 'ids':
+        if sys.byteorder != 'little':
+            ids = array('H', ids)
+            ids.byteswap()
+        return ids.tobytes()
+    return bytes(getattr(section, field))
+
+def _writeSection(memory, offset, lx, lz, sectionY, values):
+    """ Copy a section's values into an array, a row of 16 blocks at a time
+        lx, lz - the chunk's position within the region
+    """
+    width = len(values) // 4096
+    row = 16 * width
+    for i in range(256):
+        # i is y*16 + z within the section
+        start = offset + (((sectionY*16 + (i >> 4))*512 + lz*16 + (i & 15))
+                          * 512 + lx*16) * width
+        memory[start:start + row] = values[i*row:(i + 1)*row]
+
+def _readLayer(memory, offset, lz, sectionY, width):
+    """ -> array('Q') of a section's worth of layers (16 y by 16 z by 512 x)
+        of a row of chunks, or None if they are all zero
+    """
+    size = 16 * 512 * width
+    raw = b''.join(memory[start:start + size] for start in (
+        offset + ((sectionY*16 + y)*512 + lz*16) * 512 * width
+        for y in range(16)))
+    if raw.count(0) == len(raw):
+        return None
+    return array('Q', raw)
+
+def _fromLayer(layer, lx, width):
+    """ -> bytes of the section of chunk lx in a layer from _readLayer,
+        ordered YZX
+    """
+    if layer is None:
+        return bytes(4096 * width)
+    # a row of 16 blocks is 2*width longs, and there are 32 rows across the
+    # layer, so the rows of one chunk are picked out with strided slices
+    per = 2 * width
+    out = array('Q', bytes(4096 * width))
+    for j in range(per):
+        out[j::per] = layer[lx*per + j::32*per]
+    return out.tobytes()
+
+def _width(field):
+    return int(FIELDS[field][2:])
+
+def _createArray(path, dtype, format):
+    """ Create a zeroed array file, mapped into memory.
+        -> (mmap, offset of the array in the file)
+    """
+    header = _npyHeader(dtype, SHAPE) if format == 'npy' else b''
+    size = len(header) + SHAPE[0] * SHAPE[1] * SHAPE[2] * int(dtype[2:])
+    with open(path, mode='w+b') as file:
+        file.write(header)
+        # the rest of the file is sparse until it is written to
+        file.truncate(size)
+        return mmap.mmap(file.fileno(), size), len(header)
+
+def _npyHeader(dtype, shape):
+    """ -> the header of a version 1.0 .npy file """
+    text = ("{'descr': '" + dtype + "', 'fortran_order': False, 'shape': ("
+            + ', '.join(str(i) for i in shape) + '), }')
+    # the header, with the magic string and its length, is padded with
+    # spaces to a multiple of 64 bytes and ends in a newline
+    padding = 64 - (10 + len(text) + 1) % 64
+    text += ' ' * (padding % 64) + '\n'
+    return (b'\x93NUMPY\x01\x00' + len(text).to_bytes(2, 'little')
+            + text.encode('latin1'))
+
+def main(argv):
+    if len(argv) >= 3 and argv[0] == '--import':
+        print(str(importWorld(argv[1], argv[2])) + ' chunks written')
+        return 0
+    if len(argv) < 2:
+        print(__doc__)
+        return 2
+    fields = ('ids',)
+    if '--fields' in argv:
+        fields = tuple(argv[argv.index('--fields') + 1].split(','))
+    manifest = exportWorld(argv[0], argv[1], fields,
+                           'raw' if '--raw' in argv else 'npy')
+    print(str(len(manifest['regions'])) + ' regions exported')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,261 @@
+"""
+    Integrity checks (and repairs) for region files.
+
+    Usage: python fsck.py <region directory> [--decompress] [--repair]
+"""
+import io
+import os
+import os.path
+import struct
+import sys
+import zlib
+import gzip
+import mclevel
+import nbt
+
+# kinds of problem
+UNALIGNED = 'unaligned'
+TRUNCATED = 'truncated'
+IN_HEADER = 'inHeader'
+PAST_END = 'pastEnd'
+OVERLAP = 'overlap'
+BAD_LENGTH = 'badLength'
+BAD_COMPRESSION = 'badCompression'
+BAD_DATA = 'badData'
+
+class RegionReport:
+    """ The problems found in one region file.
+        problems - list of (chunkX, chunkZ, kind, detail); chunkX and chunkZ
+        are None for problems with the whole file
+    """
+    def __init__(self, path, x, z):
+        self.path = path
+        self.x = x
+        self.z = z
+        self.chunks = 0
+        self.problems = []
+    def add(self, index, kind, detail):
+        if index is None:
+            self.problems.append((None, None, kind, detail))
+        else:
+            self.problems.append((self.x*32 + (index & 31),
+                                  self.z*32 + (index >> 5), kind, detail))
+    @property
+    def ok(self):
+        return len(self.problems) == 0
+    def __repr__(self):
+        return ('RegionReport(' + os.path.basename(self.path) + ', '
+                + str(self.chunks) + ' chunks, '
+                + str(len(self.problems)) + ' problems)')
+
+def checkRegion(path, decompress=False):
+    """ -> RegionReport of a region file.
+        The header is checked as a whole: chunks inside the header, past the
+        end of the file and overlapping each other. Then the length and
+        compression type of every chunk are checked against its sectors.
+        decompress - also decompress every chunk (NBT is not parsed)
+    """
+    x, z = mclevel.regionCoords(path)
+    report = RegionReport(path, x, z)
+    fileSize = os.path.getsize(path)
+    if fileSize & 4095:
+        report.add(None, UNALIGNED, 'file size ' + str(fileSize)
+                   + ' is not a multiple of 4096')
+    if fileSize < 4096*2:
+        report.add(None, TRUNCATED, 'file is smaller than the header')
+        return report
+    sectors = (fileSize + 4095) // 4096
+    with open(path, mode='rb') as file:
+        locations = _readLocations(file)
+        report.chunks = sum(1 for l in locations if l != (0, 0))
+        _checkTable(report, locations, sectors)
+        bad = set(c[:2] for c in report.problems if c[0] is not None)
+        for i, (offset, size) in enumerate(locations):
+            if (offset, size) == (0, 0):
+                continue
+            if (x*32 + (i & 31), z*32 + (i >> 5)) in bad:
+                # reading a chunk that is outside of the file is pointless
+                continue
+            _checkChunk(report, file, i, offset, size, decompress)
+    return report
+
+def _readLocations(file):
+    file.seek(0)
+    raw = struct.unpack('>1024I', file.read(4096))
+    return [(i >> 8, i & 0xFF) for i in raw]
+
+def _checkTable(report, locations, sectors):
+    """ Check the location table as a whole """
+    used = sorted((offset, offset + size, i)
+                  for i, (offset, size) in enumerate(locations)
+                  if (offset, size) != (0, 0))
+    end = 0
+    last = None
+    for start, stop, i in used:
+        if start < 2:
+            report.add(i, IN_HEADER, 'chunk starts in the header')
+        elif stop > sectors:
+            report.add(i, PAST_END, 'chunk ends at sector ' + str(stop)
+                       + ' but the file has ' + str(sectors))
+        elif start == stop:
+            report.add(i, BAD_LENGTH, 'chunk has zero sectors')
+        if start < end:
+            report.add(i, OVERLAP, 'chunk overlaps chunk ' + str(last))
+        if stop > end:
+            end = stop
+            last = i
+
+def _checkChunk(report, file, i, offset, size, decompress):
+    file.seek(offset * 4096)
+    prefix = file.read(5)
+    if len(prefix) < 5:
+        report.add(i, PAST_END, 'chunk header is past the end of the file')
+        return
+    length = int.from_bytes(prefix[:4], 'big')
+    compression = prefix[4]
+    if length == 0 or length + 4 > size * 4096:
+        report.add(i, BAD_LENGTH, 'length ' + str(length) + ' does not fit in '
+                   + str(size) + ' sectors')
+        return
+    if compression not in (1, 2):
+        report.add(i, BAD_COMPRESSION, 'unknown compression type '
+                   + str(compression))
+        return
+    if not decompress:
+        return
+    try:
+        if compression == 2:
+            zlib.decompress(file.read(length - 1))
+        else:
+            gzip.decompress(file.read(length - 1))
+    except (zlib.error, OSError, EOFError) as e:
+        report.add(i, BAD_DATA, 'failed to decompress: ' + str(e))
+
+def repairRegion(path, report=None):
+    """ Fix the problems in a region file in place.
+        Chunks that can not be read are removed from the header. Where
+        chunks overlap, the sectors belong to the chunk whose own data they
+        hold (see _untangle). The file is padded to a multiple of 4096
+        bytes.
+        -> RegionReport of the repaired file
+    """
+    if report is None:
+        report = checkRegion(path, decompress=True)
+    if os.path.getsize(path) < 4096*2:
+        # nothing can be saved without a header
+        with open(path, mode='wb') as file:
+            file.write(b'\x00' * 4096 * 2)
+        return checkRegion(path, decompress=True)
+    with open(path, mode='r+b') as file:
+        file.seek(0, 2)
+        if file.tell() & 4095:
+            file.write(b'\x00' * (4096 - (file.tell() & 4095)))
+        header = mclevel.RegionHeader(report.x, report.z, file)
+        for x, z, kind, detail in report.problems:
+            if x is not None and kind != OVERLAP:
+                header.setChunkInfo(x, z, 0, 0)
+        _untangle(header, _overlapping(header))
+    return checkRegion(path, decompress=True)
+
+def _overlapping(header):
+    """ -> list of (x, z) of every chunk whose sectors overlap another's,
+        ordered by their first sector
+    """
+    used = sorted((offset, offset + size, i)
+                  for i, (offset, size) in enumerate(header.getLocations())
+                  if (offset, size) != (0, 0))
+    found = set()
+    # chunks whose sectors have not ended yet, as (stop, index)
+    active = []
+    for start, stop, i in used:
+        active = [a for a in active if a[0] > start]
+        if active:
+            found.add(i)
+            found.update(j for end, j in active)
+        active.append((stop, i))
+    return [(header.x*32 + (i & 31), header.z*32 + (i >> 5))
+            for start, stop, i in used if i in found]
+
+def _untangle(header, chunks):
+    """ Sort out chunks whose sectors overlap, in the order given. Sectors
+        only belong to a chunk if they hold its own data: it decompresses
+        and its xPos and zPos are the chunk's. Chunks pointing at another
+        chunk's data are removed from the header. A chunk whose data is its
+        own keeps its sectors unless an earlier chunk kept some of them, in
+        which case it is copied to the end of the file.
+    """
+    kept = []
+    for x, z in chunks:
+        offset, size, timestamp = header.getChunkInfo(x, z)
+        header.file.seek(offset * 4096)
+        data = header.file.read(size * 4096)
+        if _chunkPos(data) != (x, z):
+            header.setChunkInfo(x, z, 0, 0)
+        elif any(offset < stop and start < offset + size
+                 for start, stop in kept):
+            newOffset = header._alloc(size)
+            header.file.seek(newOffset * 4096)
+            header.file.write(data)
+            header.setChunkInfo(x, z, newOffset, size)
+            kept.append((newOffset, newOffset + size))
+        else:
+            kept.append((offset, offset + size))
+
+def _chunkPos(data):
+    """ -> (xPos, zPos) of the chunk stored at the start of data (the
+        sectors of a chunk), or None if it can not be decoded
+    """
+    length = int.from_bytes(data[:4], 'big')
+    if length == 0 or length + 4 > len(data) or data[4] not in (1, 2):
+        return None
+    try:
+        level = nbt.readPartial(io.BytesIO(mclevel.decompressChunk(
+            data[4], data[5:4 + length])), {'Level': {'xPos': True,
+                                                     'zPos': True}})['Level']
+        return level['xPos'], level['zPos']
+    except Exception:
+        # anything can go wrong reading garbage
+        return None
+
+def checkWorld(regionPath, decompress=False, processes=None):
+    """ -> list of RegionReport, one for every region file in regionPath
+        processes - worker processes, see mclevel.mapRegions
+    """
+    jobs = [(mclevel.regionPath(regionPath, x, z), decompress)
+            for x, z in mclevel.listRegions(regionPath)]
+    return mclevel.mapRegions(checkRegion, jobs, processes)
+
+def repairWorld(regionPath, processes=None):
+    """ Check every region, repairing the broken ones.
+        -> list of RegionReport from before the repairs
+    """
+    reports = checkWorld(regionPath, decompress=True, processes=processes)
+    for report in reports:
+        if not report.ok:
+            repairRegion(report.path, report)
+    return reports
+
+def main(argv):
+    if len(argv) < 1:
+        print(__doc__)
+        return 2
+    regionPath = argv[0]
+    if '--repair' in argv:
+        reports = repairWorld(regionPath)
+    else:
+        reports = checkWorld(regionPath, decompress='--decompress' in argv)
+    problems = 0
+    for report in reports:
+        for x, z, kind, detail in report.problems:
+            where = '' if x is None else ' chunk ' + str(x) + ', ' + str(z)
+            print(os.path.basename(report.path) + where + ': ' + kind + ', '
+                  + detail)
+            problems += 1
+    print(str(len(reports)) + ' regions, '
+          + str(sum(r.chunks for r in reports)) + ' chunks, '
+          + str(problems) + ' problems'
+          + (' (repaired)' if problems and '--repair' in argv else ''))
+    return 1 if problems else 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -1,6 +1,7 @@
 """
     Here are some facilities for parsing Minecraft level files.
 """
+import copy
 import os
 import os.path
 import time
@@ -9,100 +10,382 @@ import nbt
 import io
 import math
 import json
-from util import _retainFilePos
+import re
+import struct
+import sys
+import threading
+from array import array
+from collections import Counter, deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from util import _retainFilePos, stats
 import gzip
 
 class MinecraftLevel:
     """ Responsible for auxillary data about a level, like the level.dat, etc
+
+        Nothing is read until it is used: level.dat is parsed the first time
+        levelOptions is used and each dimension is opened the first time it
+        is used.
     """
+    # attribute -> directory of each dimension
+    dimensions = {'overworld': 'region', 'nether': 'DIM-1', 'end': 'DIM1'}
+
     def __init__(self, pathToWorld, levelOptions=None):
         self.path = pathToWorld
         # only try making the endmost file since only that represents the level
         if not os.path.exists(self.path):
             os.mkdir(self.path)
         self.levelFile = os.path.join(self.path, "level.dat")
-        if "level.dat" not in os.listdir(self.path):
-            # load in the default data from the format file
-            initialDataFile = 'formats/level.dat.json'
-            with open(initialDataFile, mode='r') as file:
-                self._levelOptions = json.load(file)
-        else:
-            # load in the data from the existing file
-            with gzip.open(self.levelFile) as file:
-                reader = nbt.NbtReader(file)
-                self._levelOptions = reader.read().pythonify()
+        self._levelOptions = None
+        # level.dat as it was read or last written (uncompressed), with the
+        # span of every tag in Data, and the values those tags hold
+        self._levelData = None
+        self._spans = None
+        self._saved = None
+        # the dimensions share one set of open files
+        self.regionPool = RegionPool()
+        self._worlds = {}
         if levelOptions is not None:
             # merge the requested changes in
-            self.levelOptions.update({"Data": levelOptions})
-        overworldPath = os.path.join(self.path, 'region')
-        netherPath = os.path.join(self.path, 'DIM-1')
-        endPath = os.path.join(self.path, 'DIM1')
-        if not os.path.exists(overworldPath):
-            os.mkdir(overworldPath)
-        if not os.path.exists(netherPath):
-            os.mkdir(netherPath)
-        if not os.path.exists(endPath):
-            os.mkdir(endPath)
-        self.overworld = MinecraftWorld(overworldPath)
-        self.nether = MinecraftWorld(netherPath)
-        self.end = MinecraftWorld(endPath)
+            self.levelOptions.update(levelOptions)
     @property
     def levelOptions(self):
         # hide the 'Data' tag from observers
+        self._loadLevel()
         return self._levelOptions['Data']
     @levelOptions.setter
     def levelOptions(self, value):
-        self._levelOptions['Data']
+        self._loadLevel()
+        self._levelOptions['Data'] = value
+    def _loadLevel(self):
+        if self._levelOptions is not None:
+            return
+        if not os.path.exists(self.levelFile):
+            self._levelOptions = defaultLevelOptions()
+            return
+        with gzip.open(self.levelFile) as file:
+            data = file.read()
+        self._levelOptions, self._spans = _readLevel(data)
+        self._levelData = data
+        self._saved = copy.deepcopy(self._levelOptions['Data'])
     def writeLevelOptions(self):
-        levelFile = self.levelFile
-        with open('formats/level.tagtypes.json', mode='r') as file:
-            tagTypes = json.load(file)
-        nbtTag = nbt.fromDict("", self._levelOptions, tagTypes)
-        with gzip.open(levelFile, mode='wb') as file:
-            writer = nbt.NbtWriter(file)
-            writer.write(nbtTag)
+        """ Write level.dat, if it has changed or does not exist. Only the
+            tags of Data which have changed are encoded again; the rest, and
+            any tags outside of Data, are copied from the file as it was read.
+        """
+        if self._levelOptions is None and os.path.exists(self.levelFile):
+            # never read, so nothing can have changed
+            return
+        self._loadLevel()
+        values = self._levelOptions['Data']
+        if self._levelData is None:
+            # a new level
+            data = levelSchema().encode(self._levelOptions)
+            self._levelOptions, self._spans = _readLevel(data)
+            self._levelOptions['Data'] = values
+        elif values == self._saved:
+            return
+        else:
+            data, self._spans = _patchLevel(self._levelData, self._spans,
+                                            values, self._saved)
+        with gzip.open(self.levelFile, mode='wb') as file:
+            file.write(data)
+        self._levelData = data
+        self._saved = copy.deepcopy(values)
+    def getDimension(self, name):
+        """ -> MinecraftWorld of a dimension ('overworld', 'nether' or
+            'end'), opened and its directory made when it is first used
+        """
+        world = self._worlds.get(name, None)
+        if world is None:
+            path = os.path.join(self.path, self.dimensions[name])
+            if not os.path.exists(path):
+                os.mkdir(path)
+            world = MinecraftWorld(path, pool=self.regionPool)
+            self._worlds[name] = world
+        return world
+    @property
+    def overworld(self):
+        return self.getDimension('overworld')
+    @property
+    def nether(self):
+        return self.getDimension('nether')
+    @property
+    def end(self):
+        return self.getDimension('end')
     def writeAll(self):
         self.writeLevelOptions()
-        self.overworld.writeAll()
-        self.nether.writeAll()
-        self.end.writeAll()
+        for world in self._worlds.values():
+            world.writeAll()
     def __enter__(self):
-        self.overworld = self.overworld.__enter__()
-        self.nether = self.nether.__enter__()
-        self.end = self.end.__enter__()
         return self
     def __exit__(self, *args):
         # TODO: handle exceptions properly
-        self.overworld.__exit__(*args)
-        self.nether.__exit__(*args)
-        self.end.__exit__(*args)
+        for world in self._worlds.values():
+            world.__exit__(*args)
+
+# the formats directory is kept next to this file
+FORMATS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'formats')
+_defaultLevel = None
+
+def defaultLevelOptions():
+    """ -> a new copy of the level.dat of a new level. The format file is
+        only read once per process.
+    """
+    global _defaultLevel
+    if _defaultLevel is None:
+        with open(os.path.join(FORMATS_PATH, 'level.dat.json')) as file:
+            _defaultLevel = json.load(file)
+    return copy.deepcopy(_defaultLevel)
+
+def levelSchema():
+    """ -> the compiled Schema of level.dat """
+    return nbt.loadSchema(os.path.join(FORMATS_PATH, 'level.tagtypes.json'))
+
+def _readLevel(data):
+    """ Parse uncompressed level.dat.
+        -> (pythonified root, {name: (start, end, tagtypes)} of the tags in
+        Data), where start and end are offsets into data
+    """
+    stream = io.BytesIO(data)
+    reader = nbt.NbtReader(stream)
+    reader.readTagHeader()
+    root = {}
+    spans = {}
+    while True:
+        tag = reader.readTagHeader()
+        if tag.id == nbt.Tag.TAG_End:
+            break
+        if tag.name != 'Data' or tag.id != nbt.Tag.TAG_Compound:
+            tag.value = reader.parsePayload(tag.id)
+            if tag.id == nbt.Tag.TAG_List:
+                tag.listType, tag.value = tag.value
+            root[tag.name] = tag.pythonify()
+            continue
+        values = {}
+        while True:
+            start = stream.tell()
+            child = reader.readTag()
+            if child.id == nbt.Tag.TAG_End:
+                break
+            spans[child.name] = (start, stream.tell(), child.getFormatDict())
+            values[child.name] = child.pythonify()
+        spans[None] = stream.tell() - 1
+        root['Data'] = values
+    return root, spans
+
+def _patchLevel(data, spans, values, saved):
+    """ -> (level.dat with the tags of Data that differ from saved encoded
+        again, spans of the new level.dat)
+    """
+    types = levelSchema().tagtypes['Data']
+    first = min([s[0] for k, s in spans.items() if k is not None]
+                or [spans[None]])
+    out = bytearray(data[:first])
+    newSpans = {}
+    for name, value in values.items():
+        start = len(out)
+        span = spans.get(name, None)
+        if span is not None and name in saved and saved[name] == value:
+            out += data[span[0]:span[1]]
+            tagtypes = span[2]
+        else:
+            tagtypes = types.get(name, None) or span and span[2]
+            if not tagtypes:
+                raise ValueError('Key is not in tagtypes: ' + repr(name))
+            out += nbt.compileSchema(tagtypes).encode(value, name)
+        newSpans[name] = (start, len(out), tagtypes)
+    newSpans[None] = len(out)
+    out += data[spans[None]:]
+    return bytes(out), newSpans
 
 class MinecraftWorld:
-    def __init__(self, regionPath, safetyMax=10*1024*1024*1024):
+    def __init__(self, regionPath, safetyMax=10*1024*1024*1024, index=None,
+                 writeBehind=False, maxPending=64, prefetchWorkers=0,
+                 readAhead=4, pool=None):
+        """
+            index - optional chunkindex.ChunkIndex to keep up to date as
+            chunks are written
+            writeBehind - write evicted chunks from a background thread, so
+            edits never wait for compression or the disk. flush() waits for
+            the writes to finish.
+            maxPending - most chunks that may be waiting to be written before
+            evictions block (write behind only)
+            prefetchWorkers - threads which load chunks before they are
+            needed, see prefetch. 0 turns prefetching off.
+            readAhead - chunks to load ahead when getChunk sees a sequential
+            or strided pattern of misses, 0 to only prefetch when asked to
+            pool - RegionPool of open region files, which may be shared with
+            other worlds; each world has its own by default
+        """
         self.path = regionPath
-        self.regionCache = {}
+        self.index = index
+        self.pool = pool if pool is not None else RegionPool()
         self.chunkCache = {}
         self.timestamps = {}
         self.cachedChunks = 0
         self.maxChunks = 32
-        self.cachedRegions = 0
-        self.maxRegions = 4
-        self.handles = []
+        # chunks which were not on disk when they were loaded
+        self._blank = set()
+        # chunk -> positions of its entities and tile entities on disk, see
+        # _chunksInBox
+        self._entityIndex = {}
+        # chunks that have been edited since they were last lit
+        self.lightDirty = set()
         # 10 gigabyte default
         self.regionFileMaxSize = safetyMax
+        # the region files are shared with other threads and other worlds
+        self._lock = self.pool.lock
+        self._flusher = _Flusher(self, maxPending) if writeBehind else None
+        self._prefetcher = (_Prefetcher(self, prefetchWorkers, readAhead)
+                            if prefetchWorkers > 0 else None)
     def getBlock(self, x, y, z):
         c = self.getChunk(x//16, z//16)
         x, z = x & 15, z & 15
         return c.getBlock(x, y, z)
     def setBlock(self, x, y, z, b):
         c = self.getChunk(x//16, z//16)
-        x, z = x & 15, z & 15
-        c.setBlock(x, y, z, b)
-        self.timestamps[(x//16, z//16)] = time.time()
+        c.setBlock(x & 15, y, z & 15, b)
+        self.timestamps[(c.x, c.z)] = time.time()
+        self.lightDirty.add((c.x, c.z))
+    def getTileEntity(self, x, y, z):
+        """ -> the tile entity compound at a block, or None """
+        return self.getChunk(x//16, z//16).getTileEntity(x, y, z)
+    def setTileEntity(self, tileEntity):
+        """ Add or replace a tile entity, placed by its x, y and z tags """
+        c = self.getChunk(tileEntity['x'].value//16,
+                          tileEntity['z'].value//16)
+        c.addTileEntity(tileEntity)
+        self.timestamps[(c.x, c.z)] = time.time()
+    def removeTileEntity(self, x, y, z):
+        """ -> the removed tile entity compound, or None """
+        c = self.getChunk(x//16, z//16)
+        self.timestamps[(c.x, c.z)] = time.time()
+        return c.removeTileEntity(x, y, z)
+    def tileEntitiesInBox(self, xMin, yMin, zMin, xMax, yMax, zMax):
+        """ -> list of tile entity compounds with xMin <= x < xMax, etc. """
+        out = []
+        for c in self._chunksInBox(xMin, zMin, xMax, zMax, True):
+            out.extend(c.tileEntitiesInBox(xMin, yMin, zMin, xMax, yMax, zMax))
+        return out
+    def entitiesInBox(self, xMin, yMin, zMin, xMax, yMax, zMax):
+        """ -> list of entity compounds with xMin <= x < xMax, etc. """
+        out = []
+        for c in self._chunksInBox(xMin, zMin, xMax, zMax):
+            out.extend(c.entitiesInBox(xMin, yMin, zMin, xMax, yMax, zMax))
+        return out
+    def removeTileEntities(self, xMin, yMin, zMin, xMax, yMax, zMax,
+                           match=None):
+        """ Remove the tile entities in a box, or only those for which
+            match(tileEntity) is true. -> number removed
+        """
+        removed = 0
+        for c in self._chunksInBox(xMin, zMin, xMax, zMax, True):
+            found = [t for t in c.tileEntitiesInBox(xMin, yMin, zMin,
+                                                    xMax, yMax, zMax)
+                     if match is None or match(t)]
+            if not found:
+                continue
+            c, found = self._editable(c, found)
+            for t in found:
+                c.removeTileEntity(t['x'].value, t['y'].value, t['z'].value)
+            removed += len(found)
+            self.timestamps[(c.x, c.z)] = time.time()
+        return removed
+    def removeEntities(self, xMin, yMin, zMin, xMax, yMax, zMax, match=None):
+        """ Remove the entities in a box, or only those for which
+            match(entity) is true. -> number removed
+        """
+        removed = 0
+        for c in self._chunksInBox(xMin, zMin, xMax, zMax):
+            found = [e for e in c.entitiesInBox(xMin, yMin, zMin,
+                                                xMax, yMax, zMax)
+                     if match is None or match(e)]
+            if not found:
+                continue
+            c, found = self._editable(c, found)
+            gone = set(map(id, found))
+            c.entities = [e for e in c.entities if id(e) not in gone]
+            removed += len(found)
+            self.timestamps[(c.x, c.z)] = time.time()
+        return removed
+    def _editable(self, c, found):
+        """ -> (the cached chunk, found) for a chunk from _chunksInBox; a
+            chunk that was only read for its entities is loaded, and found
+            is picked out of the loaded chunk by position in its lists
+        """
+        if self.chunkCache.get((c.x, c.z), None) is c:
+            return c, found
+        loaded = self.getChunk(c.x, c.z)
+        entities = dict((id(e), i) for i, e in enumerate(c.entities))
+        tileEntities = dict((id(t), k) for k, t in c.tileEntities.items())
+        picked = []
+        for e in found:
+            if id(e) in entities:
+                picked.append(loaded.entities[entities[id(e)]])
+            else:
+                picked.append(loaded.tileEntities[tileEntities[id(e)]])
+        return loaded, picked
+    def _chunksInBox(self, xMin, zMin, xMax, zMax, tileEntities=False):
+        """ Yield the chunks that overlap a box of blocks and may have
+            entities, or tile entities, in it. Chunks in memory are used as
+            they are. Others are read for their entity tags alone, into a
+            chunk which does not join the cache, and the positions found are
+            kept so that later queries only read chunks with something in
+            their box.
+        """
+        box = (xMin, zMin, xMax, zMax)
+        for cz in range(math.floor(zMin)//16, (math.ceil(zMax) - 1)//16 + 1):
+            for cx in range(math.floor(xMin)//16,
+                            (math.ceil(xMax) - 1)//16 + 1):
+                c = self.chunkCache.get((cx, cz), None)
+                if c is None and self._flusher is not None \
+                        and self._flusher.holds(cx, cz):
+                    # newer than what is on disk
+                    c = self.getChunk(cx, cz)
+                if c is not None:
+                    yield c
+                    continue
+                positions = self._entityIndex.get((cx, cz), None)
+                if positions is None or \
+                        _anyInBox(positions[tileEntities], *box):
+                    c = self._readEntities(cx, cz)
+                    if c is not None:
+                        yield c
+    def _noteEntities(self, c):
+        """ Keep the entity index up to date with a chunk just written.
+            Called with the lock held.
+        """
+        self._entityIndex[(c.x, c.z)] = _entityPositions(
+            c.entities, c.tileEntities)
+    def _readEntities(self, x, z):
+        """ -> Chunk holding only the entities and tile entities of the
+            chunk at x, z on disk, or None if it is not on disk
+        """
+        with self._lock:
+            header = self.getRegion(*getRegionPos(x, z))
+            compressed = (readCompressedChunk(x, z, header)
+                          if header is not None else None)
+        chunk = None
+        if compressed is not None:
+            tags = _readEntityTags(decompressChunk(*compressed))
+            chunk = Chunk(x, z)
+            chunk.entities = list(tags['Entities'].value)
+            for tileEntity in tags['TileEntities'].value:
+                chunk.addTileEntity(tileEntity)
+        positions = (_entityPositions(chunk.entities, chunk.tileEntities)
+                     if chunk is not None else ([], []))
+        with self._lock:
+            # the chunk may have been written since it was read
+            self._entityIndex.setdefault((x, z), positions)
+        return chunk
     def fillRegion(self, xMin, yMin, zMin, xSize, height, zSize, b):
         xMax = xMin + xSize
         zMax = zMin + zSize
         yMax = yMin + height
+        self.prefetch(xMin//16, zMin//16, (xMax - 1)//16 - xMin//16 + 1,
+                      (zMax - 1)//16 - zMin//16 + 1)
         # if this is too slow too often, we could probably optimize this quite a
         # bit by working in groups of chunks!
         for z in range(zMin, zMax):
@@ -110,120 +393,264 @@ class MinecraftWorld:
                 for y in range(yMin, yMax):
                     self.setBlock(x, y, z, b)
     def initializeArea(self, xMin, zMin, xSize, zSize, terrainPopulated):
+        self.prefetch(xMin, zMin, xSize, zSize)
         for z in range(zMin, zMin + zSize):
             for x in range(xMin, xMin + xSize):
                 c = self.getChunk(x, z)
                 c.terrainPopulated = terrainPopulated
-    def getChunk(self, x, z):
+                self._blank.discard((x, z))
+    def relight(self):
+        """ Recompute the light of every chunk edited since the last relight,
+            along with any of their neighbours that are in memory.
+        """
+        coords = set(self.lightDirty)
+        for x, z in self.lightDirty:
+            for n in ((x - 1, z), (x + 1, z), (x, z - 1), (x, z + 1)):
+                if n in self.chunkCache:
+                    coords.add(n)
+        self.relightChunks(coords)
+    def relightArea(self, xMin, zMin, xSize, zSize):
+        """ Recompute the light of an area, in chunk coordinates. """
+        self.relightChunks((x, z) for z in range(zMin, zMin + zSize)
+                                  for x in range(xMin, xMin + xSize))
+    def relightChunks(self, coords):
+        coords = set(coords)
+        # the whole group (and its border) has to stay in memory while it is
+        # lit, otherwise evicted chunks would be written without their light
+        maxChunks = self.maxChunks
+        self.maxChunks = max(maxChunks, self.cachedChunks + 5 * len(coords))
         try:
+            chunks = dict((c, self.getChunk(*c)) for c in coords)
+            lightChunks(chunks, self._getExistingChunk)
+        finally:
+            self.maxChunks = maxChunks
+        self.lightDirty.difference_update(coords)
+        self._trimCache()
+    def _getExistingChunk(self, x, z):
+        """ -> the chunk if it is in memory or on disk, without creating it """
+        if (x, z) in self.chunkCache:
             return self.chunkCache[(x, z)]
+        with self._lock:
+            header = self.getRegion(*getRegionPos(x, z))
+            if header is None or header.getChunkInfo(x, z)[0] is None:
+                return None
+        return self.getChunk(x, z)
+    def getChunk(self, x, z):
+        try:
+            chunk = self.chunkCache[(x, z)]
+            stats.count('chunkCacheHits')
+            return chunk
         except KeyError:
             # we need to load the chunk
-            pass
-        header = self.getRegion(*getRegionPos(x, z))
-        chunkNbt = readChunk(x, z, header)
-        if chunkNbt is None:
-            chunk = Chunk(x, z)
-        else:
-            chunk = nbtToChunk(chunkNbt)
+            stats.count('chunkCacheMisses')
+        chunk = None
+        if self._flusher is not None:
+            # the chunk may not have been written yet
+            chunk = self._flusher.reclaim(x, z)
+        if self._prefetcher is not None:
+            prefetched = self._prefetcher.take(x, z)
+            chunk = chunk or prefetched
+        if chunk is None:
+            chunk = self._loadChunk(x, z)
 
         self.chunkCache[(x, z)] = chunk
         self.timestamps[(x, z)] = time.time()
-        # drop a chunk if we have too many in memory
         self.cachedChunks += 1
-        if self.cachedChunks > self.maxChunks:
+        self._trimCache()
+        if self._prefetcher is not None:
+            self._prefetcher.missed(x, z)
+        return chunk
+    def prefetch(self, xMin, zMin, xSize, zSize):
+        """ Start loading an area, in chunk coordinates, in the background.
+            The chunks are loaded in order, a cache's worth at a time, and
+            only join the cache once getChunk asks for them. Does nothing
+            unless the world has prefetchWorkers.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.hint((x, z) for z in range(zMin, zMin + zSize)
+                                         for x in range(xMin, xMin + xSize))
+    def _prefetchChunk(self, x, z):
+        """ Load a chunk on a prefetch thread, -> None if there is nothing
+            to load or the chunk is already in memory
+        """
+        if (x, z) in self.chunkCache:
+            return None
+        if self._flusher is not None and self._flusher.holds(x, z):
+            return None
+        return self._loadChunk(x, z)
+    def _loadChunk(self, x, z):
+        # only the file access needs the lock, other threads may decompress
+        # and parse at the same time
+        with self._lock:
+            header = self.getRegion(*getRegionPos(x, z))
+            compressed = (readCompressedChunk(x, z, header)
+                          if header is not None else None)
+        chunkNbt = None
+        if compressed is not None:
+            data = decompressChunk(*compressed)
+            with stats.timer('nbtParse'):
+                chunkNbt = nbt.NbtReader(io.BytesIO(data)).read()
+        if chunkNbt is None:
+            chunk = Chunk(x, z)
+            self._blank.add((x, z))
+        else:
+            with stats.timer('nbtToChunk'):
+                chunk = nbtToChunk(chunkNbt)
+        return chunk
+    def _needsWrite(self, c):
+        """ -> False for a chunk that is not on disk and is still empty,
+            so that merely looking at an area does not create files
+        """
+        return not ((c.x, c.z) in self._blank and c.isBlank())
+    def _trimCache(self):
+        # drop chunks if we have too many in memory
+        while self.cachedChunks > self.maxChunks:
             # drop the last updated chunk
             old = self._getOldestChunk()
-            self.writeChunk(*old)
+            stats.count('chunkEvictions')
+            if self._flusher is not None:
+                if self._needsWrite(self.chunkCache[old]):
+                    self._flusher.put(self.chunkCache[old])
+            else:
+                self.writeChunk(*old)
             self._dropChunk(*old)
-        return chunk
-    def getRegion(self, x, z):
-        # REFACTOR: this function might do a little too much
-        try:
-            return self.regionCache[(x, z)]
-        except KeyError:
-            # we need to load the region
-            pass
-        r = os.path.join(self.path, 'r.' + str(x) + '.' + str(z) + '.mca')
-        # open the file
-        try:
-            try:
-                # try opening the file for reading and writing, don't truncate
-                f = open(r, mode='r+b')
-            except FileNotFoundError:
-                # w+b will truncate the file, which won't matter if it doesn't
-                # exist
-                f = open(r, mode='w+b')
-                # write an empty header
-                f.write(b'\x00'*(4096*2))
-        except IOError as e:
-            print('something went wrong reading the files')
-            raise e
-        # create the header object
-        header = RegionHeader(x, z, f)
-        self.regionCache[(x, z)] = header
-        # record that we have the file handle
-        self.handles.append(f)
-        self.cachedRegions += 1
-        if self.cachedRegions > 4:
-            # drop the last updated region
-            old = self._getOldestRegion()
-            self.writeRegion(*old)
-            self._dropRegion(*old)
-        return header
+    def getRegion(self, x, z, write=False):
+        """ -> RegionHeader of a region from the world's pool of open files.
+            If the region file does not exist it is created when write is
+            True, otherwise None is returned. The header may be closed by the
+            pool as soon as another region is opened, so hold on to it only
+            while holding the pool's lock.
+        """
+        return self.pool.get(regionPath(self.path, x, z), x, z, write)
     def writeChunk(self, x, z):
         c = self.chunkCache[(x, z)]
-        rx, rz = getRegionPos(x, z)
-        assert self.regionCache[(rx, rz)], "region was not loaded"
-        writeChunk(chunkToNbt(c), self.regionCache[(rx, rz)])
+        if not self._needsWrite(c):
+            return
+        with stats.timer('chunkToNbt'):
+            tag = chunkToNbt(c)
+        with self._lock:
+            header = self.getRegion(*getRegionPos(x, z), write=True)
+            writeChunk(tag, header)
+            timestamp = header.getChunkInfo(x, z)[2]
+            self._noteEntities(c)
+        if self.index is not None:
+            self.index.updateChunk(c, timestamp)
+    def _writeBatch(self, region, zipped):
+        """ Write [(chunk, compressed chunk)] from the flusher thread.
+            -> [(chunk, timestamp)] for the index
+        """
+        written = []
+        with self._lock:
+            header = self.getRegion(*region, write=True)
+            for c, data in zipped:
+                writeCompressedChunk(c.x, c.z, data, header)
+                self._noteEntities(c)
+                written.append((c, header.getChunkInfo(c.x, c.z)[2]))
+        return written
     def writeRegion(self, x, z):
         # writes all the chunks in this region
         r = (x, z)
+        if self._flusher is not None:
+            # through the flusher, so an older copy waiting there can not be
+            # written over the newer one
+            for c, chunk in self.chunkCache.items():
+                if getRegionPos(*c) == r and self._needsWrite(chunk):
+                    self._flusher.put(chunk)
+            self.flush()
+            return
         for c in self.chunkCache.keys():
             if getRegionPos(*c) == r:
                 self.writeChunk(*c)
     def writeAll(self):
-        # implicitly writes all regions
+        """ Write every chunk in the cache. The chunks stay in the cache,
+            with write behind too (writeAll waits for them to be written).
+        """
+        if self._flusher is not None:
+            for c in self.chunkCache.values():
+                if self._needsWrite(c):
+                    self._flusher.put(c)
+            self.flush()
+            return
         for c in self.chunkCache.keys():
             self.writeChunk(*c)
+        if self.index is not None:
+            self.index.commit()
+    def flush(self):
+        """ Wait until every chunk handed to the background writer is on
+            disk. Errors from the writer thread are raised here.
+        """
+        if self._flusher is not None:
+            written = self._flusher.flush()
+            if self.index is not None:
+                for c, timestamp in written:
+                    self.index.updateChunk(c, timestamp)
+        if self.index is not None:
+            self.index.commit()
     def clearCache(self):
         """ Deletes all unwritten changes. """
-        for i in self.regionCache.keys():
-            self._dropRegion(*i)
+        if self._prefetcher is not None:
+            self._prefetcher.clear()
+        if self._flusher is not None:
+            self._flusher.discard()
+            self.flush()
+        for c in list(self.chunkCache.keys()):
+            self._dropChunk(*c)
+        self.lightDirty.clear()
+        self._blank.clear()
     def _getOldestChunk(self):
-        oldestTime = time.time()
-        oldest = None
-        for k, v in self.timestamps.items():
-            if v < oldestTime:
-                oldest = k
-        # there may not always be an oldest chunk... ie if everything happens
-        # REALLY fast
-        if oldest is None:
-            oldest = next(iter(self.timestamps.items()))[0]
-        return oldest
+        # if everything happens REALLY fast there may be ties, in which case
+        # the first chunk loaded wins
+        return min(self.timestamps, key=self.timestamps.get)
     def _dropChunk(self, x, z):
         """ Drop a chunk (does not write the chunk) """
+        self._blank.discard((x, z))
         del self.chunkCache[(x, z)]
         del self.timestamps[(x, z)]
         self.cachedChunks -= 1
-    def _dropRegion(self, x, z):
-        """ Drop a region and all chunks in it (does not write the chunks) """
-        # drop all the chunks in this region
-        chunks = self._getCachedInRegion(self, x, z)
-        for c in chunks:
-            self._dropChunk(*c)
-        # delete the region, close the file
-        r = self.regionCache[(x, z)]
-        r.file.close()
-        self.handles.remove(r.file)
-        del self.regionCache[(x, z)]
-        self.cachedRegions -= 1
-    def _getCachedInRegion(self, x, z):
+    def listRegions(self):
+        """ -> list of (x, z) of every region file in this world """
+        return listRegions(self.path)
+    def findBlocks(self, ids, processes=None):
+        """ -> list of (x, y, z, id) of every block in the world with an id
+            in ids. Unsaved changes are written first.
+            processes - see mapRegions
+        """
+        self.writeAll()
+        # other processes read the files, so nothing may be left buffered
+        self.pool.closeAll(self.path)
+        jobs = [(regionPath(self.path, *r), r, set(ids), None)
+                for r in self.listRegions()]
         out = []
-        for k, v in self.chunkCache.items():
-            if getRegionPos(*k) == (x, z):
-                out.append(k)
+        for found in mapRegions(_findInRegion, jobs, processes):
+            out.extend(found)
         return out
+    def replaceBlocks(self, mapping, processes=None):
+        """ Replace blocks throughout the whole world.
+            mapping - dict of old block id -> new Block
+            -> number of blocks replaced
+
+            Unsaved changes are written and the cache is cleared first, since
+            the region files are edited directly. Only chunks that contained
+            an old id are rewritten; they are marked as needing light, and
+            their rows in the index are updated.
+            processes - see mapRegions
+        """
+        self.writeAll()
+        self.clearCache()
+        self.pool.closeAll(self.path)
+        mapping = dict((k, (b.id, b.data & 0x0F)) for k, b in mapping.items())
+        jobs = [(regionPath(self.path, *r), r, set(mapping), mapping)
+                for r in self.listRegions()]
+        rewritten = []
+        for found in mapRegions(_findInRegion, jobs, processes):
+            rewritten.extend(found)
+        if self.index is not None:
+            # the chunks may have been rewritten within the second their
+            # rows were made in, which refresh could not tell apart
+            for x, z, timestamp, changes, replaced in rewritten:
+                self.index.updateCounts(x, z, timestamp, changes)
+            self.index.refresh()
+        return sum(r[4] for r in rewritten)
     def getRegionTimestamp(self, x, z):
         """ A region is as old as it's newest chunk! """
         # When in doubt assume it's '70
@@ -242,21 +669,328 @@ class MinecraftWorld:
             raise exc
     def __enter__(self):
         return self
+    def close(self):
+        self.closeAll()
     def closeAll(self):
-        for i in self.handles:
-                i.close()
+        """ Wait for the background writer, if any, and close every file.
+            Chunks still in the cache are not written, see writeAll.
+        """
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+        if self._flusher is not None:
+            try:
+                self.flush()
+            finally:
+                self._flusher.stop()
+                self._flusher = None
+        self.pool.closeAll(self.path)
+        if self.index is not None:
+            self.index.commit()
+    def stats(self):
+        """ -> snapshot of the I/O counters and timers, see util.Stats.
+            These are shared by everything in this process and are only
+            collected after mclevel.stats.enable()
+        """
+        return stats.snapshot()
     def __repr__(self):
         attrs = {
             'cachedChunks': self.cachedChunks,
-            'cachedRegions': self.cachedRegions,
-            'regions': self.regionCache.keys()
+            'openRegions': self.pool.listOpen(self.path)
         }
         return 'MinecraftWorld' + str(attrs)
 
+class RegionPool:
+    """ A bounded set of open region files, closing the least recently
+        used file when too many are open. One pool may be shared by several
+        worlds, such as the dimensions of a level.
+
+        Files are opened read only until something is written to them, and
+        are only created by the first write.
+    """
+    def __init__(self, maxOpen=32):
+        self.maxOpen = maxOpen
+        # absolute path -> (RegionHeader, writable), least recent first
+        self.open = OrderedDict()
+        self.lock = threading.RLock()
+    def get(self, path, x, z, write=False):
+        """ -> RegionHeader of the region file at path, or None if the file
+            does not exist (or is empty) and write is False
+        """
+        path = os.path.abspath(path)
+        with self.lock:
+            entry = self.open.get(path, None)
+            if entry is not None:
+                if entry[1] or not write:
+                    self.open.move_to_end(path)
+                    return entry[0]
+                # reopen for writing
+                self._close(path)
+            if write:
+                try:
+                    # don't truncate existing files
+                    f = open(path, mode='r+b')
+                except FileNotFoundError:
+                    f = open(path, mode='w+b')
+            else:
+                try:
+                    if os.path.getsize(path) == 0:
+                        return None
+                except FileNotFoundError:
+                    return None
+                f = open(path, mode='rb')
+            header = RegionHeader(x, z, f)
+            stats.count('regionOpens')
+            self.open[path] = (header, write)
+            while len(self.open) > self.maxOpen:
+                self._close(next(iter(self.open)))
+            return header
+    def listOpen(self, directory=None):
+        """ -> list of paths of the open files, optionally only those in
+            directory
+        """
+        with self.lock:
+            if directory is None:
+                return list(self.open)
+            directory = os.path.abspath(directory)
+            return [p for p in self.open if os.path.dirname(p) == directory]
+    def closeAll(self, directory=None):
+        """ Close every open file, or only those in directory """
+        with self.lock:
+            for path in self.listOpen(directory):
+                self._close(path)
+    def _close(self, path):
+        header, writable = self.open.pop(path)
+        header.file.close()
+        stats.count('regionCloses')
+
+class _Flusher:
+    """ Background thread which writes the chunks evicted by a world.
+
+        Chunks wait in pending (in the order they were added) until the
+        thread takes every pending chunk of one region, converts and
+        compresses them, and writes them in one batch. put blocks while
+        maxPending chunks are waiting, so a fast editor can not run out of
+        memory ahead of a slow disk.
+    """
+    def __init__(self, world, maxPending):
+        self.world = world
+        self.maxPending = maxPending
+        self.pending = {}
+        # chunks being written, (x, z) -> chunk
+        self.inFlight = {}
+        # (chunk, timestamp) for the world's index, which is not thread safe
+        self.written = []
+        self.error = None
+        self.stopped = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name='ChunkFlusher',
+                                       daemon=True)
+        self.thread.start()
+    def put(self, chunk):
+        """ Queue a chunk to be written, waiting if too many are queued """
+        with self.condition:
+            self._raiseError()
+            key = (chunk.x, chunk.z)
+            while (key not in self.pending and len(self.pending)
+                   + len(self.inFlight) >= self.maxPending):
+                stats.count('flushWaits')
+                self.condition.wait()
+                self._raiseError()
+            self.pending[key] = chunk
+            self.condition.notify_all()
+    def holds(self, x, z):
+        """ -> True if the chunk at x, z is waiting or being written """
+        with self.condition:
+            return (x, z) in self.pending or (x, z) in self.inFlight
+    def reclaim(self, x, z):
+        """ -> the chunk at x, z if it is still waiting to be written, or
+            None. A chunk which is being written is waited for instead, since
+            the thread is still reading it, and has to be loaded from disk.
+        """
+        with self.condition:
+            chunk = self.pending.pop((x, z), None)
+            if chunk is not None:
+                self.condition.notify_all()
+                return chunk
+            while (x, z) in self.inFlight and self.error is None:
+                self.condition.wait()
+            self._raiseError()
+            return None
+    def discard(self):
+        """ Forget every chunk which has not started to be written """
+        with self.condition:
+            self.pending.clear()
+            self.condition.notify_all()
+    def flush(self):
+        """ Wait for every queued chunk to be written.
+            -> [(chunk, timestamp)] written since the last flush
+        """
+        with self.condition:
+            while (self.pending or self.inFlight) and self.error is None:
+                self.condition.wait()
+            self._raiseError()
+            written, self.written = self.written, []
+            return written
+    def stop(self):
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join()
+    def _raiseError(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.stopped:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                region = getRegionPos(*next(iter(self.pending)))
+                batch = [(c, self.pending.pop(c)) for c in list(self.pending)
+                         if getRegionPos(*c) == region]
+                self.inFlight.update(batch)
+            try:
+                zipped = []
+                for c, chunk in batch:
+                    with stats.timer('chunkToNbt'):
+                        tag = chunkToNbt(chunk)
+                    zipped.append((chunk, compressChunk(tag)))
+                written = self.world._writeBatch(region, zipped)
+                stats.count('flushBatches')
+            except Exception as e:
+                written = []
+                with self.condition:
+                    self.error = e
+            with self.condition:
+                for c, chunk in batch:
+                    del self.inFlight[c]
+                self.written.extend(written)
+                self.condition.notify_all()
+
+class _Prefetcher:
+    """ Loads chunks on a thread pool ahead of getChunk.
+
+        Chunks come from hints (MinecraftWorld.prefetch) or from the pattern
+        of cache misses: two misses in a row the same step apart queue the
+        next readAhead chunks along that step. At most a cache's worth of
+        chunks are loaded but not yet taken at any time.
+    """
+    def __init__(self, world, workers, readAhead):
+        self.world = world
+        self.readAhead = readAhead
+        self.pool = ThreadPoolExecutor(workers,
+                                       thread_name_prefix='ChunkPrefetch')
+        # (x, z) -> future of a chunk (or None), in the order submitted
+        self.loading = {}
+        self.queue = deque()
+        self.lastMiss = None
+        self.step = None
+    def hint(self, coords):
+        self.queue.extend(coords)
+        self._submit()
+    def missed(self, x, z):
+        """ Note a cache miss, and look for a pattern """
+        if self.lastMiss is not None and self.readAhead > 0:
+            step = (x - self.lastMiss[0], z - self.lastMiss[1])
+            if (step == self.step and step != (0, 0)
+                    and max(abs(step[0]), abs(step[1])) <= 32):
+                # scans are usually region by region, so do not guess past
+                # the end of this one
+                region = getRegionPos(x, z)
+                ahead = [(x + step[0]*i, z + step[1]*i)
+                         for i in range(1, self.readAhead + 1)]
+                ahead = [c for c in ahead if getRegionPos(*c) == region]
+                # the pattern is more urgent than older hints
+                self.queue.extendleft(reversed(ahead))
+            self.step = step
+        self.lastMiss = (x, z)
+        self._submit()
+    def take(self, x, z):
+        """ -> the prefetched chunk at x, z or None """
+        future = self.loading.pop((x, z), None)
+        if future is None:
+            return None
+        try:
+            chunk = future.result()
+        except Exception:
+            # let getChunk load it again, and raise if it is really broken
+            return None
+        if chunk is not None:
+            stats.count('prefetchHits')
+        return chunk
+    def clear(self):
+        self.queue.clear()
+        for future in self.loading.values():
+            future.cancel()
+        for future in self.loading.values():
+            if not future.cancelled():
+                future.exception()
+        self.loading.clear()
+    def stop(self):
+        self.clear()
+        self.pool.shutdown(wait=True)
+    def _submit(self):
+        world = self.world
+        while self.queue and len(self.loading) < world.maxChunks:
+            c = self.queue.popleft()
+            if c in self.loading or c in world.chunkCache:
+                continue
+            self.loading[c] = self.pool.submit(world._prefetchChunk, *c)
+            stats.count('prefetchIssued')
+
+def _entityPositions(entities, tileEntities):
+    """ -> (list of (x, z) of entities, list of (x, z) of tile entities)
+        of a chunk, tileEntities being a dict keyed by x, y, z
+    """
+    positions = []
+    for e in entities:
+        try:
+            x, y, z = e['Pos'].value
+        except (KeyError, ValueError):
+            continue
+        positions.append((x, z))
+    return positions, [(x, z) for x, y, z in tileEntities]
+
+def _anyInBox(positions, xMin, zMin, xMax, zMax):
+    return any(xMin <= x < xMax and zMin <= z < zMax for x, z in positions)
+
+def _readEntityTags(data):
+    """ -> {'Entities': Tag, 'TileEntities': Tag} of uncompressed chunk NBT,
+        skipping everything else; missing tags are empty lists
+    """
+    level = nbt.readPartial(io.BytesIO(data), {'Level': {
+        'Entities': 'tag', 'TileEntities': 'tag'}}).get('Level', {})
+    for name in ('Entities', 'TileEntities'):
+        level.setdefault(name, nbt.Tag('TAG_List', name, [],
+                                       nbt.Tag.TAG_End))
+    return level
+
 def readChunk(x, z, regionHeader):
     """ Returns the NBT Tag describing a chunk at offset within the region file.
         If the chunk does not exist, returns None.
     """
+    data = readChunkBytes(x, z, regionHeader)
+    if data is None:
+        return None
+    reader = nbt.NbtReader(io.BytesIO(data))
+    with stats.timer('nbtParse'):
+        return reader.read()
+
+def readChunkBytes(x, z, regionHeader):
+    """ Returns the uncompressed NBT of a chunk, or None if it does not exist.
+    """
+    compressed = readCompressedChunk(x, z, regionHeader)
+    if compressed is None:
+        return None
+    return decompressChunk(*compressed)
+
+def readCompressedChunk(x, z, regionHeader):
+    """ -> (compression type, compressed NBT) of a chunk as it is stored, or
+        None if it does not exist.
+    """
     stream = regionHeader.file
     offset, size, timestamp = regionHeader.getChunkInfo(x, z)
     if offset is None:
@@ -268,29 +1002,52 @@ def readChunk(x, z, regionHeader):
     # (note that all the chunks are padded to be 4096 byte aligned)
     length = int.from_bytes(stream.read(4), 'big')
     compressionType = int.from_bytes(stream.read(1), 'big')
-    if compressionType == 2:
-        # zlib decompress the data
-        unzipped = io.BytesIO(zlib.decompress(stream.read(length - 1)))
-    else:
+    zipped = stream.read(length - 1)
+    stats.count('bytesRead', length + 4)
+    return compressionType, zipped
+
+def decompressChunk(compressionType, zipped):
+    with stats.timer('decompress'):
+        if compressionType == 2:
+            # zlib decompress the data
+            return zlib.decompress(zipped)
         # gzip decompress (this is UNTESTED and also not used by minecraft)
         print('Woah... just used gzip to decompress chunk data')
-        unzipped = io.BytesIO(gzip.decompress(stream.read(length - 1)))
+        return gzip.decompress(zipped)
+
+def regionToJson(regionHeader, outputDir):
+    """ Write every chunk in a region to outputDir as JSON, one chunk at a
+        time, named like chunk.x.z.nbt.json and chunk.x.z.tagtypes.json
+    """
+    for z in range(regionHeader.z*32, regionHeader.z*32 + 32):
+        for x in range(regionHeader.x*32, regionHeader.x*32 + 32):
+            data = readChunkBytes(x, z, regionHeader)
+            if data is None:
+                continue
+            name = os.path.join(outputDir, 'chunk.' + str(x) + '.' + str(z))
+            with open(name + '.tagtypes.json', mode='w') as typesFile, \
+                 open(name + '.nbt.json', mode='w') as valuesFile:
+                nbt.streamToJson(io.BytesIO(data), valuesFile, typesFile)
 
-    reader = nbt.NbtReader(unzipped)
-    return reader.read()
+def compressChunk(tag, safetyMax=None):
+    """ -> the zlib compressed NBT of a chunk, as it is stored in a region """
+    writer = nbt.NbtWriter(io.BytesIO(), safetyMax=safetyMax)
+    with stats.timer('nbtSerialise'):
+        writer.write(tag)
+    with stats.timer('compress'):
+        return zlib.compress(writer.file.getvalue())
 
 def writeChunk(tag, regionHeader, safetyMax=None):
-    regionFile = regionHeader.file
     x, z = tag['Level']['xPos'].value, tag['Level']['zPos'].value
+    writeCompressedChunk(x, z, compressChunk(tag, safetyMax), regionHeader)
+
+def writeCompressedChunk(x, z, zipped, regionHeader):
+    """ Write chunk data that has already been through compressChunk. """
+    regionFile = regionHeader.file
     offset, size, timestamp = regionHeader.getChunkInfo(x, z)
-    writer = nbt.NbtWriter(io.BytesIO(), safetyMax=safetyMax)
-    writer.write(tag)
-    writer.file.seek(0)
-    data = writer.file.read()
-    zipped = zlib.compress(data)
     newsize = math.ceil((len(zipped) + 4 + 1)/4096)
     if newsize != size:
-        print('writeChunk: Chunk resize occured')
+        stats.count('chunkResizes')
         regionHeader.resize(x, z, newsize)
     # re-obtain the offset in case it has changed
     offset, size, timestamp = regionHeader.getChunkInfo(x, z)
@@ -302,8 +1059,9 @@ def writeChunk(tag, regionHeader, safetyMax=None):
     regionFile.write(b'\x02')
     # write the chunk data!
     regionFile.write(zipped)
+    stats.count('bytesWritten', len(zipped) + 5)
     # pad to multiple of 4096 bytes
-    remaining = 4096 - (regionFile.tell() & 4095)
+    remaining = (4096 - (regionFile.tell() & 4095)) & 4095
     # both of these should be valid ways to compute the required padding
     assert remaining == 4096 * newsize - len(zipped) - 5
     regionFile.write(b'\x00'*remaining)
@@ -312,111 +1070,418 @@ def writeChunk(tag, regionHeader, safetyMax=None):
     # mark the current time on the chunk
     regionHeader.markUpdate(x, z)
 
+class RegionWriter:
+    """ Writes a brand new region file front to back.
+        Chunks are appended as they arrive and the header is only written
+        when the writer is closed, so chunks never have to be moved and
+        nothing but the header is kept in memory. Each chunk can only be
+        written once, as its old sectors could not be reused.
+
+        It is the caller's responsibility to manage the file.
+    """
+    def __init__(self, regionX, regionZ, stream):
+        self.file = stream
+        self.x = regionX
+        self.z = regionZ
+        self.locations = bytearray(4096)
+        self.timestamps = bytearray(4096)
+        # the first free sector, after the two header sectors
+        self.sector = 2
+        self.file.seek(0)
+        self.file.write(b'\x00'*4096*2)
+    def writeChunk(self, tag, safetyMax=None):
+        x, z = tag['Level']['xPos'].value, tag['Level']['zPos'].value
+        self.writeCompressedChunk(x, z, compressChunk(tag, safetyMax))
+    def writeCompressedChunk(self, x, z, zipped):
+        """ Append chunk data that has already been through compressChunk """
+        if getRegionPos(x, z) != (self.x, self.z):
+            raise ValueError('Chunk is not in region ('
+                           + str(self.x) + ', ' + str(self.z) + ')')
+        pos = 4 * ((x & 31) + (z & 31) * 32)
+        if self.locations[pos:pos + 4] != b'\x00'*4:
+            raise ValueError('Chunk (' + str(x) + ', ' + str(z)
+                             + ') has already been written')
+        size = math.ceil((len(zipped) + 4 + 1)/4096)
+        if size > 255:
+            raise ValueError('Chunk is too large for a region file')
+        self.file.seek(self.sector * 4096)
+        self.file.write((len(zipped) + 1).to_bytes(4, 'big', signed=False))
+        self.file.write(b'\x02')
+        self.file.write(zipped)
+        self.file.write(b'\x00'*(size*4096 - len(zipped) - 5))
+        stats.count('bytesWritten', len(zipped) + 5)
+        self.locations[pos:pos + 4] = (self.sector.to_bytes(3, 'big')
+                                       + size.to_bytes(1, 'big'))
+        self.timestamps[pos:pos + 4] = int(time.time()).to_bytes(4, 'big')
+        self.sector += size
+    def close(self):
+        """ Write the header; does not close the file. """
+        self.file.seek(0)
+        self.file.write(self.locations)
+        self.file.write(self.timestamps)
+    def __enter__(self):
+        return self
+    def __exit__(self, exctype, exc, trace):
+        self.close()
+
 def nbtToChunk(root):
-    """ Create a chunk from an NBT tag. """
-    chunkDict = root.pythonify()['Level']
+    """ Create a chunk from an NBT tag.
+        Both the numeric id (Blocks, Add, Data) and the block state palette
+        (Palette, BlockStates) layouts of sections are understood. Level tags
+        that are not modelled by Chunk are kept in chunk.extra.
+    """
+    level = root['Level'].value
+    chunkDict = root['Level'].pythonify()
     cx, cz = chunkDict['xPos'], chunkDict['zPos']
 
     # initialize the chunk object
     chunk = Chunk(cx, cz,
-                  terrainPopulated=chunkDict['TerrainPopulated'],
-                  inhabitedTime=chunkDict['InhabitedTime'],
-                  lightPopulated=chunkDict['LightPopulated'],
-                  lastUpdate=chunkDict['LastUpdate'])
-
-    for section in chunkDict['Sections']:
-        blocks = []
-        sectionY = section['Y']
-        # 8 bits per block
-        ids = section['Blocks']
-        # 4 bits per block
-        try:
-            add = section['Add']
-        except KeyError:
-            add = None
-        # 4 bits per block
-        data = section['Data']
-        index = 0
-        # blocks are stored YZX
-        for y in range(16):
-            for z in range(16):
-                for x in range(16):
-                    # bitwise and this with data/add to get the value
-                    halfbyte = 0xF0 if index & 1 else 0x0F
-                    id = ids[index]
-                    # the add tag extends the range of ids
-                    if add is not None:
-                        id += (add[index//2] & halfbyte) << 8
-                    blockData = data[index//2] & halfbyte
-                    block = Block(id, blockData)
-                    blocks.append(block)
-                    index += 1
-        chunk.addSection(sectionY, blocks)
+                  terrainPopulated=chunkDict.get('TerrainPopulated', 1),
+                  inhabitedTime=chunkDict.get('InhabitedTime', 0),
+                  lightPopulated=chunkDict.get('LightPopulated', 0),
+                  lastUpdate=chunkDict.get('LastUpdate', 0))
+    if 'DataVersion' in root.value:
+        chunk.dataVersion = root['DataVersion'].value
+    chunk.extra = dict((k, v) for k, v in level.items()
+                       if k not in _CHUNK_TAGS)
+    if 'Entities' in level:
+        chunk.entities = list(level['Entities'].value)
+    for tileEntity in level.get('TileEntities', nbt.Tag(0, '', [])).value:
+        chunk.addTileEntity(tileEntity)
+    if 'Biomes' in level:
+        if level['Biomes'].id == nbt.Tag.TAG_Int_Array:
+            chunk.biomes = list(chunkDict['Biomes'])
+        else:
+            chunk.biomes = list(_toUnsigned(chunkDict['Biomes']))
 
+    spanning = chunk.dataVersion < SPANNING_VERSION
+    for section in chunkDict.get('Sections', []):
+        # 4 bits per block, chunks that have not been lit may not have light
+        skyLight = section.get('SkyLight', None)
+        skyLight = skyLight and _unpackNibbles(skyLight)
+        blockLight = section.get('BlockLight', None)
+        blockLight = blockLight and _unpackNibbles(blockLight)
+        if 'Blocks' in section:
+            # 8 bits per block
+            ids = _toUnsigned(section['Blocks'])
+            # 4 bits per block, the add tag extends the range of ids
+            try:
+                add = _unpackNibbles(section['Add'])
+            except KeyError:
+                add = None
+            # 4 bits per block
+            data = _unpackNibbles(section['Data'])
+            chunk.addSection(section['Y'], Section(
+                _joinIds(ids, add), data,
+                skyLight=skyLight, blockLight=blockLight))
+        elif 'Palette' in section:
+            palette = section['Palette']
+            ids = unpackBlockStates(section['BlockStates'],
+                                    blockStateBits(len(palette)),
+                                    spanning=spanning)
+            chunk.addSection(section['Y'], Section(
+                ids, skyLight=skyLight, blockLight=blockLight,
+                palette=palette))
+        elif chunk.dataVersion >= FLATTENING_VERSION:
+            # an empty section which only holds light
+            chunk.addSection(section['Y'], Section(
+                skyLight=skyLight, blockLight=blockLight,
+                palette=[{'Name': 'minecraft:air'}]))
+
+    # the stored HeightMap is not used: the game keeps the y above the top
+    # light blocking block, not the y of the top block, so getHeightmap
+    # scans the chunk once instead
     return chunk
 
+# Level tags that nbtToChunk turns into Chunk attributes
+_CHUNK_TAGS = frozenset(('xPos', 'zPos', 'LastUpdate', 'LightPopulated',
+                         'TerrainPopulated', 'V', 'InhabitedTime',
+                         'HeightMap', 'Sections', 'Biomes', 'Entities',
+                         'TileEntities'))
+
 def chunkToNbt(chunk):
+    modern = chunk.dataVersion >= FLATTENING_VERSION
     root = nbt.Tag('TAG_Compound', '', [
-        nbt.Tag("TAG_Int", "DataVersion", 169),
+        nbt.Tag("TAG_Int", "DataVersion", chunk.dataVersion),
         nbt.Tag("TAG_Compound", "Level", [
             nbt.Tag("TAG_Int", "xPos", chunk.x),
             nbt.Tag("TAG_Int", "zPos", chunk.z),
             nbt.Tag("TAG_Long", "LastUpdate", chunk.lastUpdate),
-            nbt.Tag("TAG_Byte", "LightPopulated", chunk.lightPopulated),
-            nbt.Tag("TAG_Byte", "TerrainPopulated", chunk.terrainPopulated),
-            nbt.Tag("TAG_Byte", "V", 1),
             nbt.Tag("TAG_Long", "InhabitedTime", chunk.inhabitedTime),
-            nbt.Tag("TAG_Int_Array", "HeightMap", chunk.genHeightmap()),
             nbt.Tag("TAG_List", "Sections", [], nbt.Tag.TAG_Compound),
-            nbt.Tag("TAG_List", "Entities", [], nbt.Tag.TAG_End),
-            nbt.Tag("TAG_List", "TileEntities", [], nbt.Tag.TAG_End)
+            nbt.Tag("TAG_List", "Entities", list(chunk.entities),
+                    nbt.Tag.TAG_Compound if chunk.entities
+                    else nbt.Tag.TAG_End),
+            nbt.Tag("TAG_List", "TileEntities",
+                    list(chunk.tileEntities.values()),
+                    nbt.Tag.TAG_Compound if chunk.tileEntities
+                    else nbt.Tag.TAG_End)
         ])
     ])
+    level = root['Level'].value
+    if not modern:
+        # the game keeps these in other tags since the flattening
+        level['LightPopulated'] = nbt.Tag("TAG_Byte", "LightPopulated",
+                                          chunk.lightPopulated)
+        level['TerrainPopulated'] = nbt.Tag("TAG_Byte", "TerrainPopulated",
+                                            chunk.terrainPopulated)
+        level['V'] = nbt.Tag("TAG_Byte", "V", 1)
+        level['HeightMap'] = nbt.Tag("TAG_Int_Array", "HeightMap",
+                                     chunk.getHeightmap())
+    level.update(chunk.extra)
     # Things that may or may not exist:
     # Biomes, TileTicks
-    if chunk.biomes is not None:
-        print('Writing biomes...')
-        print(chunk.biomes)
-        root.value["Biomes"] = nbt.Tag("TAG_Byte_Array", "Biomes", chunk.biomes)
+    if chunk.biomes is not None and modern:
+        level["Biomes"] = nbt.Tag("TAG_Int_Array", "Biomes",
+                                  list(chunk.biomes))
+    elif chunk.biomes is not None:
+        level["Biomes"] = nbt.Tag(
+            "TAG_Byte_Array", "Biomes",
+            _toSigned(bytes(b & 0xFF for b in chunk.biomes)))
 
     sects = len(chunk.sections.keys())
     if sects == 0:
         root['Level']['Sections'].listType = nbt.Tag.TAG_End
     else:
+        spanning = chunk.dataVersion < SPANNING_VERSION
         for k, v in chunk.sections.items():
-            root['Level']['Sections'].value.append(_sectionToNbt(k, v))
+            root['Level']['Sections'].value.append(
+                _sectionToNbt(k, v, spanning))
 
     return root
 
-def _sectionToNbt(y, section):
+def _sectionToNbt(y, section, spanning=False):
     # the root is the payload of a compound tag, which is a dict
+    if section.palette is not None:
+        return _palettedSectionToNbt(y, section, spanning)
+    blocks, add = _splitIds(section.ids)
     root = dict((i.name, i) for i in [
         nbt.Tag("TAG_Byte", "Y", y),
-        nbt.Tag("TAG_Byte_Array", "Blocks", []),
-        nbt.Tag("TAG_Byte_Array", "Add", [0 for i in range(2048)]),
-        nbt.Tag("TAG_Byte_Array", "Data", [0 for i in range(2048)]),
-        nbt.Tag("TAG_Byte_Array", "SkyLight", [0 for i in range(2048)]),
-        nbt.Tag("TAG_Byte_Array", "BlockLight", [0 for i in range(2048)])
+        nbt.Tag("TAG_Byte_Array", "Blocks", _toSigned(blocks)),
+        nbt.Tag("TAG_Byte_Array", "Add", _toSigned(_packNibbles(add))),
+        nbt.Tag("TAG_Byte_Array", "Data", _toSigned(_packNibbles(section.data))),
+        nbt.Tag("TAG_Byte_Array", "SkyLight",
+                _toSigned(_packNibbles(section.skyLight))),
+        nbt.Tag("TAG_Byte_Array", "BlockLight",
+                _toSigned(_packNibbles(section.blockLight)))
     ])
-    blocks = root["Blocks"].value
-    add = root["Add"].value
-    data = root["Data"].value
-    index = 0
-    for y in range(16):
-        for z in range(16):
-            for x in range(16):
-                # even blocks use the second half of the halfbytes
-                halfbyteShift = 4 if index & 1 else 0
-                b = section[index]
-                blocks.append(b.id & 0xFF)
-                add[index//2] = add[index//2] & ((b.id >> 8) << halfbyteShift)
-                data[index//2] = data[index//2] & ((b.data & 0x0F) << halfbyteShift)
-                index += 1
-    if sum(add) == 0:
+    if not any(add):
         del root['Add']
 
     return root
 
+def _palettedSectionToNbt(y, section, spanning):
+    palette = []
+    for state in section.palette:
+        entry = [nbt.Tag("TAG_String", "Name", state['Name'])]
+        if 'Properties' in state:
+            entry.append(nbt.Tag("TAG_Compound", "Properties", [
+                nbt.Tag("TAG_String", k, v)
+                for k, v in state['Properties'].items()]))
+        palette.append(dict((i.name, i) for i in entry))
+    bits = blockStateBits(len(palette))
+    return dict((i.name, i) for i in [
+        nbt.Tag("TAG_Byte", "Y", y),
+        nbt.Tag("TAG_List", "Palette", palette, nbt.Tag.TAG_Compound),
+        nbt.Tag("TAG_Long_Array", "BlockStates",
+                packBlockStates(section.ids, bits, spanning)),
+        nbt.Tag("TAG_Byte_Array", "SkyLight",
+                _toSigned(_packNibbles(section.skyLight))),
+        nbt.Tag("TAG_Byte_Array", "BlockLight",
+                _toSigned(_packNibbles(section.blockLight)))
+    ])
+
+# Section arrays are converted with bytes.translate and big int arithmetic
+# rather than python loops; these tables do the per-byte work.
+_LOW_NIBBLE = bytes(i & 0x0F for i in range(256))
+_HIGH_NIBBLE = bytes(i >> 4 for i in range(256))
+_SHIFT_NIBBLE = bytes((i << 4) & 0xF0 for i in range(256))
+_AIR_LAYER = array('H', bytes(512))
+
+def _toUnsigned(byteArray):
+    """ TAG_Byte_Array value (list of signed ints) -> bytes """
+    return array('b', byteArray).tobytes()
+
+def _toSigned(raw):
+    """ bytes -> TAG_Byte_Array value (list of signed ints) """
+    return array('b', bytes(raw)).tolist()
+
+def _unpackNibbles(packed):
+    """ 2048 packed halfbytes -> bytearray of 4096 values, one per block.
+        Even blocks use the low halfbyte, odd blocks use the high halfbyte.
+    """
+    raw = _toUnsigned(packed)
+    out = bytearray(len(raw) * 2)
+    out[0::2] = raw.translate(_LOW_NIBBLE)
+    out[1::2] = raw.translate(_HIGH_NIBBLE)
+    return out
+
+def _packNibbles(values):
+    """ The inverse of _unpackNibbles, -> bytes of len(values)//2 """
+    low = bytes(values[0::2]).translate(_LOW_NIBBLE)
+    high = bytes(values[1::2]).translate(_SHIFT_NIBBLE)
+    packed = int.from_bytes(low, 'big') | int.from_bytes(high, 'big')
+    return packed.to_bytes(len(low), 'big')
+
+def _joinIds(blocks, add=None):
+    """ Blocks (bytes) and unpacked Add (bytearray) -> array('H') of ids """
+    raw = bytearray(len(blocks) * 2)
+    low, high = (0, 1) if sys.byteorder == 'little' else (1, 0)
+    raw[low::2] = blocks
+    if add is not None:
+        raw[high::2] = add
+    ids = array('H')
+    ids.frombytes(raw)
+    return ids
+
+def _splitIds(ids):
+    """ array('H') of ids -> (Blocks bytes, unpacked Add bytes) """
+    raw = ids.tobytes()
+    low, high = (0, 1) if sys.byteorder == 'little' else (1, 0)
+    return raw[low::2], raw[high::2].translate(_LOW_NIBBLE)
+
+# DataVersion of the first chunks with block state palettes (1.13) and of
+# the first chunks where BlockStates entries no longer span two longs (1.16)
+FLATTENING_VERSION = 1451
+SPANNING_VERSION = 2529
+
+def blockStateBits(paletteSize):
+    """ -> bits per entry of BlockStates for a palette of paletteSize """
+    return max(4, (paletteSize - 1).bit_length())
+
+def unpackBlockStates(states, bits, count=4096, spanning=False):
+    """ BlockStates (list of signed longs) -> array('H') of count palette
+        indices.
+        spanning - entries may be split across two longs, as they were
+        before 1.16. Otherwise each long holds 64//bits entries and the
+        remaining high bits are unused.
+    """
+    raw = array('q', states)
+    if sys.byteorder == 'big':
+        raw.byteswap()
+    raw = raw.tobytes()
+    if bits == 4:
+        # one entry per halfbyte, low halfbyte first
+        ids = _joinIds(_unpackNibbles(raw))
+    elif bits == 8:
+        ids = _joinIds(raw)
+    elif spanning:
+        # every group of bits bytes holds exactly 8 entries
+        groups = [int.from_bytes(raw[i:i + bits], 'little')
+                  for i in range(0, len(raw), bits)]
+        ids = _splitFields(groups, 8, bits)
+    else:
+        words = array('Q')
+        words.frombytes(raw)
+        if sys.byteorder == 'big':
+            words.byteswap()
+        ids = _splitFields(words, 64 // bits, bits)
+    del ids[count:]
+    return ids
+
+def packBlockStates(ids, bits, spanning=False):
+    """ The inverse of unpackBlockStates, -> list of signed longs """
+    if len(ids) and max(ids) >= 1 << bits:
+        raise ValueError('Palette index ' + str(max(ids))
+                         + ' does not fit in ' + str(bits) + ' bits')
+    if bits == 4:
+        raw = _packNibbles(_splitIds(ids)[0])
+    elif bits == 8:
+        raw = _splitIds(ids)[0]
+    elif spanning:
+        groups = _joinFields(ids, 8, bits)
+        raw = b''.join(g.to_bytes(bits, 'little') for g in groups)
+    else:
+        words = array('Q', _joinFields(ids, 64 // bits, bits))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        raw = words.tobytes()
+    # pad to a whole number of longs
+    raw = bytes(raw) + bytes(-len(raw) & 7)
+    states = array('q')
+    states.frombytes(raw)
+    if sys.byteorder == 'big':
+        states.byteswap()
+    return states.tolist()
+
+def _splitFields(words, per, bits):
+    """ ints holding per fields of bits each, lowest first -> array('H') of
+        the fields. Works a field position at a time over every word.
+    """
+    mask = (1 << bits) - 1
+    ids = array('H', bytes(len(words) * per * 2))
+    for j in range(per):
+        shift = j * bits
+        ids[j::per] = array('H', [(w >> shift) & mask for w in words])
+    return ids
+
+def _joinFields(ids, per, bits):
+    """ The inverse of _splitFields, -> list of ints """
+    words = [0] * ((len(ids) + per - 1) // per)
+    for j in range(per):
+        shift = j * bits
+        column = ids[j::per]
+        words[:len(column)] = [w | (i << shift)
+                               for w, i in zip(words, column)]
+    return words
+
+class Section:
+    """ A 16x16x16 cube of blocks, stored as flat YZX ordered arrays.
+        ids - array('H') of block ids, or of indices into palette
+        data - bytearray of block data values
+        skyLight, blockLight - bytearrays of light levels
+        palette - list of block states ({'Name': ..., 'Properties': {...}})
+        for sections saved since 1.13, otherwise None. Such sections have no
+        block ids: blocks are set by state, and lighting and find/replace
+        do not apply to them.
+    """
+    def __init__(self, ids=None, data=None, skyLight=None, blockLight=None,
+                 palette=None):
+        self.ids = ids if ids is not None else array('H', bytes(8192))
+        self.data = data if data is not None else bytearray(4096)
+        self.skyLight = skyLight if skyLight is not None else bytearray(4096)
+        self.blockLight = (blockLight if blockLight is not None
+                           else bytearray(4096))
+        self.palette = palette
+    @classmethod
+    def fromBlocks(cls, blocks):
+        """ Create a section from a list of 4096 Blocks ordered YZX """
+        return cls(array('H', [b.id for b in blocks]),
+                   bytearray(b.data & 0x0F for b in blocks))
+    def getState(self, index):
+        """ -> the block state at index of a section with a palette """
+        return self.palette[self.ids[index]]
+    def stateIndex(self, state):
+        """ -> index of a block state in the palette, added if it is new """
+        try:
+            return self.palette.index(state)
+        except ValueError:
+            self.palette.append(state)
+            return len(self.palette) - 1
+    def solidIds(self):
+        """ -> the ids with air as 0; for a section with a palette every
+            state other than air is 1
+        """
+        if self.palette is None:
+            return self.ids
+        table = [0 if state.get('Name') in AIR_STATES else 1
+                 for state in self.palette]
+        return array('H', map(table.__getitem__, self.ids))
+    def isSolid(self, index):
+        """ -> True if the block at index is not air """
+        if self.palette is None:
+            return self.ids[index] != 0
+        return self.palette[self.ids[index]].get('Name') not in AIR_STATES
+
+# block states which count as air in sections with a palette
+AIR_STATES = frozenset(('minecraft:air', 'minecraft:cave_air',
+                        'minecraft:void_air'))
+
+# the attributes of a Chunk that are saved, see Chunk.isBlank
+_CHUNK_STATE = ('sections', 'biomes', 'entities', 'tileEntities', 'extra',
+                'inhabitedTime', 'terrainPopulated', 'lightPopulated',
+                'lastUpdate', 'dataVersion')
+
 class Chunk:
     def __init__(self, xPos, zPos, **kw):
         """ Create an empty chunk. """
@@ -431,31 +1496,89 @@ class Chunk:
         self.terrainPopulated = kw.get('terrainPopulated', 1)
         self.lightPopulated = kw.get('lightPopulated', 0)
         self.lastUpdate = kw.get('lastUpdate', 0)
-    def addSection(self, sectionY, blocks):
-        # blocks are ordered YZX
-        self.sections[sectionY] = blocks
+        self.dataVersion = kw.get('dataVersion', 169)
+        # compounds (dicts of name -> Tag) as they are stored in the NBT;
+        # tile entities are kept by their x, y, z (world block coordinates)
+        self.entities = []
+        self.tileEntities = {}
+        # Level tags which are written back as they were read
+        self.extra = {}
+    def addSection(self, sectionY, section):
+        if not isinstance(section, Section):
+            # blocks are ordered YZX
+            section = Section.fromBlocks(section)
+        self.sections[sectionY] = section
         self.topSection = max(self.topSection, sectionY)
+        # the heightmap may be invalid now
+        self.heightmap = None
     def getBlock(self, x, y, z):
         if x > 15 or x < 0 or y > 255 or y < 0 or z > 15 or z < 0:
             raise ValueError('getBlock takes local chunk block coordinates')
         # blocks are ordered YZX
         try:
-            return self.sections[y//16][(y & 15)*256 + z*16 + x]
+            section = self.sections[y//16]
         except KeyError:
             # the section does not exist
             return None
+        index = (y & 15)*256 + z*16 + x
+        if section.palette is not None:
+            return Block(None, 0, section.getState(index))
+        return Block(section.ids[index], section.data[index])
     def setBlock(self, x, y, z, b):
+        """ Set a block; in a section with a palette the block must have a
+            state, which is added to the palette if needed
+        """
         index = (y & 15)*256 + z*16 + x
         section = self.sections.get(y//16, None)
         if section is None:
-            self._initializeSection(y//16)
-        self.sections[y//16][index] = b
+            section = self._initializeSection(y//16)
+        if section.palette is not None:
+            if b.state is None:
+                raise ValueError('Blocks in sections with a palette need a '
+                                 'state, not an id')
+            section.ids[index] = section.stateIndex(b.state)
+        else:
+            section.ids[index] = b.id
+            section.data[index] = b.data & 0x0F
+        if self.heightmap is not None:
+            self._updateHeightmap(x, y, z, section.isSolid(index))
+    def addTileEntity(self, tileEntity):
+        """ Add or replace the tile entity at its x, y, z """
+        key = (tileEntity['x'].value, tileEntity['y'].value,
+               tileEntity['z'].value)
+        self.tileEntities[key] = tileEntity
+    def getTileEntity(self, x, y, z):
+        """ -> tile entity at world block coordinates x, y, z or None """
+        return self.tileEntities.get((x, y, z), None)
+    def removeTileEntity(self, x, y, z):
+        return self.tileEntities.pop((x, y, z), None)
+    def tileEntitiesInBox(self, xMin, yMin, zMin, xMax, yMax, zMax):
+        return [t for (x, y, z), t in self.tileEntities.items()
+                if xMin <= x < xMax and yMin <= y < yMax and zMin <= z < zMax]
+    def entitiesInBox(self, xMin, yMin, zMin, xMax, yMax, zMax):
+        out = []
+        for e in self.entities:
+            try:
+                x, y, z = e['Pos'].value
+            except (KeyError, ValueError):
+                continue
+            if xMin <= x < xMax and yMin <= y < yMax and zMin <= z < zMax:
+                out.append(e)
+        return out
+    def isBlank(self):
+        """ -> True if the chunk is still as Chunk(x, z) made it """
+        blank = Chunk(self.x, self.z)
+        return all(getattr(self, k) == getattr(blank, k)
+                   for k in _CHUNK_STATE)
     def _initializeSection(self, y):
-        arr = []
-        for i in range(4096):
-            arr.append(Block(0, 0))
-        self.sections[y] = arr
+        if self.dataVersion >= FLATTENING_VERSION:
+            # every section of a chunk has to use the same format
+            section = Section(palette=[{'Name': 'minecraft:air'}])
+        else:
+            section = Section()
+        self.sections[y] = section
         self.topSection = max(self.topSection, y)
+        return section
     def getAsciiYCrossSection(self, y):
         """ A marginally useful debugging/novelty method. :)"""
         out = []
@@ -467,16 +1590,52 @@ class Chunk:
                 out[z].append(b)
             out[z] = ' | '.join(out[z])
         return '\n'.join(out)
+    def getHeightmap(self):
+        """ -> the heightmap, only generating it if it is not up to date """
+        if self.heightmap is None:
+            return self.genHeightmap()
+        return self.heightmap
     def genHeightmap(self):
+        """ Find the highest non air block of every column.
+            Works a whole 16x16 layer at a time from the top section down,
+            stopping as soon as every column has been found.
+        """
         self.heightmap = [0 for i in range(256)]
-        for z in range(16):
-            for x in range(16):
-                for y in range(255, -1, -1):
-                    b = self.getBlock(x, y, z)
-                    if b is not None and b.id != 0:
-                        self.heightmap[z*16 + x] = y
-                        break
+        remaining = set(range(256))
+        for sectionY in sorted(self.sections, reverse=True):
+            ids = self.sections[sectionY].solidIds()
+            for y in range(15, -1, -1):
+                layer = ids[y*256:(y + 1)*256]
+                if layer == _AIR_LAYER:
+                    continue
+                found = [i for i in remaining if layer[i] != 0]
+                for i in found:
+                    self.heightmap[i] = sectionY*16 + y
+                remaining.difference_update(found)
+                if not remaining:
+                    return self.heightmap
         return self.heightmap
+    def _updateHeightmap(self, x, y, z, solid):
+        """ Keep the heightmap valid after a single block changed. """
+        column = z*16 + x
+        if solid:
+            if y > self.heightmap[column]:
+                self.heightmap[column] = y
+        elif y == self.heightmap[column]:
+            # the top block was removed, look for the next one down
+            self.heightmap[column] = self._columnHeight(x, y - 1, z)
+    def _columnHeight(self, x, y, z):
+        """ -> y of the highest non air block at or below y in column x, z """
+        while y >= 0:
+            section = self.sections.get(y//16, None)
+            if section is None:
+                # skip straight to the top of the next section down
+                y = (y//16)*16 - 1
+                continue
+            if section.isSolid((y & 15)*256 + z*16 + x):
+                return y
+            y -= 1
+        return 0
     def fillBiome(self, biomeId):
         self.biomes = [biomeId for i in range(256)]
     def setBiome(self, x, z, biomeId, defaultBiome=-1):
@@ -484,10 +1643,196 @@ class Chunk:
             self.fillBiome(defaultBiome)
         self.biomes[z*16 + x] = biomeId
 
+# Light levels removed by light passing through a block, indexed by block id.
+# Any id that is not listed is treated as a fully opaque block.
+LIGHT_OPACITY = bytearray(b'\x0f' * 4096)
+for _id in (0, 6, 20, 26, 27, 28, 31, 32, 37, 38, 39, 40, 50, 51, 55, 59,
+            63, 64, 65, 66, 68, 69, 70, 71, 72, 75, 76, 77, 83, 85, 90, 92,
+            95, 96, 101, 102, 104, 105, 106, 107, 111, 113, 115, 131, 132,
+            140, 141, 142, 143, 147, 148, 157, 160, 166, 171, 175, 176, 177,
+            183, 184, 185, 186, 187, 188, 189, 190, 191, 192, 193, 194, 195,
+            196, 197, 198, 199, 200):
+    LIGHT_OPACITY[_id] = 0
+for _id in (18, 30, 161):
+    LIGHT_OPACITY[_id] = 1
+for _id in (8, 9, 79, 212):
+    LIGHT_OPACITY[_id] = 3
+
+# Light level emitted by a block, indexed by block id.
+LIGHT_EMISSION = bytearray(4096)
+for _id, _level in ((10, 15), (11, 15), (39, 1), (50, 14), (51, 15),
+                    (62, 13), (74, 9), (76, 7), (89, 15), (90, 11),
+                    (91, 15), (117, 1), (119, 15), (120, 1), (122, 1),
+                    (124, 15), (138, 15), (169, 15), (198, 14), (213, 3)):
+    LIGHT_EMISSION[_id] = _level
+
+def lightChunks(chunks, getNeighbour=None):
+    """ Recompute the sky light and block light of a group of chunks.
+        chunks - dict of (chunkX, chunkZ) -> Chunk, light may spread freely
+        between these chunks
+        getNeighbour - optional function (chunkX, chunkZ) -> Chunk or None;
+        light already stored in neighbouring chunks outside of the group
+        spreads into the group, but the neighbours themselves are not changed
+
+        Light is flood filled breadth first from the sources, block by block,
+        over the section arrays. Light does not enter missing sections.
+        The light tables are by block id, so chunks with palette sections
+        raise ValueError.
+    """
+    # (chunkX, sectionY, chunkZ) -> Section for everything we may write to
+    sections = {}
+    for (cx, cz), chunk in chunks.items():
+        for sy, section in chunk.sections.items():
+            if section.palette is not None:
+                raise ValueError('Light can not be computed for chunk '
+                                 + str((cx, cz)) + ', it has block states '
+                                 'rather than block ids')
+            sections[(cx, sy, cz)] = section
+    # direct sky light first, since it decides where the fill has to start
+    tops = {}
+    skyQueue = deque()
+    for chunk in chunks.values():
+        _skyColumns(chunk, tops, skyQueue)
+    for (cx, cz), chunk in chunks.items():
+        _skySeeds(chunk, tops, skyQueue)
+    blockQueue = deque()
+    emitters = set(i for i in range(len(LIGHT_EMISSION)) if LIGHT_EMISSION[i])
+    for (cx, cz), chunk in chunks.items():
+        _blockSeeds(chunk, emitters, blockQueue)
+    if getNeighbour is not None:
+        _neighbourSeeds(chunks, getNeighbour, skyQueue, blockQueue)
+    _propagate(skyQueue, dict((k, (s.ids, s.skyLight))
+                              for k, s in sections.items()))
+    _propagate(blockQueue, dict((k, (s.ids, s.blockLight))
+                                for k, s in sections.items()))
+    for chunk in chunks.values():
+        chunk.lightPopulated = 1
+
+def _skyColumns(chunk, tops, queue):
+    """ Light every column straight down from the sky, a layer at a time.
+        Records the lowest y of full sky light per column in tops, and queues
+        any blocks that were only partially lit (i.e. under water or leaves).
+    """
+    light = bytearray(b'\x0f' * 256)
+    # columns that still see the sky
+    clear = set(range(256))
+    top = [0 for i in range(256)]
+    wx, wz = chunk.x * 16, chunk.z * 16
+    for sectionY in sorted(chunk.sections, reverse=True):
+        section = chunk.sections[sectionY]
+        section.skyLight = bytearray(4096)
+        if not any(light):
+            # everything below here is in the dark
+            continue
+        ids = section.ids
+        for y in range(15, -1, -1):
+            base = y * 256
+            layer = ids[base:base + 256]
+            if layer != _AIR_LAYER:
+                opacity = bytes(map(LIGHT_OPACITY.__getitem__, layer))
+                for i in [i for i in range(256) if opacity[i] and light[i]]:
+                    level = light[i] - opacity[i]
+                    light[i] = level if level > 0 else 0
+                    if i in clear:
+                        clear.remove(i)
+                        top[i] = sectionY*16 + y + 1
+                    if level > 1:
+                        queue.append((wx + (i & 15), sectionY*16 + y,
+                                      wz + (i >> 4), level))
+            section.skyLight[base:base + 256] = light
+    for i in range(256):
+        tops[(wx + (i & 15), wz + (i >> 4))] = top[i]
+
+def _skySeeds(chunk, tops, queue):
+    """ Queue the fully sky lit blocks that sit next to a darker column. """
+    wx, wz = chunk.x * 16, chunk.z * 16
+    for z in range(wz, wz + 16):
+        for x in range(wx, wx + 16):
+            top = tops[(x, z)]
+            highest = max(tops.get((x - 1, z), 0), tops.get((x + 1, z), 0),
+                          tops.get((x, z - 1), 0), tops.get((x, z + 1), 0))
+            for y in range(top, highest):
+                if (y >> 4) in chunk.sections:
+                    queue.append((x, y, z, 15))
+
+def _blockSeeds(chunk, emitters, queue):
+    """ Reset block light and queue every light emitting block. """
+    wx, wz = chunk.x * 16, chunk.z * 16
+    for sectionY, section in chunk.sections.items():
+        section.blockLight = bytearray(4096)
+        if emitters.isdisjoint(section.ids):
+            continue
+        for index, id in enumerate(section.ids):
+            level = LIGHT_EMISSION[id]
+            if level:
+                section.blockLight[index] = level
+                queue.append((wx + (index & 15), sectionY*16 + (index >> 8),
+                              wz + ((index >> 4) & 15), level))
+
+def _neighbourSeeds(chunks, getNeighbour, skyQueue, blockQueue):
+    """ Queue the border blocks of chunks just outside of the group. """
+    for cx, cz in chunks:
+        for dx, dz in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            if (cx + dx, cz + dz) in chunks:
+                continue
+            neighbour = getNeighbour(cx + dx, cz + dz)
+            if neighbour is None:
+                continue
+            # the face of the neighbour which touches this chunk
+            if dx != 0:
+                x = 15 if dx < 0 else 0
+                face = [z*16 + x for z in range(16)]
+            else:
+                z = 15 if dz < 0 else 0
+                face = [z*16 + x for x in range(16)]
+            wx, wz = neighbour.x * 16, neighbour.z * 16
+            for sectionY, section in neighbour.sections.items():
+                for y in range(16):
+                    for i in face:
+                        index = y*256 + i
+                        pos = (wx + (i & 15), sectionY*16 + y, wz + (i >> 4))
+                        if section.skyLight[index] > 1:
+                            skyQueue.append(pos + (section.skyLight[index],))
+                        if section.blockLight[index] > 1:
+                            blockQueue.append(
+                                pos + (section.blockLight[index],))
+
+def _propagate(queue, arrays):
+    """ Breadth first flood fill of light.
+        queue - deque of (x, y, z, light level) in world block coordinates
+        arrays - dict of (chunkX, sectionY, chunkZ) -> (ids, light array)
+    """
+    opacity = LIGHT_OPACITY
+    get = arrays.get
+    pop = queue.popleft
+    push = queue.append
+    while queue:
+        x, y, z, level = pop()
+        for nx, ny, nz in ((x - 1, y, z), (x + 1, y, z), (x, y - 1, z),
+                           (x, y + 1, z), (x, y, z - 1), (x, y, z + 1)):
+            if ny < 0 or ny > 255:
+                continue
+            arrs = get((nx >> 4, ny >> 4, nz >> 4))
+            if arrs is None:
+                continue
+            ids, light = arrs
+            index = (ny & 15)*256 + (nz & 15)*16 + (nx & 15)
+            cost = opacity[ids[index]]
+            newLevel = level - (cost if cost > 1 else 1)
+            if newLevel > light[index]:
+                light[index] = newLevel
+                if newLevel > 1:
+                    push((nx, ny, nz, newLevel))
+
 class Block:
-    def __init__(self, id, data):
+    """ A block by numeric id and data, or by block state (a palette entry
+        like {'Name': 'minecraft:stone'}) for sections with a palette.
+        Blocks read from a palette section have an id of None.
+    """
+    def __init__(self, id, data, state=None):
         self.id = id
         self.data = data
+        self.state = state
 
 class RegionHeader:
     """ Wraps a .mca Anvil world file.
@@ -499,6 +1844,7 @@ class RegionHeader:
     """
     def __init__(self, regionX, regionZ, stream):
         self.file = stream
+        self.file.seek(0)
         if self.file.read(1) == b'':
             # write the two initial sectors if the file is empty
             self.file.seek(0)
@@ -530,6 +1876,17 @@ class RegionHeader:
     def _toChunkId(self, x, z):
         return x + z * 32
     @_retainFilePos(fileAttr='file')
+    def getLocations(self):
+        """ -> list of (offset, size) for all 1024 chunks, ordered x + z*32 """
+        self.file.seek(0)
+        raw = struct.unpack('>1024I', self.file.read(4096))
+        return [(i >> 8, i & 0xFF) for i in raw]
+    @_retainFilePos(fileAttr='file')
+    def getTimestamps(self):
+        """ -> list of timestamps for all 1024 chunks, ordered x + z*32 """
+        self.file.seek(4096)
+        return list(struct.unpack('>1024I', self.file.read(4096)))
+    @_retainFilePos(fileAttr='file')
     def countChunks(self):
         self.file.seek(0)
         c = 0
@@ -547,11 +1904,14 @@ class RegionHeader:
                 s += nxt[-1]
         return s
     @_retainFilePos(fileAttr='file')
-    def markUpdate(self, x, z):
+    def markUpdate(self, x, z, timestamp=None):
+        """ Set the timestamp of a chunk, to now unless one is given """
         # recall: timestamp is 4096 bytes ahead of offset position
+        if timestamp is None:
+            timestamp = int(time.time())
         pos = self._getIndex(x, z) + 4096
         self.file.seek(pos)
-        self.file.write( int(time.time()).to_bytes(4, 'big', signed=False) )
+        self.file.write( timestamp.to_bytes(4, 'big', signed=False) )
     @_retainFilePos(fileAttr='file')
     def resize(self, x, z, newSize):
         offset, size, timestamp = self.getChunkInfo(x, z)
@@ -580,6 +1940,7 @@ class RegionHeader:
             self.setChunkInfo(x, z, offset, newSize)
             return
         # we must reallocate this chunk...
+        stats.count('chunkReallocations')
         newOffset = self._alloc(newSize)
         self.setChunkInfo(x, z, newOffset, newSize)
         # grab the old data and set it to zero if it exists
@@ -626,19 +1987,136 @@ class RegionHeader:
     def findHoles(self):
         """ Here's a fun analysis method! Finds the "holes" in the file. """
         self.file.seek(0, 2)
-        fileSize = self.file.tell()
-        # all files should be 4096 byte-aligned
-        assert math.floor(fileSize/4096) == fileSize//4096
-        fileSize //= 4096
+        # all files should be 4096 byte-aligned, but a partial sector at the
+        # end still counts (see fsck for checking a file properly)
+        fileSize = (self.file.tell() + 4095) // 4096
         # it's probably faster to remove indices from a set
         holes = set(i for i in range(2, fileSize))
-        self.file.seek(0)
-        for i in range(1024):
-            location = int.from_bytes(self.file.read(3), 'big', signed=False)
-            size = int.from_bytes(self.file.read(1), 'big', signed=False)
-            for j in range(location, location+size):
-                holes.remove(j)
+        for location, size in self.getLocations():
+            # overlapping chunks may have already removed a sector
+            holes.difference_update(range(location, location+size))
         return holes
 
+_regionName = re.compile(r'^r\.(-?\d+)\.(-?\d+)\.mca$')
+
+def listRegions(regionPath):
+    """ -> list of (x, z) of every region file in a directory """
+    out = []
+    for name in os.listdir(regionPath):
+        match = _regionName.match(name)
+        if match is not None:
+            out.append((int(match.group(1)), int(match.group(2))))
+    return out
+
+def regionPath(directory, x, z):
+    """ -> path of the file of region x, z in a directory of region files """
+    return os.path.join(directory, 'r.' + str(x) + '.' + str(z) + '.mca')
+
+def regionCoords(path):
+    """ -> (x, z) of a region file from its name, see regionPath """
+    match = _regionName.match(os.path.basename(path))
+    if match is None:
+        raise ValueError('Not a region file name: ' + str(path))
+    return int(match.group(1)), int(match.group(2))
+
+def mapRegions(func, jobs, processes=None):
+    """ -> [func(*job) for job in jobs], usually one job per region.
+        processes - number of worker processes, None for one per CPU and 0
+        to run every job in this process
+    """
+    if processes == 0 or not jobs:
+        return [func(*job) for job in jobs]
+    with ProcessPoolExecutor(processes) as pool:
+        return list(pool.map(func, *zip(*jobs)))
+
+def _findInRegion(path, region, ids, mapping):
+    """ Search (mapping is None) or replace (mapping is a dict of old id ->
+        (new id, new data)) blocks within one region file.
+        -> list of (x, y, z, id) found, or when replacing a list of
+        (chunkX, chunkZ, timestamp, changes, replaced) of the chunks that
+        were rewritten, where changes is a dict of id -> change in count
+    """
+    found = []
+    if os.path.getsize(path) < 4096*2:
+        return found
+    with open(path, mode='rb' if mapping is None else 'r+b') as file:
+        header = RegionHeader(region[0], region[1], file)
+        locations = header.getLocations()
+        for i in range(1024):
+            if locations[i] == (0, 0):
+                continue
+            x, z = region[0]*32 + (i & 31), region[1]*32 + (i >> 5)
+            tag = readChunk(x, z, header)
+            changed = 0
+            changes = Counter()
+            for section in tag['Level']['Sections'].value:
+                match = _matchSection(section, ids)
+                if match is None:
+                    continue
+                sectionIds, indices = match
+                if mapping is None:
+                    sy = section['Y'].value * 16
+                    found.extend((x*16 + (j & 15), sy + (j >> 8),
+                                  z*16 + ((j >> 4) & 15), sectionIds[j])
+                                 for j in indices)
+                else:
+                    changed += _replaceInSection(section, sectionIds, indices,
+                                                 mapping, changes)
+            if changed:
+                level = tag['Level'].value
+                level['LightPopulated'].value = 0
+                level['HeightMap'].value = nbtToChunk(tag).genHeightmap()
+                writeCompressedChunk(x, z, compressChunk(tag), header)
+                found.append((x, z, header.getChunkInfo(x, z)[2],
+                              dict(changes), changed))
+    return found
+
+def _matchSection(section, ids):
+    """ -> (ids array, list of indices of blocks in ids) for a section tag,
+        or None if the section can not contain any of the ids.
+
+        Sections are ruled out with bulk checks on the raw Blocks and Add
+        arrays before any per block work is done.
+    """
+    if 'Blocks' not in section:
+        # sections with a palette do not have block ids
+        return None
+    blocks = _toUnsigned(section['Blocks'].value)
+    add = section.get('Add', None)
+    if add is None:
+        # without Add, ids over 255 can not be in this section
+        low = set(i for i in ids if i < 256)
+    else:
+        low = set(i & 0xFF for i in ids)
+    if low.isdisjoint(blocks):
+        return None
+    if add is None:
+        sectionIds = _joinIds(blocks)
+    else:
+        sectionIds = _joinIds(blocks, _unpackNibbles(add.value))
+    if ids.isdisjoint(sectionIds):
+        return None
+    return sectionIds, [j for j, id in enumerate(sectionIds) if id in ids]
+
+def _replaceInSection(section, sectionIds, indices, mapping, changes):
+    """ Apply mapping to the blocks at indices of a section tag, adding the
+        change in the count of each id to changes
+        -> number of blocks changed
+    """
+    data = _unpackNibbles(section['Data'].value)
+    for j in indices:
+        changes[sectionIds[j]] -= 1
+        sectionIds[j], data[j] = mapping[sectionIds[j]]
+        changes[sectionIds[j]] += 1
+    blocks, add = _splitIds(sectionIds)
+    section['Blocks'].value = _toSigned(blocks)
+    section['Data'].value = _toSigned(_packNibbles(data))
+    if any(add):
+        section['Add'] = nbt.Tag('TAG_Byte_Array', 'Add',
+                                 _toSigned(_packNibbles(add)))
+    else:
+        section.pop('Add', None)
+    return len(indices)
+
 def getRegionPos(chunkX, chunkZ):
     return (chunkX >> 5, chunkZ >> 5)
@@ -1,7 +1,14 @@
 import gzip
+import io
 import struct
 import json
+import json.decoder
+import json.scanner
 import os.path
+import re
+import shutil
+import tempfile
+import time
 
 def toJson(fileName, outputDir, gzipped=True):
     """ Write an NBT as two JSON files.
@@ -12,30 +19,36 @@ def toJson(fileName, outputDir, gzipped=True):
         Number type (IEEE floats), so all bytes, shorts, ints, etc are converted
         to floats.
 
-        Longs may be truncated if JSON module refuses to read/write numbers
-        larger than the max double.
+        The file is converted as it is read (see streamToJson) and longs are
+        written exactly. Whether the file is gzipped is detected with
+        isGzipped; the gzipped argument is only kept for compatibility.
     """
     path, name = os.path.split(fileName)
     tagtypes = os.path.join(outputDir,
                             os.path.splitext(name)[0] + '.tagtypes.json')
     tags = os.path.join(outputDir, name + '.json')
-    with gzip.open(fileName) as file:
-        root = NbtReader(file).read()
-    with open(tagtypes, mode='w') as file:
-        json.dump(root.getFormatDict(), file, indent=4)
-    with open(tags, mode='w') as file:
-        json.dump(root.pythonify(), file, indent=4)
+    with open(fileName, mode='rb') as file:
+        if isGzipped(file):
+            file = gzip.GzipFile(fileobj=file)
+        with open(tagtypes, mode='w') as typesFile, \
+             open(tags, mode='w') as valuesFile:
+            streamToJson(file, valuesFile, typesFile)
 
 def fromJson(rootName, dataFileName, tagtypesFileName):
     """ Given tagtypes and nbt JSON files, create an NBT Tag. """
-    # perhaps we could use the parse_float and parse_int options of the
-    # json.load function?
-    with open(dataFileName) as file:
-        values = json.load(file)
+    stream = io.BytesIO()
+    jsonToNbt(rootName, dataFileName, tagtypesFileName, stream)
+    stream.seek(0)
+    return NbtReader(stream).read()
+
+def jsonToNbt(rootName, dataFileName, tagtypesFileName, stream):
+    """ Given tagtypes and nbt JSON files, write the NBT to stream.
+        The values file is converted as it is read, without building Tags.
+    """
     with open(tagtypesFileName) as tagtypesFile:
         tagtypes = json.load(tagtypesFile)
-
-    return fromDict(rootName, values, tagtypes)
+    with open(dataFileName) as file:
+        jsonToStream(file, tagtypes, stream, rootName)
 
 def tagToJson(outputDir, fileName, root):
     """ Given an NBT tag root, write it to outputDir as JSON. """
@@ -44,10 +57,12 @@ def tagToJson(outputDir, fileName, root):
     tagtypes = os.path.join(outputDir,
                             os.path.splitext(name)[0] + '.tagtypes.json')
     tags = os.path.join(outputDir, name + '.json')
-    with open(tagtypes, mode='w') as file:
-        json.dump(root.getFormatDict(), file, indent=4)
-    with open(tags, mode='w') as file:
-        json.dump(root.pythonify(), file, indent=4)
+    stream = io.BytesIO()
+    NbtWriter(stream).write(root)
+    stream.seek(0)
+    with open(tagtypes, mode='w') as typesFile, \
+         open(tags, mode='w') as valuesFile:
+        streamToJson(stream, valuesFile, typesFile)
 
 def fromDict(name, values, types):
     t = Tag(0, name)
@@ -111,6 +126,7 @@ class Tag:
     TAG_List = 9
     TAG_Compound = 10
     TAG_Int_Array = 11
+    TAG_Long_Array = 12
     fromId = {
         TAG_End: 'TAG_End',
         TAG_Byte: 'TAG_Byte',
@@ -123,7 +139,8 @@ class Tag:
         TAG_String: 'TAG_String',
         TAG_List: 'TAG_List',
         TAG_Compound: 'TAG_Compound',
-        TAG_Int_Array: 'TAG_Int_Array'
+        TAG_Int_Array: 'TAG_Int_Array',
+        TAG_Long_Array: 'TAG_Long_Array'
     }
 
     def __init__(self, id, name, val=None, listType=None):
@@ -213,7 +230,8 @@ class NbtWriter:
         Tag.TAG_String: 'writeString',
         Tag.TAG_List: 'writeList',
         Tag.TAG_Compound: 'writeCompound',
-        Tag.TAG_Int_Array: 'writeIntArray'
+        Tag.TAG_Int_Array: 'writeIntArray',
+        Tag.TAG_Long_Array: 'writeLongArray'
     }
 
     def __init__(self, stream, safetyMax=None):
@@ -238,14 +256,15 @@ class NbtWriter:
                            + str(self.safetyMax))
         getattr(self, NbtWriter.payloads[id])(payload=value, tag=tag)
     # complex types
-    def writeByteArray(self, tag=None, **kw):
-        self.writeInt(len(tag.value))
-        for i in tag.value:
-            self.writeByte(i)
-    def writeIntArray(self, tag=None, **kw):
-        self.writeInt(len(tag.value))
-        for i in tag.value:
-            self.writeInt(i)
+    def writeByteArray(self, payload=None, **kw):
+        self.writeInt(len(payload))
+        self.file.write( struct.pack('>%db' % len(payload), *payload) )
+    def writeIntArray(self, payload=None, **kw):
+        self.writeInt(len(payload))
+        self.file.write( struct.pack('>%di' % len(payload), *payload) )
+    def writeLongArray(self, payload=None, **kw):
+        self.writeInt(len(payload))
+        self.file.write( struct.pack('>%dq' % len(payload), *payload) )
     def writeList(self, tag=None, **kw):
         self.writeByte(tag.listType)
         self.writeInt(len(tag.value))
@@ -274,8 +293,9 @@ class NbtWriter:
         self.file.write( struct.pack('>d', payload) )
     def writeString(self, payload=None, **kw):
         # all nbt string lengths are defined by a short, not null terminator
-        self.writeShort(len(payload))
-        self.file.write( payload.encode('utf-8') )
+        data = payload.encode('utf-8')
+        self.file.write( len(data).to_bytes(2, 'big', signed=False) )
+        self.file.write( data )
 
 class NbtReader:
     payloads = {
@@ -290,7 +310,8 @@ class NbtReader:
         Tag.TAG_String: 'readString',
         Tag.TAG_List: 'readList',
         Tag.TAG_Compound: 'readCompound',
-        Tag.TAG_Int_Array: 'readIntArray'
+        Tag.TAG_Int_Array: 'readIntArray',
+        Tag.TAG_Long_Array: 'readLongArray'
     }
 
     def __init__(self, stream):
@@ -314,7 +335,7 @@ class NbtReader:
         id = self.readByte()
         if id == 0:
             return Tag(id, '')
-        t = Tag(id, self.readString(self.readShort()))
+        t = Tag(id, self.readString(self.readUnsignedShort()))
         return t
     def parsePayload(self, id):
         """ -> python value of payload or (list type, value of payload)"""
@@ -322,7 +343,7 @@ class NbtReader:
             return getattr(self, NbtReader.payloads[id])()
         except KeyError:
             # .payloads[...] will throw the error, not getattr
-            raise NotImplementedError('Encountered unkown tag id: ' + id)
+            raise NotImplementedError('Encountered unkown tag id: ' + str(id))
     def readCompound(self):
         result = {}
         while True:
@@ -340,16 +361,13 @@ class NbtReader:
         return listType, value
     def readByteArray(self):
         size = self.readInt()
-        value = []
-        for i in range(size):
-            value.append(self.parsePayload(Tag.TAG_Byte))
-        return value
+        return list(struct.unpack('>%db' % size, self.file.read(size)))
     def readIntArray(self):
         size = self.readInt()
-        value = []
-        for i in range(size):
-            value.append(self.parsePayload(Tag.TAG_Int))
-        return value
+        return list(struct.unpack('>%di' % size, self.file.read(size * 4)))
+    def readLongArray(self):
+        size = self.readInt()
+        return list(struct.unpack('>%dq' % size, self.file.read(size * 8)))
     # numeric tags
     def readDouble(self):
         return struct.unpack('>d', self.file.read(8))[0]
@@ -361,11 +379,710 @@ class NbtReader:
         return int.from_bytes(self.file.read(4), 'big', signed=True)
     def readShort(self):
         return int.from_bytes(self.file.read(2), 'big', signed=True)
+    def readUnsignedShort(self):
+        # the length of a string, as writeString writes it
+        return int.from_bytes(self.file.read(2), 'big', signed=False)
     def readByte(self):
         return int.from_bytes(self.file.read(1), 'big', signed=True)
     def readString(self, length=None):
         if length is None:
-            return self.readString(self.readShort())
+            return self.readString(self.readUnsignedShort())
         s = self.file.read(length)
         s = s.decode('utf-8')
         return s
+    # partial reads
+    def skipPayload(self, id):
+        """ Move past a payload without decoding it """
+        if id in NbtReader._sizes:
+            self.file.seek(NbtReader._sizes[id], 1)
+        elif id in NbtReader._arrays:
+            self.file.seek(self.readInt() * NbtReader._arrays[id], 1)
+        elif id == Tag.TAG_String:
+            self.file.seek(int.from_bytes(self.file.read(2), 'big'), 1)
+        elif id == Tag.TAG_List:
+            listType = self.readByte()
+            length = self.readInt()
+            if listType in NbtReader._sizes:
+                self.file.seek(length * NbtReader._sizes[listType], 1)
+            else:
+                for i in range(length):
+                    self.skipPayload(listType)
+        elif id == Tag.TAG_Compound:
+            while True:
+                nxt = self.readByte()
+                if nxt == Tag.TAG_End:
+                    break
+                self.file.seek(int.from_bytes(self.file.read(2), 'big'), 1)
+                self.skipPayload(nxt)
+        else:
+            raise NotImplementedError('Encountered unkown tag id: ' + str(id))
+    def readSelected(self, id, spec):
+        """ -> the parts of a compound (or list of compounds) payload named
+            by spec, see readPartial
+        """
+        if id == Tag.TAG_List:
+            listType = self.readByte()
+            return [self.readSelected(listType, spec)
+                    for i in range(self.readInt())]
+        result = {}
+        while True:
+            nxt = self.readByte()
+            if nxt == Tag.TAG_End:
+                break
+            name = self.readString()
+            wanted = spec.get(name, None)
+            if wanted is None:
+                self.skipPayload(nxt)
+            elif wanted is True or wanted == 'tag':
+                t = Tag(nxt, name)
+                if nxt == Tag.TAG_List:
+                    t.listType, t.value = self.parsePayload(nxt)
+                else:
+                    t.value = self.parsePayload(nxt)
+                result[name] = t.pythonify() if wanted is True else t
+            else:
+                result[name] = self.readSelected(nxt, wanted)
+        return result
+    # payload sizes for skipPayload
+    _sizes = {
+        Tag.TAG_Byte: 1,
+        Tag.TAG_Short: 2,
+        Tag.TAG_Int: 4,
+        Tag.TAG_Long: 8,
+        Tag.TAG_Float: 4,
+        Tag.TAG_Double: 8
+    }
+    _arrays = {
+        Tag.TAG_Byte_Array: 1,
+        Tag.TAG_Int_Array: 4,
+        Tag.TAG_Long_Array: 8
+    }
+
+def readPartial(stream, spec):
+    """ Read only some of the tags in an NBT document.
+        spec is a dict shaped like the wanted part of the root compound;
+        each key maps to True to read that tag (as pythonify would return
+        it), 'tag' to read it as a Tag, or to a nested spec for a compound
+        or a list of compounds.
+        Everything else is skipped without being decoded.
+        -> dict of the wanted tags that were present
+    """
+    reader = NbtReader(stream)
+    id = reader.readByte()
+    reader.readString()
+    return reader.readSelected(id, spec)
+
+class NbtProfile:
+    """ Counts, bytes and time of the payloads handled by a ProfilingReader
+        or ProfilingWriter, by tag type and by path (like
+        Level/Sections/*/Blocks, where * is any element of a list).
+
+        types, paths - dicts of key -> [count, bytes, seconds, selfBytes,
+        selfSeconds]; bytes and seconds of a compound or list include its
+        contents, the self values do not.
+    """
+    columns = ('count', 'bytes', 'seconds', 'selfBytes', 'selfSeconds')
+
+    def __init__(self):
+        self.types = {}
+        self.paths = {}
+        # [bytes, seconds] taken by the contents of each open payload
+        self._inner = []
+    def measure(self, id, path, stream, func, *args):
+        """ -> func(*args), recorded as a payload of type id at path """
+        inner = [0, 0.0]
+        self._inner.append(inner)
+        pos = stream.tell()
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            size = stream.tell() - pos
+            self._inner.pop()
+            if self._inner:
+                self._inner[-1][0] += size
+                self._inner[-1][1] += seconds
+            for table, key in ((self.types, Tag.fromId[id]),
+                               (self.paths, path)):
+                entry = table.get(key, None)
+                if entry is None:
+                    entry = table[key] = [0, 0, 0.0, 0, 0.0]
+                entry[0] += 1
+                entry[1] += size
+                entry[2] += seconds
+                entry[3] += size - inner[0]
+                entry[4] += seconds - inner[1]
+    def report(self, by='paths', sort='selfSeconds', limit=20):
+        """ -> text table of the types or paths (by), most costly first by
+            one of NbtProfile.columns
+        """
+        table = getattr(self, by)
+        column = NbtProfile.columns.index(sort)
+        rows = sorted(table.items(), key=lambda r: r[1][column],
+                      reverse=True)
+        if limit is not None:
+            rows = rows[:limit]
+        width = max([len(by)] + [len(k) for k, v in rows])
+        lines = [by.ljust(width) + ''.join(c.rjust(13)
+                                           for c in NbtProfile.columns)]
+        for key, (count, size, seconds, selfSize, selfSeconds) in rows:
+            lines.append(key.ljust(width) + '%13d%13d%13.6f%13d%13.6f'
+                         % (count, size, seconds, selfSize, selfSeconds))
+        return '\n'.join(lines)
+
+class ProfilingReader(NbtReader):
+    """ An NbtReader which records what it reads in an NbtProfile.
+        NbtReader itself is untouched, so profiling costs nothing when it
+        is not used.
+    """
+    def __init__(self, stream, profile=None):
+        super().__init__(stream)
+        self.profile = profile if profile is not None else NbtProfile()
+        self._path = []
+    def readTag(self):
+        t = self.readTagHeader()
+        if t.id == Tag.TAG_End:
+            return t
+        self._path.append(t.name)
+        try:
+            if t.id == Tag.TAG_List:
+                t.listType, t.value = self.parsePayload(t.id)
+            else:
+                t.value = self.parsePayload(t.id)
+        finally:
+            self._path.pop()
+        return t
+    def readList(self):
+        self._path.append('*')
+        try:
+            return super().readList()
+        finally:
+            self._path.pop()
+    def parsePayload(self, id):
+        return self.profile.measure(id, _profilePath(self._path), self.file,
+                                    super().parsePayload, id)
+
+class ProfilingWriter(NbtWriter):
+    """ An NbtWriter which records what it writes in an NbtProfile, see
+        ProfilingReader
+    """
+    def __init__(self, stream, safetyMax=None, profile=None):
+        super().__init__(stream, safetyMax)
+        self.profile = profile if profile is not None else NbtProfile()
+        self._path = []
+    def write(self, tag):
+        self._path.append(tag.name)
+        try:
+            super().write(tag)
+        finally:
+            self._path.pop()
+    def writeList(self, tag=None, **kw):
+        self._path.append('*')
+        try:
+            super().writeList(tag=tag, **kw)
+        finally:
+            self._path.pop()
+    def writePayload(self, id, value, tag=None):
+        self.profile.measure(id, _profilePath(self._path), self.file,
+                             super().writePayload, id, value, tag)
+
+def _profilePath(names):
+    # the root tag is usually unnamed
+    return '/'.join(names).lstrip('/') or '/'
+
+def profileFile(fileName):
+    """ Read an NBT file (gzipped or not) with a ProfilingReader.
+        -> (root Tag, NbtProfile)
+    """
+    with open(fileName, mode='rb') as file:
+        if isGzipped(file):
+            file = gzip.GzipFile(fileobj=file)
+        reader = ProfilingReader(file)
+        return reader.read(), reader.profile
+
+def streamToJson(stream, valuesFile, typesFile, indent=4):
+    """ Convert the NBT in stream to JSON as it is read.
+        The values and the tagtypes are written to the two text files in a
+        single pass, without building any Tags. Arrays are written on a
+        single line.
+    """
+    reader = NbtReader(stream)
+    id = reader.readByte()
+    # the name of the root tag is not kept, same as pythonify
+    reader.readString()
+    _JsonEmitter(reader, valuesFile, typesFile, indent).payload(id, 0)
+
+def jsonToStream(valuesFile, tagtypes, stream, rootName=''):
+    """ Write the values JSON in valuesFile to stream as NBT as it is read.
+        tagtypes - the (already loaded) tagtypes structure
+    """
+    tokens = _JsonTokens(valuesFile)
+    if stream.seekable() and not isinstance(stream, gzip.GzipFile):
+        out = _NbtEmitter(stream)
+    else:
+        # list lengths may have to be patched in after the list is written,
+        # which needs a file that can seek back
+        out = _NbtEmitter(tempfile.TemporaryFile())
+    out.header(_typeId(tagtypes), rootName)
+    out.payload(tokens, tokens.next(), tagtypes)
+    out.flush()
+    if out.file is not stream:
+        out.file.seek(0)
+        shutil.copyfileobj(out.file, stream)
+        out.file.close()
+
+def _typeId(types):
+    """ tagtypes structure -> tag id """
+    if type(types) == dict:
+        return Tag.TAG_Compound
+    elif type(types) == list:
+        return Tag.TAG_List
+    return getattr(Tag, types)
+
+def _floatStr(f):
+    # the same spelling json.dumps uses
+    if f != f:
+        return 'NaN'
+    elif f in (float('inf'), float('-inf')):
+        return 'Infinity' if f > 0 else '-Infinity'
+    return repr(f)
+
+class _JsonEmitter:
+    """ Walks NBT payloads from a reader, writing values and types. """
+    _arrays = {
+        Tag.TAG_Byte_Array: ('b', 1),
+        Tag.TAG_Int_Array: ('i', 4),
+        Tag.TAG_Long_Array: ('q', 8)
+    }
+
+    def __init__(self, reader, values, types, indent):
+        self.reader = reader
+        self.values = values
+        self.types = types
+        self.indent = indent
+    def newline(self, depth):
+        if self.indent is None:
+            return ''
+        return '\n' + ' ' * (self.indent * depth)
+    def payload(self, id, depth):
+        """ Write one payload to values and its type to types """
+        if id == Tag.TAG_Compound:
+            self.compound(depth)
+        elif id == Tag.TAG_List:
+            self.list(depth)
+        else:
+            self.values.write(self.primitive(id))
+            self.types.write('"' + Tag.fromId[id] + '"')
+    def primitive(self, id):
+        """ -> JSON text of a payload that is not a compound or list """
+        r = self.reader
+        if id in _JsonEmitter._arrays:
+            code, width = _JsonEmitter._arrays[id]
+            size = r.readInt()
+            values = struct.unpack('>%d%s' % (size, code),
+                                   r.file.read(size * width))
+            return '[' + ', '.join(map(str, values)) + ']'
+        elif id == Tag.TAG_String:
+            return json.dumps(r.readString())
+        elif id in (Tag.TAG_Float, Tag.TAG_Double):
+            return _floatStr(r.parsePayload(id))
+        # integers are written exactly, however large
+        return str(r.parsePayload(id))
+    def compound(self, depth):
+        first = True
+        while True:
+            id = self.reader.readByte()
+            if id == Tag.TAG_End:
+                break
+            name = json.dumps(self.reader.readString())
+            start = ('{' if first else ',') + self.newline(depth + 1)
+            self.values.write(start + name + ': ')
+            self.types.write(start + name + ': ')
+            self.payload(id, depth + 1)
+            first = False
+        end = '{}' if first else self.newline(depth) + '}'
+        self.values.write(end)
+        self.types.write(end)
+    def list(self, depth):
+        listType = self.reader.readByte()
+        length = self.reader.readInt()
+        if listType not in (Tag.TAG_Compound, Tag.TAG_List):
+            # lists of primitives are described by [ "TAG_x" ]
+            self.types.write('["' + Tag.fromId[listType] + '"]')
+            self.values.write('[' + ', '.join(self.primitive(listType)
+                                              for i in range(length)) + ']')
+            return
+        # lists of compounds and lists of lists have a type for every element
+        for i in range(length):
+            start = ('[' if i == 0 else ',') + self.newline(depth + 1)
+            self.values.write(start)
+            self.types.write(start)
+            self.payload(listType, depth + 1)
+        end = '[]' if length == 0 else self.newline(depth) + ']'
+        self.values.write(end)
+        self.types.write(end)
+
+class _JsonTokens:
+    """ Reads a JSON document as a stream of tokens, a block at a time.
+        Tokens are '{', '}', '[', ']' and python values; ',' and ':' are
+        skipped. Integers are never converted to floats.
+    """
+    _space = re.compile(r'[\s,:]*')
+    _literals = {'true': True, 'false': False, 'null': None,
+                 'NaN': float('nan'), 'Infinity': float('inf'),
+                 '-Infinity': float('-inf')}
+
+    def __init__(self, file, blockSize=1 << 16):
+        self.file = file
+        self.blockSize = blockSize
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+    def fill(self):
+        """ Read another block, -> False at the end of the file """
+        if self.eof:
+            return False
+        block = self.file.read(self.blockSize)
+        if not block:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + block
+        self.pos = 0
+        return True
+    def numbers(self):
+        """ -> list of the numbers up to the next ']', which is consumed.
+            Much faster than next() for long arrays of numbers.
+        """
+        end = self.buffer.find(']', self.pos)
+        while end == -1:
+            if not self.fill():
+                raise ValueError('Unexpected end of JSON document')
+            end = self.buffer.find(']', self.pos)
+        values = json.loads('[' + self.buffer[self.pos:end + 1])
+        self.pos = end + 1
+        return values
+    def next(self):
+        while True:
+            self.pos = _JsonTokens._space.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or not self.fill():
+                break
+        if self.pos >= len(self.buffer):
+            raise ValueError('Unexpected end of JSON document')
+        c = self.buffer[self.pos]
+        if c in '{}[]':
+            self.pos += 1
+            return c
+        while True:
+            token = self.scalar(c)
+            if token is not None:
+                return token[0]
+            # at the end of the file scalar will either succeed or raise
+            self.fill()
+    def scalar(self, c):
+        """ -> (value,) or None if the token may continue past the buffer """
+        s, pos = self.buffer, self.pos
+        if c == '"':
+            try:
+                value, end = json.decoder.scanstring(s, pos + 1)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                return None
+        else:
+            match = json.scanner.NUMBER_RE.match(s, pos)
+            if match is not None:
+                integer, frac, exp = match.groups()
+                if frac or exp:
+                    value = float(integer + (frac or '') + (exp or ''))
+                else:
+                    value = int(integer)
+                end = match.end()
+            else:
+                for word, value in _JsonTokens._literals.items():
+                    if s.startswith(word, pos):
+                        end = pos + len(word)
+                        break
+                else:
+                    if not self.eof and len(s) - pos < 10:
+                        return None
+                    raise ValueError('Invalid JSON at ' + repr(s[pos:pos+20]))
+            if len(s) - end < 32 and not self.eof:
+                # the number may be cut off by the end of the buffer
+                return None
+        self.pos = end
+        return (value,)
+
+class _NbtEmitter:
+    """ Writes NBT payloads from JSON tokens directed by tagtypes. """
+    _formats = {
+        Tag.TAG_Byte: 'b',
+        Tag.TAG_Short: 'h',
+        Tag.TAG_Int: 'i',
+        Tag.TAG_Long: 'q',
+        Tag.TAG_Float: 'f',
+        Tag.TAG_Double: 'd'
+    }
+    _arrays = {
+        Tag.TAG_Byte_Array: 'b',
+        Tag.TAG_Int_Array: 'i',
+        Tag.TAG_Long_Array: 'q'
+    }
+
+    def __init__(self, stream, bufferSize=1 << 16):
+        self.file = stream
+        self.buffer = bytearray()
+        self.bufferSize = bufferSize
+        # where the output starts in the stream and how much of it has been
+        # written out, for patch
+        self.start = stream.tell()
+        self.flushed = 0
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) > self.bufferSize:
+            self.flush()
+    def flush(self):
+        self.file.write(self.buffer)
+        self.flushed += len(self.buffer)
+        self.buffer = bytearray()
+    def tell(self):
+        """ -> position in the output """
+        return self.flushed + len(self.buffer)
+    def patch(self, pos, data):
+        """ Overwrite the output at pos, which may have been written out """
+        if pos >= self.flushed:
+            pos -= self.flushed
+            self.buffer[pos:pos + len(data)] = data
+            return
+        self.file.seek(self.start + pos)
+        self.file.write(data)
+        self.file.seek(self.start + self.flushed)
+    def header(self, id, name):
+        self.write(struct.pack('>b', id))
+        self.string(name)
+    def string(self, s):
+        data = s.encode('utf-8')
+        self.write(struct.pack('>H', len(data)) + data)
+    def payload(self, tokens, token, types):
+        """ Write the value starting with token, described by types """
+        if type(types) == dict:
+            if token != '{':
+                raise ValueError('Expected a compound, got ' + repr(token))
+            while True:
+                key = tokens.next()
+                if key == '}':
+                    break
+                self.header(_typeId(types[key]), key)
+                self.payload(tokens, tokens.next(), types[key])
+            self.write(b'\x00')
+        elif type(types) == list:
+            if token != '[':
+                raise ValueError('Expected a list, got ' + repr(token))
+            self.list(tokens, types)
+        else:
+            id = getattr(Tag, types)
+            self.primitive(id, self.value(tokens, token,
+                                          id in _NbtEmitter._arrays))
+    def value(self, tokens, token, numeric=False):
+        """ -> the python value of a scalar or an array starting at token
+            numeric - the array can only contain numbers
+        """
+        if token != '[':
+            return token
+        if numeric:
+            return tokens.numbers()
+        values = []
+        token = tokens.next()
+        while token != ']':
+            values.append(token)
+            token = tokens.next()
+        return values
+    def list(self, tokens, types):
+        if len(types) == 0:
+            # an empty list
+            tokens.next()
+            self.write(struct.pack('>bi', Tag.TAG_End, 0))
+        elif type(types[0]) in (dict, list):
+            # every element has its own entry in types, so the length is
+            # known before the elements are read; it is only patched if the
+            # values do not agree
+            self.write(struct.pack('>bi', _typeId(types[0]), len(types)))
+            start = self.tell() - 4
+            length = 0
+            token = tokens.next()
+            while token != ']':
+                self.payload(tokens, token, types[min(length, len(types) - 1)])
+                length += 1
+                token = tokens.next()
+            if length != len(types):
+                self.patch(start, struct.pack('>i', length))
+        else:
+            # a list of primitives has to be read before its length is known
+            listType = getattr(Tag, types[0])
+            if listType in _NbtEmitter._formats:
+                elements = tokens.numbers()
+            else:
+                elements = []
+                token = tokens.next()
+                while token != ']':
+                    elements.append(self.value(
+                        tokens, token, listType in _NbtEmitter._arrays))
+                    token = tokens.next()
+            self.write(struct.pack('>bi', listType, len(elements)))
+            if listType in _NbtEmitter._formats:
+                self.numbers(listType, elements)
+            else:
+                for element in elements:
+                    self.primitive(listType, element)
+    def numbers(self, id, values):
+        self.pack(_NbtEmitter._formats[id], values)
+    def pack(self, code, values):
+        try:
+            data = struct.pack('>%d%s' % (len(values), code), *values)
+        except struct.error:
+            # integers may have been written as floats, ie 1.0
+            if code in 'fd':
+                raise
+            data = struct.pack('>%d%s' % (len(values), code),
+                               *[int(v) for v in values])
+        self.write(data)
+    def primitive(self, id, value):
+        if id == Tag.TAG_String:
+            self.string(value)
+        elif id in _NbtEmitter._arrays:
+            self.write(struct.pack('>i', len(value)))
+            self.pack(_NbtEmitter._arrays[id], value)
+        else:
+            self.numbers(id, [value])
+
+# compiled schemas from loadSchema, by absolute path -> (mtime, Schema)
+_schemaCache = {}
+
+def loadSchema(tagtypesFileName):
+    """ -> the compiled Schema of a tagtypes JSON file.
+        Schemas are only compiled once per process, unless the file changes.
+    """
+    path = os.path.abspath(tagtypesFileName)
+    mtime = os.path.getmtime(path)
+    cached = _schemaCache.get(path, None)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    with open(path) as file:
+        schema = compileSchema(json.load(file))
+    _schemaCache[path] = (mtime, schema)
+    return schema
+
+def compileSchema(tagtypes):
+    """ Compile a tagtypes structure into a Schema. """
+    return Schema(tagtypes)
+
+class Schema:
+    """ A tagtypes structure compiled into encoder functions, which write
+        plain python values (as made by Tag.pythonify or json.load) straight
+        to NBT without building Tags.
+    """
+    _numbers = {
+        Tag.TAG_Byte: 'b',
+        Tag.TAG_Short: 'h',
+        Tag.TAG_Int: 'i',
+        Tag.TAG_Long: 'q',
+        Tag.TAG_Float: 'f',
+        Tag.TAG_Double: 'd'
+    }
+    _arrays = {
+        Tag.TAG_Byte_Array: 'b',
+        Tag.TAG_Int_Array: 'i',
+        Tag.TAG_Long_Array: 'q'
+    }
+
+    def __init__(self, tagtypes):
+        self.tagtypes = tagtypes
+        self.id = _typeId(tagtypes)
+        self.encoder = self._compile(tagtypes)
+    def encode(self, values, name=''):
+        """ -> bytes of a complete NBT tag named name """
+        out = bytearray()
+        out += _tagHeader(self.id, name)
+        self.encoder(values, out)
+        return bytes(out)
+    def write(self, values, stream, name=''):
+        stream.write(self.encode(values, name))
+    def _compile(self, types):
+        """ -> function encoder(values, out) which appends the payload of
+            values to the bytearray out
+        """
+        id = _typeId(types)
+        if id == Tag.TAG_Compound:
+            return self._compileCompound(types)
+        elif id == Tag.TAG_List:
+            return self._compileList(types)
+        elif id == Tag.TAG_String:
+            return _encodeString
+        elif id in Schema._arrays:
+            return _arrayEncoder(Schema._arrays[id])
+        elif id in Schema._numbers:
+            number = struct.Struct('>' + Schema._numbers[id]).pack
+            def encodeNumber(value, out):
+                out += number(value)
+            return encodeNumber
+        raise ValueError('Unknown tag type in tagtypes: ' + repr(types))
+    def _compileCompound(self, types):
+        # the header of every child can be built ahead of time
+        fields = dict((k, (_tagHeader(_typeId(t), k), self._compile(t)))
+                      for k, t in types.items())
+        def encodeCompound(values, out):
+            for k, v in values.items():
+                try:
+                    header, encoder = fields[k]
+                except KeyError:
+                    raise ValueError('Key is not in tagtypes: ' + repr(k))
+                out += header
+                encoder(v, out)
+            out += b'\x00'
+        return encodeCompound
+    def _compileList(self, types):
+        if len(types) == 0 or types[0] == 'TAG_End':
+            def encodeEmpty(values, out):
+                if len(values) != 0:
+                    raise ValueError('tagtypes describes an empty list')
+                out += struct.pack('>bi', Tag.TAG_End, 0)
+            return encodeEmpty
+        elif type(types[0]) in (dict, list):
+            # every element has its own entry in types; extra elements use
+            # the last one
+            listType = _typeId(types[0])
+            encoders = [self._compile(t) for t in types]
+            def encodeElements(values, out):
+                out += struct.pack('>bi', listType, len(values))
+                last = len(encoders) - 1
+                for i, v in enumerate(values):
+                    encoders[i if i < last else last](v, out)
+            return encodeElements
+        listType = getattr(Tag, types[0])
+        if listType in Schema._numbers:
+            code = Schema._numbers[listType]
+            def encodeNumbers(values, out):
+                out += struct.pack('>bi%d%s' % (len(values), code), listType,
+                                   len(values), *values)
+            return encodeNumbers
+        element = self._compile(types[0])
+        def encodeList(values, out):
+            out += struct.pack('>bi', listType, len(values))
+            for v in values:
+                element(v, out)
+        return encodeList
+
+def _tagHeader(id, name):
+    data = name.encode('utf-8')
+    return struct.pack('>bH', id, len(data)) + data
+
+def _encodeString(value, out):
+    data = value.encode('utf-8')
+    out += struct.pack('>H', len(data))
+    out += data
+
+def _arrayEncoder(code):
+    def encodeArray(values, out):
+        out += struct.pack('>i%d%s' % (len(values), code), len(values),
+                           *values)
+    return encodeArray
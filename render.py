@@ -0,0 +1,357 @@
+"""
+    Top down map tiles, one pixel per block and one tile per region.
+
+    Only the heightmap and block arrays of each chunk are read from the NBT,
+    and colours are looked up a whole tile at a time with bytes.translate.
+    Tiles are only rendered again when their region file has changed.
+
+    Usage: python render.py <region directory> <output directory>
+           [--raw] [--force]
+"""
+import io
+import json
+import os
+import os.path
+import struct
+import sys
+import zlib
+from array import array
+import mclevel
+import nbt
+
+# colours of the top block of a column, by block id
+BLOCK_COLOURS = {
+    0: (0, 0, 0),
+    1: (125, 125, 125),
+    2: (95, 159, 53),
+    3: (134, 96, 67),
+    4: (122, 122, 122),
+    5: (157, 128, 79),
+    6: (71, 102, 37),
+    7: (84, 84, 84),
+    8: (47, 67, 244),
+    9: (47, 67, 244),
+    10: (207, 91, 20),
+    11: (207, 91, 20),
+    12: (219, 211, 160),
+    13: (136, 126, 126),
+    14: (143, 140, 125),
+    15: (136, 130, 127),
+    16: (115, 115, 115),
+    17: (102, 81, 51),
+    18: (60, 110, 40),
+    19: (195, 196, 85),
+    20: (218, 240, 244),
+    24: (216, 208, 155),
+    31: (100, 150, 50),
+    32: (123, 79, 25),
+    35: (221, 221, 221),
+    37: (241, 249, 2),
+    38: (196, 12, 22),
+    43: (168, 168, 168),
+    44: (168, 168, 168),
+    45: (146, 99, 86),
+    48: (103, 121, 103),
+    49: (20, 18, 29),
+    53: (157, 128, 79),
+    56: (129, 140, 143),
+    60: (115, 75, 45),
+    78: (240, 251, 251),
+    79: (125, 173, 255),
+    80: (240, 251, 251),
+    81: (13, 99, 24),
+    82: (158, 164, 176),
+    83: (148, 192, 101),
+    86: (192, 118, 21),
+    87: (111, 54, 52),
+    88: (84, 64, 51),
+    89: (143, 118, 69),
+    98: (122, 121, 122),
+    110: (111, 99, 101),
+    111: (32, 128, 48),
+    112: (44, 21, 26),
+    121: (221, 223, 165),
+    159: (209, 178, 161),
+    161: (60, 110, 40),
+    162: (102, 81, 51),
+    172: (150, 92, 66),
+    174: (165, 195, 245),
+    179: (166, 85, 29)
+}
+# colour of ids which are not in BLOCK_COLOURS
+DEFAULT_COLOUR = (128, 128, 128)
+
+# block state names (1.13 onwards) -> the id whose colour they use. Names
+# that are not listed are matched by their suffix in STATE_SUFFIXES.
+STATE_IDS = {
+    'minecraft:air': 0,
+    'minecraft:cave_air': 0,
+    'minecraft:void_air': 0,
+    'minecraft:stone': 1,
+    'minecraft:grass_block': 2,
+    'minecraft:dirt': 3,
+    'minecraft:coarse_dirt': 3,
+    'minecraft:cobblestone': 4,
+    'minecraft:bedrock': 7,
+    'minecraft:water': 9,
+    'minecraft:lava': 11,
+    'minecraft:sand': 12,
+    'minecraft:gravel': 13,
+    'minecraft:sandstone': 24,
+    'minecraft:grass': 31,
+    'minecraft:tall_grass': 31,
+    'minecraft:fern': 31,
+    'minecraft:dead_bush': 32,
+    'minecraft:dandelion': 37,
+    'minecraft:poppy': 38,
+    'minecraft:obsidian': 49,
+    'minecraft:farmland': 60,
+    'minecraft:snow': 78,
+    'minecraft:ice': 79,
+    'minecraft:snow_block': 80,
+    'minecraft:cactus': 81,
+    'minecraft:clay': 82,
+    'minecraft:sugar_cane': 83,
+    'minecraft:netherrack': 87,
+    'minecraft:soul_sand': 88,
+    'minecraft:mycelium': 110,
+    'minecraft:lily_pad': 111,
+    'minecraft:end_stone': 121,
+    'minecraft:packed_ice': 174,
+    'minecraft:red_sandstone': 179
+}
+STATE_SUFFIXES = [
+    ('_leaves', 18),
+    ('_log', 17),
+    ('_wood', 17),
+    ('_planks', 5),
+    ('_stairs', 53),
+    ('_slab', 44),
+    ('_wool', 35),
+    ('_terracotta', 159),
+    ('_ore', 15),
+    ('_glass', 20),
+    ('_bricks', 98)
+]
+
+# brightness of a column which is lower than, level with and higher than
+# the column to its north
+SHADES = (0.8, 1.0, 1.15)
+
+# the parts of a chunk the renderer needs
+_SURFACE = {
+    'DataVersion': True,
+    'Level': {
+        'HeightMap': True,
+        'Heightmaps': {'WORLD_SURFACE': True},
+        'Sections': {'Y': True, 'Blocks': True, 'Palette': True,
+                     'BlockStates': True}
+    }
+}
+
+def stateId(name):
+    """ -> the id whose colour a block state name is drawn with """
+    try:
+        return STATE_IDS[name]
+    except KeyError:
+        pass
+    for suffix, id in STATE_SUFFIXES:
+        if name.endswith(suffix):
+            return id
+    return 1
+
+def colourTables(colours=None):
+    """ -> [shade][channel] translate tables from block id to colour """
+    if colours is None:
+        colours = BLOCK_COLOURS
+    base = [colours.get(i, DEFAULT_COLOUR) for i in range(256)]
+    return [[bytes(min(255, int(c[channel] * shade)) for c in base)
+             for channel in range(3)] for shade in SHADES]
+
+def renderRegion(regionFile, outputFile, format='png', colours=None):
+    """ Render the region file to a 512x512 tile, as a PNG or as raw RGB
+        bytes (format='raw'). Chunks that do not exist are black.
+    """
+    x, z = mclevel.regionCoords(regionFile)
+    ids = bytearray(512 * 512)
+    heights = bytearray(512 * 512)
+    if os.path.getsize(regionFile) >= 4096*2:
+        with open(regionFile, mode='rb') as file:
+            header = mclevel.RegionHeader(x, z, file)
+            locations = header.getLocations()
+            for i in range(1024):
+                if locations[i] == (0, 0):
+                    continue
+                data = mclevel.readChunkBytes(x*32 + (i & 31),
+                                              z*32 + (i >> 5), header)
+                top, height = chunkSurface(
+                    nbt.readPartial(io.BytesIO(data), _SURFACE))
+                # copy the chunk into the tile a row of 16 at a time
+                start = (i >> 5)*16*512 + (i & 31)*16
+                for row in range(16):
+                    pos = start + row*512
+                    ids[pos:pos + 16] = top[row*16:row*16 + 16]
+                    heights[pos:pos + 16] = height[row*16:row*16 + 16]
+    rgb = colourTile(ids, heights, 512, colours)
+    with open(outputFile, mode='wb') as file:
+        if format == 'raw':
+            file.write(rgb)
+        else:
+            file.write(encodePng(512, 512, rgb))
+
+def chunkSurface(chunk):
+    """ Partially read chunk NBT (see _SURFACE) -> (ids, heights), the id
+        and y of the top block of every column as 256 bytes each
+    """
+    level = chunk.get('Level', {})
+    sections = {}
+    if 'HeightMap' in level:
+        heightmap = level['HeightMap']
+        for s in level.get('Sections', []):
+            if 'Blocks' in s:
+                sections[s['Y']] = array('b', s['Blocks']).tobytes()
+    else:
+        # 1.13 onwards: palettes and a packed heightmap
+        spanning = chunk.get('DataVersion', 0) < mclevel.SPANNING_VERSION
+        packed = level.get('Heightmaps', {}).get('WORLD_SURFACE', None)
+        if packed is not None:
+            heightmap = mclevel.unpackBlockStates(packed, 9, 256, spanning)
+        else:
+            heightmap = [255] * 256
+        for s in level.get('Sections', []):
+            if 'Palette' not in s or 'BlockStates' not in s:
+                continue
+            palette = s['Palette']
+            indices = mclevel.unpackBlockStates(
+                s['BlockStates'], mclevel.blockStateBits(len(palette)),
+                spanning=spanning)
+            # translate palette indices to ids a layer at a time
+            table = bytes(stateId(p['Name']) & 0xFF for p in palette)
+            if len(palette) <= 256:
+                raw = mclevel._splitIds(indices)[0]
+                sections[s['Y']] = raw.translate(
+                    table + bytes(256 - len(table)))
+            else:
+                sections[s['Y']] = bytes(table[i] for i in indices)
+    ids = bytearray(256)
+    heights = bytearray(256)
+    for column in range(256):
+        # vanilla heightmaps hold the y above the top block, ones written
+        # by this library hold the y of the top block; start at either
+        y = min(heightmap[column], 255)
+        while y >= 0:
+            blocks = sections.get(y >> 4, None)
+            if blocks is None:
+                y = (y & ~15) - 1
+                continue
+            id = blocks[(y & 15)*256 + column]
+            if id != 0:
+                ids[column] = id
+                heights[column] = y
+                break
+            y -= 1
+    return ids, heights
+
+def colourTile(ids, heights, width, colours=None):
+    """ -> RGB bytes of a tile from the top block ids and heights.
+        Columns higher than their northern neighbour are drawn lighter,
+        lower ones darker.
+    """
+    tables = colourTables(colours) if colours is not None else _TABLES
+    ids = bytes(ids)
+    # the row to the north of the first row is the first row itself
+    north = bytes(heights[:width]) + bytes(heights[:-width])
+    shade = bytes(0 if h < n else 2 if h > n else 1
+                  for h, n in zip(heights, north))
+    dark = int.from_bytes(shade.translate(_IS_DARK), 'big')
+    light = int.from_bytes(shade.translate(_IS_LIGHT), 'big')
+    level = ((1 << (8 * len(ids))) - 1) ^ (dark | light)
+    out = bytearray(len(ids) * 3)
+    for channel in range(3):
+        # pick each pixel from one of the three shaded lookups with masks
+        value = ((int.from_bytes(ids.translate(tables[0][channel]), 'big')
+                  & dark)
+                 | (int.from_bytes(ids.translate(tables[1][channel]), 'big')
+                    & level)
+                 | (int.from_bytes(ids.translate(tables[2][channel]), 'big')
+                    & light))
+        out[channel::3] = value.to_bytes(len(ids), 'big')
+    return bytes(out)
+
+_TABLES = colourTables()
+_IS_DARK = bytes([255, 0, 0]) + bytes(253)
+_IS_LIGHT = bytes([0, 0, 255]) + bytes(253)
+
+def encodePng(width, height, rgb):
+    """ -> bytes of an 8 bit RGB PNG """
+    stride = width * 3
+    raw = bytearray()
+    for row in range(height):
+        # filter type 0, the row as it is
+        raw += b'\x00'
+        raw += rgb[row*stride:(row + 1)*stride]
+    return (b'\x89PNG\r\n\x1a\n'
+            + _pngChunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                             8, 2, 0, 0, 0))
+            + _pngChunk(b'IDAT', zlib.compress(bytes(raw), 6))
+            + _pngChunk(b'IEND', b''))
+
+def _pngChunk(kind, data):
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data)))
+
+def renderWorld(regionPath, outputDir, format='png', processes=None,
+                force=False, colours=None):
+    """ Render a tile for every region of a world, named like r.x.z.png
+        (or r.x.z.rgb). Regions whose header and modification time are
+        unchanged since the last render are skipped, unless force is True.
+        processes - see mclevel.mapRegions
+        -> list of (x, z) of the regions that were rendered
+    """
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+    extension = '.rgb' if format == 'raw' else '.png'
+    manifestPath = os.path.join(outputDir, 'render.json')
+    try:
+        with open(manifestPath) as file:
+            manifest = json.load(file)
+    except FileNotFoundError:
+        manifest = {}
+    jobs = []
+    for x, z in mclevel.listRegions(regionPath):
+        path = mclevel.regionPath(regionPath, x, z)
+        name = os.path.splitext(os.path.basename(path))[0]
+        output = os.path.join(outputDir, name + extension)
+        with open(path, mode='rb') as file:
+            # the location and timestamp tables change with most writes,
+            # but a chunk rewritten in place within a second only changes
+            # the modification time
+            checksum = zlib.crc32(file.read(4096*2))
+            checksum = zlib.crc32(
+                str(os.fstat(file.fileno()).st_mtime_ns).encode(), checksum)
+        if (not force and manifest.get(name, None) == [checksum, format]
+                and os.path.exists(output)):
+            continue
+        jobs.append((name, (x, z), path, output, checksum))
+    mclevel.mapRegions(renderRegion, [(path, output, format, colours)
+                                      for n, c, path, output, k in jobs],
+                       processes)
+    for name, c, path, output, checksum in jobs:
+        manifest[name] = [checksum, format]
+    with open(manifestPath, mode='w') as file:
+        json.dump(manifest, file, indent=4, sort_keys=True)
+    return [c for n, c, path, output, k in jobs]
+
+def main(argv):
+    paths = [a for a in argv if not a.startswith('--')]
+    if len(paths) != 2:
+        print(__doc__)
+        return 2
+    rendered = renderWorld(paths[0], paths[1],
+                           format='raw' if '--raw' in argv else 'png',
+                           force='--force' in argv)
+    print(str(len(rendered)) + ' regions rendered')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
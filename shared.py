@@ -0,0 +1,175 @@
+"""
+    Chunk sections loaded by worker processes into shared memory.
+
+    Every region is read by a worker, which copies the block ids, data and
+    light of each section into one shared memory block per region. Only the
+    name of the block and a small index go back to the parent, which sees
+    the sections as memoryviews into shared memory rather than unpickling
+    whole chunks.
+"""
+from multiprocessing import resource_tracker, shared_memory
+import os
+import os.path
+import mclevel
+
+# bytes of each part of a section, in the order they are stored
+_IDS = 4096 * 2
+_NIBBLES = 4096
+SLOT_SIZE = _IDS + _NIBBLES * 3
+
+class SharedRegion:
+    """ The sections of one region, in a shared memory block.
+        slots - dict of (chunkX, chunkZ, sectionY) -> slot in the block
+        palettes - dict of slot -> palette of the sections with one
+    """
+    def __init__(self, x, z, name, slots, palettes):
+        self.x = x
+        self.z = z
+        self.slots = slots
+        self.palettes = palettes
+        self.memory = shared_memory.SharedMemory(name=name)
+        # slot -> Section of views, made once per slot
+        self._sections = {}
+    def getSection(self, x, z, sectionY):
+        """ -> Section whose arrays are views of the shared memory, or None
+            if the section does not exist. Changes to the Section are seen
+            by every process which has this region open.
+        """
+        slot = self.slots.get((x, z, sectionY), None)
+        if slot is None:
+            return None
+        section = self._sections.get(slot, None)
+        if section is None:
+            section = self._sections[slot] = self._makeSection(slot)
+        return section
+    def _makeSection(self, slot):
+        start = slot * SLOT_SIZE
+        buf = self.memory.buf
+        ids = buf[start:start + _IDS].cast('H')
+        start += _IDS
+        data, skyLight, blockLight = (
+            buf[start + i*_NIBBLES:start + (i + 1)*_NIBBLES]
+            for i in range(3))
+        return mclevel.Section(ids, data, skyLight, blockLight,
+                               palette=self.palettes.get(slot, None))
+    def sections(self):
+        """ Yield (chunkX, chunkZ, sectionY, Section) of every section """
+        for x, z, y in sorted(self.slots, key=self.slots.get):
+            yield x, z, y, self.getSection(x, z, y)
+    def close(self):
+        """ Detach from the shared memory. Sections from getSection can not
+            be used afterwards.
+        """
+        for section in self._sections.values():
+            for view in (section.ids, section.data, section.skyLight,
+                         section.blockLight):
+                if isinstance(view, memoryview):
+                    view.release()
+        self._sections = {}
+        self.memory.close()
+    def unlink(self):
+        """ Free the shared memory, once every process has closed it """
+        self.memory.unlink()
+
+class SharedWorld:
+    """ The SharedRegions of a world, from loadWorld """
+    def __init__(self, regions):
+        self.regions = dict(((r.x, r.z), r) for r in regions)
+    def getSection(self, x, z, sectionY):
+        """ -> Section at chunk x, z and sectionY, see SharedRegion """
+        region = self.regions.get(mclevel.getRegionPos(x, z), None)
+        if region is None:
+            return None
+        return region.getSection(x, z, sectionY)
+    def sections(self):
+        """ Yield (chunkX, chunkZ, sectionY, Section) of every section """
+        for key in sorted(self.regions):
+            yield from self.regions[key].sections()
+    def close(self):
+        """ Detach from and free the shared memory of every region """
+        for region in self.regions.values():
+            region.close()
+            region.unlink()
+        self.regions = {}
+    def __enter__(self):
+        return self
+    def __exit__(self, exctype, exc, trace):
+        self.close()
+
+def loadWorld(regionPath, regions=None, processes=None):
+    """ -> SharedWorld of the sections of every region in regionPath.
+        The region files are read as they are on disk, so a MinecraftWorld
+        should have written its changes first.
+        regions - list of (x, z) of the regions to load, by default all
+        processes - see mclevel.mapRegions
+    """
+    if regions is None:
+        regions = mclevel.listRegions(regionPath)
+    jobs = [(shareRegion, mclevel.regionPath(regionPath, x, z), (x, z))
+            for x, z in regions]
+    # the workers register their blocks with this process's tracker, which
+    # frees them if this process dies before they are unlinked
+    resource_tracker.ensure_running()
+    shared = []
+    error = None
+    results = mclevel.mapRegions(_call, jobs, processes)
+    # every block that was made has to be taken, even if a worker failed,
+    # so that none are left behind
+    for result, e in results:
+        if e is not None:
+            error = error or e
+        elif result is not None:
+            shared.append(SharedRegion(*result))
+    if error is not None:
+        for region in shared:
+            region.close()
+            region.unlink()
+        raise error
+    return SharedWorld(shared)
+
+def _call(func, *args):
+    """ -> (func(*args), None), or (None, exception) if it raised """
+    try:
+        return func(*args), None
+    except Exception as e:
+        return None, e
+
+def shareRegion(path, region):
+    """ Copy the sections of a region file into a new shared memory block.
+        -> (regionX, regionZ, name, slots, palettes) for SharedRegion, or
+        None if the region has no sections. The block stays registered
+        with the resource tracker until the caller unlinks it.
+    """
+    if not os.path.exists(path) or os.path.getsize(path) < 4096*2:
+        return None
+    sections = []
+    with open(path, mode='rb') as file:
+        header = mclevel.RegionHeader(region[0], region[1], file)
+        locations = header.getLocations()
+        for i in range(1024):
+            if locations[i] == (0, 0):
+                continue
+            x, z = region[0]*32 + (i & 31), region[1]*32 + (i >> 5)
+            chunk = mclevel.nbtToChunk(mclevel.readChunk(x, z, header))
+            for y, section in sorted(chunk.sections.items()):
+                sections.append(((x, z, y), section))
+    if not sections:
+        return None
+    memory = shared_memory.SharedMemory(create=True,
+                                        size=len(sections) * SLOT_SIZE)
+    slots = {}
+    palettes = {}
+    buf = memory.buf
+    for slot, (key, section) in enumerate(sections):
+        start = slot * SLOT_SIZE
+        buf[start:start + _IDS] = section.ids.tobytes()
+        start += _IDS
+        for part in (section.data, section.skyLight, section.blockLight):
+            buf[start:start + _NIBBLES] = part
+            start += _NIBBLES
+        slots[key] = slot
+        if section.palette is not None:
+            palettes[slot] = section.palette
+    del buf
+    memory.close()
+    return region[0], region[1], memory.name, slots, palettes
@@ -0,0 +1,92 @@
+import sys
+import os
+import os.path as path
+import shutil
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+import backup
+
+def chunkBytes(directory):
+    """ -> dict of (x, z) -> uncompressed NBT of every chunk on disk """
+    out = {}
+    for rx, rz in mclevel.listRegions(directory):
+        with open(mclevel.regionPath(directory, rx, rz), mode='rb') as file:
+            header = mclevel.RegionHeader(rx, rz, file)
+            for i, location in enumerate(header.getLocations()):
+                if location != (0, 0):
+                    x, z = rx*32 + (i & 31), rz*32 + (i >> 5)
+                    out[(x, z)] = mclevel.readChunkBytes(x, z, header)
+    return out
+
+def makeWorld(directory):
+    os.makedirs(directory)
+    world = mclevel.MinecraftWorld(directory)
+    for x in (0, 16, -600):
+        world.setBlock(x, 10, 0, mclevel.Block(1, 0))
+    world.writeAll()
+    world.close()
+
+def edit(directory):
+    """ Change chunk 0, 0, add chunk 3, 3 and remove chunk 1, 0 """
+    world = mclevel.MinecraftWorld(directory)
+    world.setBlock(0, 11, 0, mclevel.Block(4, 0))
+    world.setBlock(48, 10, 48, mclevel.Block(1, 0))
+    world.writeAll()
+    world.close()
+    with open(mclevel.regionPath(directory, 0, 0), mode='r+b') as file:
+        header = mclevel.RegionHeader(0, 0, file)
+        header.setChunkInfo(1, 0, 0, 0)
+        header.markUpdate(1, 0, 0)
+
+def testDiff():
+    with tempfile.TemporaryDirectory() as tmp:
+        a, b = path.join(tmp, 'a'), path.join(tmp, 'b')
+        makeWorld(a)
+        shutil.copytree(a, b)
+        assert backup.diff(a, b, processes=0) == []
+        edit(b)
+        # the edits may be within the same second as the copy
+        changes = backup.diff(a, b, checkAll=True, processes=0)
+        assert changes == [(0, 0, backup.CHANGED, None),
+                           (1, 0, backup.REMOVED, None),
+                           (3, 3, backup.ADDED, None)]
+        changes = backup.diff(a, b, semantic=True, checkAll=True,
+                              processes=0)
+        detail = changes[0][3]
+        assert '/Level/Sections' in ' '.join(detail)
+
+def testDeltaRoundTrip():
+    with tempfile.TemporaryDirectory() as tmp:
+        a, b = path.join(tmp, 'a'), path.join(tmp, 'b')
+        makeWorld(a)
+        shutil.copytree(a, b)
+        edit(b)
+        changes = backup.diff(a, b, checkAll=True, processes=0)
+        delta = path.join(tmp, 'delta')
+        assert backup.writeDelta(a, b, delta, changes) == 3
+        assert backup.applyDelta(delta, a) == 3
+        assert chunkBytes(a) == chunkBytes(b)
+        assert backup.diff(a, b, processes=0) == []
+        try:
+            backup.applyDelta(mclevel.regionPath(b, 0, 0), a)
+        except ValueError:
+            pass
+        else:
+            assert False, 'a region file was applied as a delta'
+
+def testBackupWorld():
+    with tempfile.TemporaryDirectory() as tmp:
+        world, mirror = path.join(tmp, 'world'), path.join(tmp, 'mirror')
+        makeWorld(world)
+        changes = backup.backupWorld(world, mirror, processes=0)
+        assert len(changes) == 3
+        assert chunkBytes(mirror) == chunkBytes(world)
+        assert backup.backupWorld(world, mirror, processes=0) == []
+        edit(world)
+        delta = path.join(tmp, 'delta')
+        changes = backup.backupWorld(world, mirror, delta, checkAll=True,
+                                     processes=0)
+        assert len(changes) == 3
+        assert chunkBytes(mirror) == chunkBytes(world)
@@ -0,0 +1,245 @@
+""" Benchmarks for the NBT, chunk and region code.
+
+    Every fixture (level.dat, chunks, region files) is generated on the fly,
+    so no Minecraft files are needed. Results are printed as JSON and may be
+    saved and compared against an earlier run:
+
+        python test/benchmark.py --save baseline.json
+        python test/benchmark.py --baseline baseline.json
+
+    Comparing exits with status 1 if any benchmark got slower by more than
+    --tolerance.
+"""
+import sys
+import os.path as path
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import argparse
+import contextlib
+import io
+import os
+import json
+import platform
+import random
+import shutil
+import tempfile
+import time
+import tracemalloc
+from array import array
+import nbt
+import mclevel
+
+ROOT = path.dirname(path.dirname(path.realpath(__file__)))
+
+def makeChunk(x, z, seed=0):
+    """ A chunk with stone up to y=60, some ores and a grass surface """
+    rand = random.Random(seed * 31 + x * 1031 + z)
+    chunk = mclevel.Chunk(x, z)
+    for sectionY in range(4):
+        ids = array('H', [1] * 4096)
+        for i in range(64):
+            ids[rand.randrange(4096)] = rand.choice((14, 15, 16, 56))
+        chunk.addSection(sectionY, mclevel.Section(ids))
+    for zz in range(16):
+        for xx in range(16):
+            chunk.setBlock(xx, 64, zz, mclevel.Block(2, 0))
+    chunk.fillBiome(1)
+    return chunk
+
+def makeLevel():
+    """ -> (level.dat NBT bytes, level.dat values) """
+    with open(path.join(ROOT, 'formats', 'level.dat.json')) as file:
+        values = json.load(file)
+    schema = nbt.loadSchema(path.join(ROOT, 'formats', 'level.tagtypes.json'))
+    return schema.encode(values), values
+
+def makeRegion(chunks):
+    """ -> bytes of region 0, 0 holding the first chunks chunks """
+    stream = io.BytesIO()
+    with mclevel.RegionWriter(0, 0, stream) as writer:
+        for i in range(chunks):
+            chunk = makeChunk(i & 31, i >> 5)
+            writer.writeChunk(mclevel.chunkToNbt(chunk))
+    return stream.getvalue()
+
+def tagBytes(tag):
+    stream = io.BytesIO()
+    nbt.NbtWriter(stream).write(tag)
+    return stream.getvalue()
+
+class Fixtures:
+    def __init__(self, chunks, workDir):
+        self.workDir = workDir
+        self.chunks = chunks
+        self.levelBytes, self.levelValues = makeLevel()
+        self.levelTag = nbt.NbtReader(io.BytesIO(self.levelBytes)).read()
+        self.chunk = makeChunk(0, 0)
+        self.chunkTag = mclevel.chunkToNbt(self.chunk)
+        self.chunkBytes = tagBytes(self.chunkTag)
+        self.region = makeRegion(chunks)
+        # one tag per chunk of the region, for writing them back
+        self.chunkTags = [mclevel.chunkToNbt(makeChunk(i & 31, i >> 5))
+                          for i in range(chunks)]
+        self.regionPath = path.join(workDir, 'region')
+        os.makedirs(self.regionPath)
+        with open(path.join(self.regionPath, 'r.0.0.mca'), 'wb') as file:
+            file.write(self.region)
+
+# every benchmark is a function (fixtures) -> bytes processed (or 0), and is
+# run repeatedly until it has taken enough time
+def benchReadLevel(f):
+    nbt.NbtReader(io.BytesIO(f.levelBytes)).read()
+    return len(f.levelBytes)
+
+def benchWriteLevel(f):
+    nbt.NbtWriter(io.BytesIO()).write(f.levelTag)
+    return len(f.levelBytes)
+
+def benchReadChunk(f):
+    nbt.NbtReader(io.BytesIO(f.chunkBytes)).read()
+    return len(f.chunkBytes)
+
+def benchWriteChunk(f):
+    nbt.NbtWriter(io.BytesIO()).write(f.chunkTag)
+    return len(f.chunkBytes)
+
+def benchNbtToChunk(f):
+    mclevel.nbtToChunk(f.chunkTag)
+    return 0
+
+def benchChunkToNbt(f):
+    f.chunk.heightmap = None
+    mclevel.chunkToNbt(f.chunk)
+    return 0
+
+def benchRegionRead(f):
+    header = mclevel.RegionHeader(0, 0, io.BytesIO(f.region))
+    for i in range(f.chunks):
+        mclevel.readChunk(i & 31, i >> 5, header)
+    return len(f.region)
+
+def benchRegionWrite(f):
+    header = mclevel.RegionHeader(0, 0, io.BytesIO(f.region))
+    written = 0
+    for tag in f.chunkTags:
+        zipped = mclevel.compressChunk(tag)
+        x, z = tag['Level']['xPos'].value, tag['Level']['zPos'].value
+        mclevel.writeCompressedChunk(x, z, zipped, header)
+        written += len(zipped)
+    return written
+
+def benchFillRegion(f):
+    worldPath = path.join(f.workDir, 'fill')
+    shutil.rmtree(worldPath, ignore_errors=True)
+    os.makedirs(worldPath)
+    with mclevel.MinecraftWorld(worldPath) as world:
+        world.fillRegion(0, 60, 0, 64, 4, 64, mclevel.Block(1, 0))
+        world.writeAll()
+    return 0
+
+def benchRegionScan(f):
+    world = mclevel.MinecraftWorld(f.regionPath)
+    world.findBlocks([56], processes=0)
+    world.closeAll()
+    return len(f.region)
+
+BENCHMARKS = [
+    ('nbt.read.level', benchReadLevel),
+    ('nbt.write.level', benchWriteLevel),
+    ('nbt.read.chunk', benchReadChunk),
+    ('nbt.write.chunk', benchWriteChunk),
+    ('chunk.nbtToChunk', benchNbtToChunk),
+    ('chunk.chunkToNbt', benchChunkToNbt),
+    ('region.readChunk', benchRegionRead),
+    ('region.writeChunk', benchRegionWrite),
+    ('world.fillRegion', benchFillRegion),
+    ('world.scan', benchRegionScan)
+]
+
+def measure(func, fixtures, minTime):
+    """ -> dict of results for one benchmark """
+    # a warm up run, which also tells us how many runs fit in minTime
+    start = time.perf_counter()
+    size = func(fixtures)
+    once = time.perf_counter() - start
+    runs = max(1, min(10000, int(minTime / max(once, 1e-9))))
+    start = time.perf_counter()
+    for i in range(runs):
+        func(fixtures)
+    seconds = (time.perf_counter() - start) / runs
+    # peak memory is measured separately since tracing slows everything down
+    tracemalloc.start()
+    func(fixtures)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {
+        'seconds': seconds,
+        'opsPerSecond': 1 / seconds,
+        'peakBytes': peak,
+        'runs': runs
+    }
+    if size:
+        result['mbPerSecond'] = size / seconds / 1024 / 1024
+    return result
+
+def compare(results, baseline, tolerance):
+    """ -> list of (name, ratio) of benchmarks slower than the baseline by
+        more than tolerance; ratio is new time / old time
+    """
+    slower = []
+    for name, result in results.items():
+        old = baseline.get('results', {}).get(name, None)
+        if old is None:
+            continue
+        ratio = result['seconds'] / old['seconds']
+        result['baselineRatio'] = ratio
+        if ratio > 1 + tolerance:
+            slower.append((name, ratio))
+    return slower
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--chunks', type=int, default=256,
+                        help='chunks in the generated region (max 1024)')
+    parser.add_argument('--min-time', type=float, default=0.5,
+                        help='seconds to spend timing each benchmark')
+    parser.add_argument('--only', default='',
+                        help='only run benchmarks starting with this')
+    parser.add_argument('--save', help='write the results to this file')
+    parser.add_argument('--baseline', help='compare against saved results')
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help='allowed slow down before failing, 0.15 = 15%%')
+    args = parser.parse_args(argv)
+
+    workDir = tempfile.mkdtemp(prefix='nbtbench')
+    # anything the library prints must not end up in the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            fixtures = Fixtures(min(args.chunks, 1024), workDir)
+            results = {}
+            for name, func in BENCHMARKS:
+                if name.startswith(args.only):
+                    results[name] = measure(func, fixtures, args.min_time)
+        finally:
+            shutil.rmtree(workDir, ignore_errors=True)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.time(),
+        'chunks': fixtures.chunks,
+        'results': results
+    }
+    slower = []
+    if args.baseline:
+        with open(args.baseline) as file:
+            slower = compare(results, json.load(file), args.tolerance)
+        report['regressions'] = dict(slower)
+    print(json.dumps(report, indent=4))
+    if args.save:
+        with open(args.save, mode='w') as file:
+            json.dump(report, file, indent=4)
+    return 1 if slower else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,32 @@
+import sys
+import os.path as path
+import contextlib
+import io
+import json
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import benchmark
+
+def testEveryBenchmarkRuns():
+    with tempfile.TemporaryDirectory() as tmp:
+        saved = path.join(tmp, 'baseline.json')
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            status = benchmark.main(['--chunks', '4', '--min-time', '0',
+                                     '--save', saved])
+        assert status == 0
+        report = json.loads(out.getvalue())
+        assert sorted(report['results']) == sorted(
+            name for name, func in benchmark.BENCHMARKS)
+        # benchRegionWrite reports the bytes of every chunk it wrote
+        assert report['results']['region.writeChunk']['mbPerSecond'] > 0
+        with open(saved) as file:
+            assert json.load(file)['chunks'] == 4
+
+def testCompareFindsRegressions():
+    baseline = {'results': {'a': {'seconds': 1.0}, 'b': {'seconds': 1.0}}}
+    results = {'a': {'seconds': 1.1}, 'b': {'seconds': 1.5},
+               'new': {'seconds': 9.0}}
+    assert benchmark.compare(results, baseline, 0.15) == [('b', 1.5)]
+    assert results['a']['baselineRatio'] == 1.1
@@ -0,0 +1,76 @@
+import sys
+import os.path as path
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+import chunkindex
+from benchmark import makeChunk, makeRegion
+
+def testIndexFollowsWrites():
+    with tempfile.TemporaryDirectory() as tmp:
+        index = chunkindex.ChunkIndex(tmp)
+        world = mclevel.MinecraftWorld(tmp, index=index)
+        world.setBlock(3, 100, 4, mclevel.Block(57, 0))
+        world.setBlock(20, 100, 4, mclevel.Block(57, 0))
+        world.setBlock(21, 100, 4, mclevel.Block(57, 0))
+        world.writeAll()
+        assert index.findBlock(57) == {(0, 0): 1, (1, 0): 2}
+        assert index.countBlock(57) == 3
+        index.close()
+
+def testRefreshRereadsChangedChunks():
+    with tempfile.TemporaryDirectory() as tmp:
+        regionFile = path.join(tmp, 'r.0.0.mca')
+        with open(regionFile, mode='wb') as file:
+            file.write(makeRegion(4))
+        with chunkindex.ChunkIndex(tmp) as index:
+            assert index.refresh() == 4
+            assert index.refresh() == 0
+            assert sorted(index.findBlock(2)) == [(0, 0), (1, 0), (2, 0),
+                                                  (3, 0)]
+            with open(regionFile, mode='r+b') as file:
+                header = mclevel.RegionHeader(0, 0, file)
+                timestamp = header.getChunkInfo(1, 0)[2]
+                chunk = makeChunk(1, 0)
+                chunk.setBlock(0, 100, 0, mclevel.Block(57, 0))
+                mclevel.writeChunk(mclevel.chunkToNbt(chunk), header)
+                header.markUpdate(1, 0, timestamp + 1)
+                # removed from the table
+                header.setChunkInfo(2, 0, 0, 0)
+            assert index.refresh() == 1
+            assert index.findBlock(57) == {(1, 0): 1}
+            assert (2, 0) not in index.findBlock(2)
+
+def testPaletteSectionsAreCountedByName():
+    chunk = mclevel.Chunk(0, 0, dataVersion=mclevel.FLATTENING_VERSION)
+    stone = mclevel.Block(None, 0, {'Name': 'minecraft:stone'})
+    for x in range(5):
+        chunk.setBlock(x, 1, 0, stone)
+    with tempfile.TemporaryDirectory() as tmp:
+        with chunkindex.ChunkIndex(tmp) as index:
+            index.updateChunk(chunk, 0)
+            assert index.findBlock('minecraft:stone') == {(0, 0): 5}
+            assert index.countBlock('minecraft:air') == 4096 - 5
+            # palette indices are not block ids
+            assert index.findBlock(1) == {}
+
+def testReplaceBlocksUpdatesIndex():
+    with tempfile.TemporaryDirectory() as tmp:
+        index = chunkindex.ChunkIndex(tmp)
+        world = mclevel.MinecraftWorld(tmp, index=index)
+        for x in range(6):
+            world.setBlock(x*9, 100, 3, mclevel.Block(54, 0))
+        world.writeAll()
+        index.refresh()
+        assert index.findBlock(54) == {(0, 0): 2, (1, 0): 2, (2, 0): 2}
+        # in the same second as the rows were made
+        assert world.replaceBlocks({54: mclevel.Block(55, 0)},
+                                   processes=0) == 6
+        assert index.findBlock(54) == {}
+        assert index.findBlock(55) == {(0, 0): 2, (1, 0): 2, (2, 0): 2}
+        assert index.countBlock(55) == 6
+        assert index.refresh() == 0
+        assert not index.query("SELECT x, z FROM chunks "
+                               "WHERE lightPopulated != 0")
+        index.close()
@@ -0,0 +1,82 @@
+import sys
+import os.path as path
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+import export
+from benchmark import makeRegion
+
+FIELDS = ('ids', 'data', 'skyLight', 'blockLight')
+
+def makeWorld(directory):
+    with open(mclevel.regionPath(directory, 0, 0), mode='wb') as file:
+        file.write(makeRegion(2))
+    world = mclevel.MinecraftWorld(directory)
+    world.setBlock(-3, 70, 5, mclevel.Block(35, 14))
+    world.writeAll()
+    world.close()
+
+def blockOffset(entry, x, y, z):
+    """ -> offset in an array file of block x, y, z of a region """
+    lx, lz = x - entry['x']*512, z - entry['z']*512
+    return entry['offset'] + ((y*512 + lz)*512 + lx)*2
+
+def testExportImportRoundTrip():
+    with tempfile.TemporaryDirectory() as tmp:
+        makeWorld(tmp)
+        out = path.join(tmp, 'export')
+        manifest = export.exportWorld(tmp, out, FIELDS, processes=0)
+        assert [(r['x'], r['z']) for r in manifest['regions']] == [
+            (-1, 0), (0, 0)]
+        with open(path.join(out, 'r.0.0.ids.npy'), mode='rb') as file:
+            assert file.read(6) == b'\x93NUMPY'
+        copy = path.join(tmp, 'copy')
+        # the two chunks of region 0, 0 and the wool
+        assert export.importWorld(out, copy, processes=0) == 3
+        original, imported = (mclevel.MinecraftWorld(d) for d in (tmp, copy))
+        for x, y, z in ((-3, 70, 5), (0, 64, 0), (31, 64, 15), (5, 30, 7)):
+            a, b = imported.getBlock(x, y, z), original.getBlock(x, y, z)
+            assert (a.id, a.data) == (b.id, b.data)
+        assert imported.getChunk(1, 0).lightPopulated == 0
+        original.close()
+        imported.close()
+
+def testUnchangedChunksAreNotWritten():
+    with tempfile.TemporaryDirectory() as tmp:
+        makeWorld(tmp)
+        out = path.join(tmp, 'export')
+        manifest = export.exportWorld(tmp, out, FIELDS, processes=0)
+        assert export.importWorld(out, tmp, processes=0) == 0
+        # change one block in the array
+        entry = [r for r in manifest['regions'] if r['x'] == -1][0]
+        with open(path.join(out, entry['files']['ids']), mode='r+b') as file:
+            file.seek(blockOffset(entry, -3, 70, 5))
+            file.write((1).to_bytes(2, 'little'))
+        assert export.importWorld(out, tmp, processes=0) == 1
+        world = mclevel.MinecraftWorld(tmp)
+        assert world.getBlock(-3, 70, 5).id == 1
+        world.close()
+
+def testPaletteSections():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp)
+        chunk = world.getChunk(0, 0)
+        chunk.dataVersion = mclevel.SPANNING_VERSION
+        for i, name in enumerate(('stone', 'dirt', 'stone')):
+            chunk.setBlock(i, 10, 0, mclevel.Block(
+                None, 0, {'Name': 'minecraft:' + name}))
+        world.writeAll()
+        world.close()
+        out = path.join(tmp, 'export')
+        manifest = export.exportWorld(tmp, out, processes=0)
+        assert manifest['regions'][0]['palette'] == [
+            {'Name': 'minecraft:air'}, {'Name': 'minecraft:stone'},
+            {'Name': 'minecraft:dirt'}]
+        assert export.importWorld(out, tmp, processes=0) == 0
+        copy = path.join(tmp, 'copy')
+        assert export.importWorld(out, copy, processes=0) == 1
+        world = mclevel.MinecraftWorld(copy)
+        assert world.getBlock(1, 10, 0).state == {'Name': 'minecraft:dirt'}
+        assert world.getBlock(2, 10, 0).state == {'Name': 'minecraft:stone'}
+        world.close()
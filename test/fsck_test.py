@@ -0,0 +1,97 @@
+import sys
+import os.path as path
+import gzip
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+import fsck
+from benchmark import makeChunk, makeRegion, tagBytes
+
+def writeRegion(tmp, chunks=4):
+    name = path.join(tmp, 'r.0.0.mca')
+    with open(name, mode='wb') as file:
+        file.write(makeRegion(chunks))
+    return name
+
+def readPos(file, x, z):
+    """ -> (xPos, zPos) read from chunk x, z, or None if it is missing """
+    header = mclevel.RegionHeader(0, 0, file)
+    if header.getChunkInfo(x, z)[0] is None:
+        return None
+    level = mclevel.readChunk(x, z, header)['Level']
+    return level['xPos'].value, level['zPos'].value
+
+def testSoundRegion():
+    with tempfile.TemporaryDirectory() as tmp:
+        report = fsck.checkRegion(writeRegion(tmp), decompress=True)
+        assert report.ok
+        assert report.chunks == 4
+
+def testProblemsAreFound():
+    with tempfile.TemporaryDirectory() as tmp:
+        name = writeRegion(tmp)
+        with open(name, mode='r+b') as file:
+            header = mclevel.RegionHeader(0, 0, file)
+            header.setChunkInfo(1, 0, 1, 1)
+            offset = header.getChunkInfo(2, 0)[0]
+            header.setChunkInfo(3, 0, 500, 1)
+            # garbage in place of chunk 2, 0
+            file.seek(offset * 4096 + 5)
+            file.write(b'\xff' * 64)
+        kinds = dict(((x, z), kind) for x, z, kind, detail
+                     in fsck.checkRegion(name, decompress=True).problems)
+        assert kinds == {(1, 0): fsck.IN_HEADER, (2, 0): fsck.BAD_DATA,
+                         (3, 0): fsck.PAST_END}
+        after = fsck.repairRegion(name)
+        assert after.ok
+        assert after.chunks == 1
+
+def testSharedSectorsGoToTheirOwner():
+    with tempfile.TemporaryDirectory() as tmp:
+        name = writeRegion(tmp)
+        with open(name, mode='r+b') as file:
+            header = mclevel.RegionHeader(0, 0, file)
+            offset, size, timestamp = header.getChunkInfo(1, 0)
+            # chunk 0, 0 comes first in the table, but the sectors hold 1, 0
+            header.setChunkInfo(0, 0, offset, size)
+        report = fsck.checkRegion(name, decompress=True)
+        assert [p[2] for p in report.problems] == [fsck.OVERLAP]
+        assert fsck.repairRegion(name, report).ok
+        with open(name, mode='rb') as file:
+            assert readPos(file, 0, 0) is None
+            assert readPos(file, 1, 0) == (1, 0)
+            assert readPos(file, 2, 0) == (2, 0)
+
+def testOverlappingGzipChunkIsKept():
+    with tempfile.TemporaryDirectory() as tmp:
+        name = writeRegion(tmp)
+        data = gzip.compress(tagBytes(mclevel.chunkToNbt(makeChunk(5, 0))))
+        with open(name, mode='r+b') as file:
+            header = mclevel.RegionHeader(0, 0, file)
+            # a gzip chunk at the end of the file, inside the sectors that
+            # chunk 3, 0 claims
+            file.seek(0, 2)
+            start = file.tell() // 4096
+            file.write((len(data) + 1).to_bytes(4, 'big') + b'\x01' + data)
+            file.write(b'\x00' * (4096 - file.tell() % 4096))
+            header.setChunkInfo(5, 0, start, file.tell() // 4096 - start)
+            offset, size, timestamp = header.getChunkInfo(3, 0)
+            header.setChunkInfo(3, 0, offset, start - offset + 1)
+        report = fsck.checkRegion(name, decompress=True)
+        assert [p[:3] for p in report.problems] == [(5, 0, fsck.OVERLAP)]
+        assert fsck.repairRegion(name, report).ok
+        with open(name, mode='rb') as file:
+            assert readPos(file, 3, 0) == (3, 0)
+            assert readPos(file, 5, 0) == (5, 0)
+
+def testCheckWorld():
+    with tempfile.TemporaryDirectory() as tmp:
+        writeRegion(tmp)
+        with open(path.join(tmp, 'r.1.0.mca'), mode='wb') as file:
+            file.write(b'\x00' * 100)
+        reports = sorted(fsck.checkWorld(tmp, processes=0),
+                         key=lambda r: r.x)
+        assert [r.ok for r in reports] == [True, False]
+        fsck.repairWorld(tmp, processes=0)
+        assert all(r.ok for r in fsck.checkWorld(tmp, processes=0))
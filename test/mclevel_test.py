@@ -1,11 +1,17 @@
 import sys
+import os
 import os.path as path
+import gzip
 import io
 import shutil
+import tempfile
+from array import array
 # add the parent directory
 sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
 import nbt
 import mclevel
+from benchmark import makeChunk, makeRegion, tagBytes
+from util import stats
 
 def readIntoJSON(x, z):
     print('# Reading demo #')
@@ -97,8 +103,454 @@ def stripChunk():
         c.stripBlock(Block(1, 0))
         c.stripBlock(Block(7, 0))
 
-editorTest()
-readIntoJSON(0, 0)
-editDemo()
-airChunk(0, 1)
-seekTest()
\ No newline at end of file
+# Regression tests, run with pytest. Unlike the demos above they make their
+# own chunks and worlds, in a temporary directory.
+
+def roundTrip(chunk):
+    """ -> chunk after being written to and read back from NBT """
+    stream = io.BytesIO(tagBytes(mclevel.chunkToNbt(chunk)))
+    return mclevel.nbtToChunk(nbt.NbtReader(stream).read())
+
+def testSectionRoundTrip():
+    chunk = makeChunk(3, -2)
+    # ids above 255 go through the Add nibbles
+    chunk.setBlock(1, 2, 3, mclevel.Block(300, 5))
+    chunk.setBlock(15, 63, 15, mclevel.Block(4095, 15))
+    read = roundTrip(chunk)
+    assert sorted(read.sections) == sorted(chunk.sections)
+    for y, section in chunk.sections.items():
+        assert list(read.sections[y].ids) == list(section.ids)
+        assert bytes(read.sections[y].data) == bytes(section.data)
+    assert read.getBlock(1, 2, 3).id == 300
+    assert read.getBlock(1, 2, 3).data == 5
+    assert read.getBlock(15, 63, 15).id == 4095
+
+def testHeightmapFollowsSetBlock():
+    chunk = makeChunk(0, 0)
+    assert chunk.getHeightmap()[0] == 64
+    chunk.setBlock(0, 100, 0, mclevel.Block(1, 0))
+    chunk.setBlock(5, 64, 0, mclevel.Block(0, 0))
+    chunk.setBlock(0, 100, 0, mclevel.Block(0, 0))
+    incremental = list(chunk.getHeightmap())
+    chunk.heightmap = None
+    assert incremental == chunk.genHeightmap()
+    assert incremental[5] == 63
+
+def testStoredHeightmapIsNotTrusted():
+    chunk = makeChunk(0, 0)
+    tag = mclevel.chunkToNbt(chunk)
+    # the game stores the y above the top block
+    tag['Level']['HeightMap'].value = [65] * 256
+    read = mclevel.nbtToChunk(tag)
+    read.setBlock(0, 64, 0, mclevel.Block(0, 0))
+    assert read.getHeightmap()[0] == 63
+    assert read.getHeightmap()[1] == 64
+
+def testEvictionKeepsEditedChunks():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp)
+        world.maxChunks = 3
+        blocks = [(cx*16 + 1, 5, cz*16 + 2) for cx in range(4)
+                  for cz in range(3)]
+        for x, y, z in blocks * 2:
+            world.setBlock(x, y, z, mclevel.Block(1, 0))
+        world.writeAll()
+        world = mclevel.MinecraftWorld(tmp)
+        for x, y, z in blocks:
+            assert world.getBlock(x, y, z).id == 1
+
+def lightAt(chunk, x, y, z, kind='skyLight'):
+    section = chunk.sections[y//16]
+    return getattr(section, kind)[(y & 15)*256 + z*16 + x]
+
+def testSkyLight():
+    chunk = makeChunk(0, 0)
+    chunk.addSection(4, mclevel.Section())
+    chunk.setBlock(0, 64, 0, mclevel.Block(2, 0))
+    mclevel.lightChunks({(0, 0): chunk})
+    assert lightAt(chunk, 3, 70, 3) == 15
+    assert lightAt(chunk, 3, 63, 3) == 0
+
+def testBlockLightCrossesChunks():
+    chunks = {(0, 0): makeChunk(0, 0), (1, 0): makeChunk(1, 0)}
+    # a tunnel of air along x at y=30, z=8, with a torch at its west end
+    for x in range(14, 20):
+        c = chunks[(x//16, 0)]
+        c.setBlock(x & 15, 30, 8, mclevel.Block(0, 0))
+    chunks[(0, 0)].setBlock(14, 30, 8, mclevel.Block(50, 0))
+    mclevel.lightChunks(chunks)
+    assert lightAt(chunks[(0, 0)], 14, 30, 8, 'blockLight') == 14
+    assert lightAt(chunks[(0, 0)], 15, 30, 8, 'blockLight') == 13
+    assert lightAt(chunks[(1, 0)], 3, 30, 8, 'blockLight') == 9
+    # stone around the tunnel stays dark
+    assert lightAt(chunks[(1, 0)], 3, 31, 8, 'blockLight') == 0
+
+def testRelightClearsDirtyChunks():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp)
+        world.setBlock(8, 70, 8, mclevel.Block(89, 0))
+        assert (0, 0) in world.lightDirty
+        world.relight()
+        assert not world.lightDirty
+        chunk = world.getChunk(0, 0)
+        assert lightAt(chunk, 8, 71, 8, 'blockLight') == 14
+
+def testRegionWriterRejectsDuplicates():
+    stream = io.BytesIO()
+    with mclevel.RegionWriter(0, 0, stream) as writer:
+        writer.writeChunk(mclevel.chunkToNbt(makeChunk(1, 1)))
+        try:
+            writer.writeChunk(mclevel.chunkToNbt(makeChunk(1, 1)))
+        except ValueError:
+            pass
+        else:
+            assert False, 'a chunk was written twice'
+    header = mclevel.RegionHeader(0, 0, stream)
+    chunk = mclevel.nbtToChunk(mclevel.readChunk(1, 1, header))
+    assert chunk.getBlock(0, 64, 0).id == 2
+
+def testFindAndReplaceBlocks():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp)
+        world.setBlock(5, 80, 5, mclevel.Block(54, 2))
+        world.setBlock(-40, 10, 600, mclevel.Block(54, 3))
+        world.setBlock(6, 80, 5, mclevel.Block(300, 0))
+        found = sorted(world.findBlocks([54, 300], processes=0))
+        assert found == [(-40, 10, 600, 54), (5, 80, 5, 54), (6, 80, 5, 300)]
+        assert world.replaceBlocks({54: mclevel.Block(1, 0)},
+                                   processes=0) == 2
+        assert world.findBlocks([54], processes=0) == []
+        assert world.getBlock(5, 80, 5).id == 1
+        assert world.getBlock(6, 80, 5).id == 300
+
+def testRegionFileNames():
+    assert mclevel.regionCoords(mclevel.regionPath('dir', -3, 12)) == (-3, 12)
+    try:
+        mclevel.regionCoords('level.dat')
+    except ValueError:
+        pass
+    else:
+        assert False, 'level.dat is not a region'
+
+def pig(x, z):
+    return {
+        'id': nbt.Tag('TAG_String', 'id', 'Pig'),
+        'Pos': nbt.Tag('TAG_List', 'Pos', [x, 64.0, z], nbt.Tag.TAG_Double)
+    }
+
+def chest(x, z):
+    return dict((name, nbt.Tag('TAG_Int', name, v))
+                for name, v in (('x', x), ('y', 64), ('z', z)))
+
+def entityWorld(tmp):
+    """ -> world with a pig in chunk 0, 0, a chest in chunk 1, 0 and
+        plain chunks around them, all written to disk
+    """
+    world = mclevel.MinecraftWorld(tmp)
+    world.getChunk(0, 0).entities.append(pig(3.5, 4.5))
+    world.setTileEntity(chest(20, 2))
+    for x in range(-1, 4):
+        world.setBlock(x*16, 1, 20, mclevel.Block(1, 0))
+    world.writeAll()
+    world.close()
+    return mclevel.MinecraftWorld(tmp)
+
+def countReads(func):
+    """ -> (func(), number of chunks decompressed on the way) """
+    decompress = mclevel.decompressChunk
+    reads = []
+    def counting(*args):
+        reads.append(args)
+        return decompress(*args)
+    mclevel.decompressChunk = counting
+    try:
+        return func(), len(reads)
+    finally:
+        mclevel.decompressChunk = decompress
+
+def testEntitiesInBox():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = entityWorld(tmp)
+        found, reads = countReads(
+            lambda: world.entitiesInBox(-16, 0, 0, 48, 256, 32))
+        assert [e['Pos'].value for e in found] == [[3.5, 64.0, 4.5]]
+        # only the six chunks on disk in the box were read, and none were
+        # cached
+        assert reads == 6
+        assert world.chunkCache == {}
+        assert len(world._entityIndex) == 8
+        # now only the chunk with a chest in the box is read again
+        found, reads = countReads(
+            lambda: world.tileEntitiesInBox(-16, 0, 0, 48, 256, 32))
+        assert [t['x'].value for t in found] == [20]
+        assert reads == 1
+        found, reads = countReads(
+            lambda: world.entitiesInBox(4, 0, 0, 16, 256, 16))
+        assert (found, reads) == ([], 0)
+
+def testRemoveEntitiesUpdatesIndex():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = entityWorld(tmp)
+        assert world.entitiesInBox(0, 0, 0, 16, 256, 16) != []
+        assert world.removeEntities(0, 0, 0, 16, 256, 16) == 1
+        assert world.removeTileEntities(16, 0, 0, 32, 256, 16) == 1
+        world.writeAll()
+        world.clearCache()
+        assert world._entityIndex[(0, 0)] == ([], [])
+        found, reads = countReads(
+            lambda: world.entitiesInBox(0, 0, 0, 32, 256, 16)
+                    + world.tileEntitiesInBox(0, 0, 0, 32, 256, 16))
+        assert (found, reads) == ([], 0)
+
+def testEntitiesWaitingToBeWritten():
+    with tempfile.TemporaryDirectory() as tmp:
+        entityWorld(tmp).close()
+        world = mclevel.MinecraftWorld(tmp, writeBehind=True)
+        world.maxChunks = 1
+        assert world.removeEntities(0, 0, 0, 16, 256, 16) == 1
+        # evicted to the background writer, which is newer than the disk
+        world.getChunk(5, 5)
+        assert world.entitiesInBox(0, 0, 0, 16, 256, 16) == []
+        world.getChunk(5, 5)
+        world.flush()
+        assert (0, 0) not in world.chunkCache
+        assert world._entityIndex[(0, 0)] == ([], [])
+        found, reads = countReads(
+            lambda: world.entitiesInBox(0, 0, 0, 16, 256, 16))
+        assert (found, reads) == ([], 0)
+        world.close()
+
+def chunkBytes(directory):
+    """ -> dict of (x, z) -> uncompressed NBT of every chunk on disk """
+    out = {}
+    for rx, rz in mclevel.listRegions(directory):
+        with open(mclevel.regionPath(directory, rx, rz), mode='rb') as file:
+            header = mclevel.RegionHeader(rx, rz, file)
+            for i, location in enumerate(header.getLocations()):
+                if location != (0, 0):
+                    x, z = rx*32 + (i & 31), rz*32 + (i >> 5)
+                    out[(x, z)] = mclevel.readChunkBytes(x, z, header)
+    return out
+
+def edit(world):
+    world.maxChunks = 4
+    for i in range(200):
+        x, z = (i * 37) % 300 - 150, (i * 91) % 200 - 100
+        world.setBlock(x, i % 128, z, mclevel.Block(1 + i % 5, 0))
+    world.writeAll()
+    world.close()
+
+def testWriteBehindWritesTheSameChunks():
+    with tempfile.TemporaryDirectory() as sync, \
+            tempfile.TemporaryDirectory() as behind:
+        edit(mclevel.MinecraftWorld(sync))
+        edit(mclevel.MinecraftWorld(behind, writeBehind=True, maxPending=3))
+        written = chunkBytes(sync)
+        assert len(written) > 4
+        assert chunkBytes(behind) == written
+
+def testEvictedChunksAreReclaimed():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp, writeBehind=True)
+        world.maxChunks = 1
+        chunk = world.getChunk(0, 0)
+        chunk.setBlock(0, 0, 0, mclevel.Block(7, 0))
+        world.getChunk(1, 0)
+        # either still queued, and taken back as it is, or written first
+        assert world.getChunk(0, 0).getBlock(0, 0, 0).id == 7
+        world.writeAll()
+        world.close()
+        assert mclevel.MinecraftWorld(tmp).getBlock(0, 0, 0).id == 7
+
+def prefetchStats(func):
+    """ -> (func(), prefetchHits) """
+    stats.reset()
+    stats.enable()
+    try:
+        result = func()
+        return result, stats.snapshot()['counters'].get('prefetchHits', 0)
+    finally:
+        stats.disable()
+        stats.reset()
+
+def testPrefetchHints():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(mclevel.regionPath(tmp, 0, 0), mode='wb') as file:
+            file.write(makeRegion(8))
+        world = mclevel.MinecraftWorld(tmp, prefetchWorkers=2)
+        def scan():
+            world.prefetch(0, 0, 8, 1)
+            return [world.getChunk(x, 0) for x in range(8)]
+        chunks, hits = prefetchStats(scan)
+        assert hits == 8
+        for x, chunk in enumerate(chunks):
+            assert chunk.sections[0].ids == makeChunk(x, 0).sections[0].ids
+        world.close()
+
+def testPrefetchFollowsStrides():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(mclevel.regionPath(tmp, 0, 0), mode='wb') as file:
+            file.write(makeRegion(16))
+        world = mclevel.MinecraftWorld(tmp, prefetchWorkers=1, readAhead=2)
+        def scan():
+            return [world.getChunk(x, 0) for x in range(0, 16, 2)]
+        chunks, hits = prefetchStats(scan)
+        # the third miss finds the pattern, the chunks after it are ahead
+        assert hits == 5
+        assert chunks[-1].sections[0].ids == makeChunk(14, 0).sections[0].ids
+        world.close()
+
+def testRegionPoolClosesLeastRecentlyUsed():
+    with tempfile.TemporaryDirectory() as tmp:
+        pool = mclevel.RegionPool(maxOpen=2)
+        paths = [mclevel.regionPath(tmp, x, 0) for x in range(3)]
+        # reading does not create files
+        assert pool.get(paths[0], 0, 0) is None
+        assert not path.exists(paths[0])
+        for x in range(2):
+            pool.get(paths[x], x, 0, write=True)
+        pool.get(paths[0], 0, 0)
+        pool.get(paths[2], 2, 0, write=True)
+        assert pool.listOpen(tmp) == [path.abspath(p) for p in
+                                      (paths[0], paths[2])]
+        pool.closeAll(tmp)
+        assert pool.listOpen() == []
+
+def testWorldsShareAPool():
+    with tempfile.TemporaryDirectory() as a, \
+            tempfile.TemporaryDirectory() as b:
+        pool = mclevel.RegionPool(maxOpen=1)
+        worlds = [mclevel.MinecraftWorld(d, pool=pool) for d in (a, b)]
+        for i, world in enumerate(worlds):
+            world.setBlock(0, 0, 0, mclevel.Block(i + 1, 0))
+            world.writeAll()
+        assert len(pool.listOpen()) == 1
+        for i, world in enumerate(worlds):
+            world.clearCache()
+            assert world.getBlock(0, 0, 0).id == i + 1
+            world.close()
+
+def testLookingDoesNotCreateRegions():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp)
+        assert world.getBlock(40, 10, 40) is None
+        world.writeAll()
+        assert mclevel.listRegions(tmp) == []
+        world.setBlock(40, 10, 40, mclevel.Block(1, 0))
+        world.writeAll()
+        assert mclevel.listRegions(tmp) == [(0, 0)]
+        world.close()
+
+def levelBytes(directory):
+    with gzip.open(path.join(directory, 'level.dat')) as file:
+        return file.read()
+
+def testLevelIsOpenedLazily():
+    with tempfile.TemporaryDirectory() as tmp:
+        level = mclevel.MinecraftLevel(path.join(tmp, 'level'))
+        assert os.listdir(level.path) == []
+        level.nether.setBlock(0, 0, 0, mclevel.Block(87, 0))
+        assert os.listdir(level.path) == ['DIM-1']
+        assert level.getDimension('nether') is level.nether
+        level.levelOptions['RandomSeed'] = 42
+        level.writeAll()
+        assert sorted(os.listdir(level.path)) == ['DIM-1', 'level.dat']
+        level.__exit__(None, None, None)
+        level = mclevel.MinecraftLevel(level.path)
+        assert level.levelOptions['RandomSeed'] == 42
+        assert level.nether.getBlock(0, 0, 0).id == 87
+        level.__exit__(None, None, None)
+
+def testLevelDatIsPatched():
+    with tempfile.TemporaryDirectory() as tmp:
+        mclevel.MinecraftLevel(tmp).writeLevelOptions()
+        original = levelBytes(tmp)
+        # a tag the schema does not know about, at the end of Data
+        root, spans = mclevel._readLevel(original)
+        extra = b'\x01' + (6).to_bytes(2, 'big') + b'Modded' + b'\x01'
+        with gzip.open(path.join(tmp, 'level.dat'), mode='wb') as file:
+            file.write(original[:spans[None]] + extra
+                       + original[spans[None]:])
+        modified = levelBytes(tmp)
+        level = mclevel.MinecraftLevel(tmp)
+        assert level.levelOptions['Modded'] == 1
+        # nothing changed, nothing is written
+        os.remove(path.join(tmp, 'level.dat'))
+        level.writeLevelOptions()
+        assert not path.exists(path.join(tmp, 'level.dat'))
+        level.levelOptions['Time'] = 1 << 40
+        level.writeLevelOptions()
+        patched = levelBytes(tmp)
+        assert len(patched) == len(modified)
+        # only the payload of Time differs
+        differ = [i for i in range(len(patched)) if patched[i] != modified[i]]
+        start, end = spans['Time'][:2]
+        assert differ and start <= differ[0] and differ[-1] < end
+        level = mclevel.MinecraftLevel(tmp)
+        assert level.levelOptions['Time'] == 1 << 40
+        assert level.levelOptions['Modded'] == 1
+
+def paletteChunk(dataVersion=mclevel.SPANNING_VERSION - 1):
+    chunk = mclevel.Chunk(0, 0, dataVersion=dataVersion)
+    # 17 states need 5 bits, which do not divide 64
+    for i in range(17):
+        chunk.setBlock(i % 16, i, 3, mclevel.Block(None, 0, {
+            'Name': 'minecraft:wool', 'Properties': {'color': str(i)}}))
+    return chunk
+
+def testBlockStatePacking():
+    ids = array('H', [(i * 7) % 17 for i in range(4096)])
+    for spanning in (True, False):
+        packed = mclevel.packBlockStates(ids, 5, spanning)
+        assert all(-(1 << 63) <= v < 1 << 63 for v in packed)
+        assert mclevel.unpackBlockStates(packed, 5, spanning=spanning) == ids
+    # 64 // 5 entries per long when entries do not span longs
+    assert len(mclevel.packBlockStates(ids, 5, False)) == -(-4096 // 12)
+    assert len(mclevel.packBlockStates(ids, 5, True)) == 4096 * 5 // 64
+    try:
+        mclevel.packBlockStates(ids, 4)
+    except ValueError:
+        pass
+    else:
+        assert False, 'indices were packed into too few bits'
+
+def testPaletteChunkRoundTrip():
+    for version in (mclevel.SPANNING_VERSION - 1, mclevel.SPANNING_VERSION):
+        chunk = paletteChunk(version)
+        tag = mclevel.chunkToNbt(chunk)
+        section = tag['Level']['Sections'].value[0]
+        assert section['BlockStates'].id == nbt.Tag.TAG_Long_Array
+        assert 'Blocks' not in section
+        read = roundTrip(chunk)
+        assert read.dataVersion == version
+        for i in range(17):
+            block = read.getBlock(i % 16, i, 3)
+            assert block.id is None
+            assert block.state['Properties']['color'] == str(i)
+        assert read.getBlock(0, 0, 0).state == {'Name': 'minecraft:air'}
+
+def testPaletteSectionsNeedStates():
+    chunk = paletteChunk()
+    try:
+        chunk.setBlock(0, 0, 0, mclevel.Block(1, 0))
+    except ValueError:
+        pass
+    else:
+        assert False, 'a block id was put in a palette section'
+    # air counts as empty for the heightmap
+    assert chunk.getHeightmap()[3*16] == 16
+    assert chunk.getHeightmap()[3*16 + 1] == 1
+    assert chunk.getHeightmap()[0] == 0
+    try:
+        mclevel.lightChunks({(0, 0): chunk})
+    except ValueError:
+        pass
+    else:
+        assert False, 'light was computed from palette indices'
+
+if __name__ == '__main__':
+    editorTest()
+    readIntoJSON(0, 0)
+    editDemo()
+    airChunk(0, 1)
+    seekTest()
@@ -5,6 +5,11 @@ sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
 import nbt
 import io
 import gzip
+import json
+import os
+import tempfile
+import tracemalloc
+from benchmark import tagBytes
 
 def read():
     nbt.toJson('nbt/level.dat', 'json', gzipped=False)
@@ -18,5 +23,161 @@ def write():
     stream.seek(0)
     with open('out.dat', mode='wb') as file:
        file.write(gzip.compress(stream.read()))
-       
-write()
\ No newline at end of file
+
+# Regression tests, run with pytest. Unlike the demos above they make their
+# own NBT.
+
+def entity(i):
+    return {
+        'id': nbt.Tag('TAG_String', 'id', 'Pig'),
+        'Pos': nbt.Tag('TAG_List', 'Pos', [i + 0.5, 64.0, -i - 0.25],
+                       nbt.Tag.TAG_Double),
+        'UUIDMost': nbt.Tag('TAG_Long', 'UUIDMost', -(1 << 63) + i),
+        'Data': nbt.Tag('TAG_Int_Array', 'Data', [i, -i, 1 << 30])
+    }
+
+def sampleTag(entities=3):
+    return nbt.Tag('TAG_Compound', '', [
+        nbt.Tag('TAG_Byte', 'byte', -5),
+        nbt.Tag('TAG_Short', 'short', 30000),
+        nbt.Tag('TAG_Float', 'float', 0.5),
+        nbt.Tag('TAG_String', 'unicode', 'café ☃'),
+        # longer than a signed short can hold
+        nbt.Tag('TAG_String', 'long', 'x' * 40000),
+        nbt.Tag('TAG_Byte_Array', 'bytes', [-128, 0, 127]),
+        nbt.Tag('TAG_Long_Array', 'longs', [1 << 62, -1]),
+        nbt.Tag('TAG_List', 'empty', [], nbt.Tag.TAG_End),
+        nbt.Tag('TAG_List', 'Entities',
+                [entity(i) for i in range(entities)], nbt.Tag.TAG_Compound),
+        nbt.Tag('TAG_Compound', 'nested', [
+            nbt.Tag('TAG_Long', 'big', (1 << 63) - 1)])
+    ])
+
+def toJsonText(data):
+    values, types = io.StringIO(), io.StringIO()
+    nbt.streamToJson(io.BytesIO(data), values, types)
+    return values.getvalue(), json.loads(types.getvalue())
+
+def testJsonRoundTrip():
+    data = tagBytes(sampleTag())
+    values, types = toJsonText(data)
+    out = io.BytesIO()
+    nbt.jsonToStream(io.StringIO(values), types, out)
+    assert out.getvalue() == data
+    assert nbt.NbtReader(io.BytesIO(data)).read()['long'].value == 'x' * 40000
+
+def testJsonListLengthIsPatched():
+    data = tagBytes(sampleTag(5000))
+    values, types = toJsonText(data)
+    # one entry for every element is the usual form; a single entry for the
+    # whole list is also understood
+    del types['Entities'][1:]
+    with tempfile.TemporaryFile() as file:
+        nbt.jsonToStream(io.StringIO(values), types, file)
+        file.seek(0)
+        assert file.read() == data
+    # a stream that can not seek back
+    with tempfile.TemporaryFile() as file:
+        with gzip.GzipFile(fileobj=file, mode='wb') as zipped:
+            nbt.jsonToStream(io.StringIO(values), types, zipped)
+        file.seek(0)
+        assert gzip.decompress(file.read()) == data
+
+def testJsonToStreamMemoryIsBounded():
+    data = tagBytes(sampleTag(40000))
+    values, types = toJsonText(data)
+    values = io.StringIO(values)
+    with tempfile.TemporaryFile() as file:
+        tracemalloc.start()
+        try:
+            nbt.jsonToStream(values, types, file)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        assert file.tell() == len(data)
+    # the list of entities alone is several megabytes
+    assert len(data) > 3 << 20
+    assert peak < 1 << 20
+
+def testSchemaEncodesLikeNbtWriter():
+    tag = sampleTag()
+    data = tagBytes(tag)
+    schema = nbt.compileSchema(toJsonText(data)[1])
+    assert schema.encode(tag.pythonify()) == data
+    try:
+        schema.encode({'unknown': 1})
+    except ValueError:
+        pass
+    else:
+        assert False, 'a key missing from tagtypes was encoded'
+
+def testLevelSchema():
+    root = path.dirname(path.dirname(path.realpath(__file__)))
+    schema = nbt.loadSchema(path.join(root, 'formats', 'level.tagtypes.json'))
+    with open(path.join(root, 'formats', 'level.dat.json')) as file:
+        values = json.load(file)
+    read = nbt.NbtReader(io.BytesIO(schema.encode(values))).read()
+    assert read.pythonify() == values
+
+def testLoadSchemaIsCached():
+    with tempfile.TemporaryDirectory() as tmp:
+        name = path.join(tmp, 'a.tagtypes.json')
+        with open(name, mode='w') as file:
+            json.dump({'a': 'TAG_Int'}, file)
+        schema = nbt.loadSchema(name)
+        assert nbt.loadSchema(name) is schema
+        with open(name, mode='w') as file:
+            json.dump({'a': 'TAG_Short'}, file)
+        # a changed file is compiled again
+        os.utime(name, (0, 1))
+        assert nbt.loadSchema(name).encode({'a': 1}) == (
+            b'\x0a\x00\x00\x02\x00\x01a\x00\x01\x00')
+
+def testProfilingReader():
+    data = tagBytes(sampleTag())
+    reader = nbt.ProfilingReader(io.BytesIO(data))
+    tag = reader.read()
+    assert tagBytes(tag) == data
+    profile = reader.profile
+    assert profile.paths['Entities/*/Pos'][0] == 3
+    assert profile.paths['Entities/*/Pos/*'][0] == 9
+    assert profile.types['TAG_Double'][0] == 9
+    # the root compound is everything after its own header, and the self
+    # values add up to it without counting anything twice
+    root = profile.paths['/']
+    assert root[1] == len(data) - 3
+    assert sum(v[3] for v in profile.types.values()) == root[1]
+    assert sum(v[3] for v in profile.paths.values()) == root[1]
+    assert profile.paths['long'][1:4:2] == [2 + 40000, 2 + 40000]
+
+def testProfilingWriter():
+    tag = sampleTag()
+    stream = io.BytesIO()
+    writer = nbt.ProfilingWriter(stream)
+    writer.write(tag)
+    assert stream.getvalue() == tagBytes(tag)
+    reader = nbt.ProfilingReader(io.BytesIO(stream.getvalue()))
+    reader.read()
+    counts = lambda profile: dict((k, v[:2]) for k, v in
+                                  profile.paths.items())
+    assert counts(writer.profile) == counts(reader.profile)
+
+def testProfileReport():
+    with tempfile.TemporaryDirectory() as tmp:
+        fileName = path.join(tmp, 'sample.dat')
+        with open(fileName, mode='wb') as file:
+            file.write(gzip.compress(tagBytes(sampleTag())))
+        tag, profile = nbt.profileFile(fileName)
+    assert tag['nested']['big'].value == (1 << 63) - 1
+    lines = profile.report(by='types', sort='selfBytes', limit=3).split('\n')
+    assert lines[0].split() == ['types'] + list(nbt.NbtProfile.columns)
+    assert len(lines) == 4
+    # the long string is the largest payload of its own
+    assert lines[1].split()[0] == 'TAG_String'
+    sizes = [int(line.split()[4]) for line in lines[1:]]
+    assert sizes == sorted(sizes, reverse=True)
+    assert len(profile.report(limit=None).split('\n')) == \
+        len(profile.paths) + 1
+
+if __name__ == '__main__':
+    write()
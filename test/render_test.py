@@ -0,0 +1,76 @@
+import sys
+import os.path as path
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+import render
+from benchmark import makeRegion
+
+def pixel(rgb, x, z):
+    i = (z*512 + x)*3
+    return tuple(rgb[i:i + 3])
+
+def colour(id, shade=1):
+    tables = render.colourTables()
+    return tuple(tables[shade][channel][id] for channel in range(3))
+
+def testRenderRegion():
+    with tempfile.TemporaryDirectory() as tmp:
+        regionFile = mclevel.regionPath(tmp, 0, 0)
+        with open(regionFile, mode='wb') as file:
+            file.write(makeRegion(2))
+        output = path.join(tmp, 'tile.rgb')
+        render.renderRegion(regionFile, output, format='raw')
+        with open(output, mode='rb') as file:
+            rgb = file.read()
+        assert len(rgb) == 512*512*3
+        # grass on top of the two chunks, nothing elsewhere
+        assert pixel(rgb, 0, 0) == colour(2)
+        assert pixel(rgb, 31, 15) == colour(2)
+        assert pixel(rgb, 32, 0) == (0, 0, 0)
+        assert pixel(rgb, 0, 16) == (0, 0, 0)
+
+def testPaletteChunksAreRendered():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp)
+        chunk = world.getChunk(0, 0)
+        chunk.dataVersion = mclevel.SPANNING_VERSION
+        for x in range(16):
+            chunk.setBlock(x, 70, 0, mclevel.Block(
+                None, 0, {'Name': 'minecraft:grass_block'}))
+            chunk.setBlock(x, 10, 1, mclevel.Block(
+                None, 0, {'Name': 'minecraft:stone'}))
+        world.writeAll()
+        world.close()
+        output = path.join(tmp, 'tile.rgb')
+        render.renderRegion(mclevel.regionPath(tmp, 0, 0), output,
+                            format='raw')
+        with open(output, mode='rb') as file:
+            rgb = file.read()
+        assert pixel(rgb, 5, 0) == colour(render.stateId(
+            'minecraft:grass_block'))
+        # much lower than the row to its north
+        assert pixel(rgb, 5, 1) == colour(1, shade=0)
+
+def testRenderWorldSkipsUnchangedRegions():
+    with tempfile.TemporaryDirectory() as tmp:
+        world = mclevel.MinecraftWorld(tmp)
+        world.setBlock(0, 0, 0, mclevel.Block(1, 0))
+        world.setBlock(-600, 0, 0, mclevel.Block(1, 0))
+        world.writeAll()
+        world.clearCache()
+        tiles = path.join(tmp, 'tiles')
+        assert sorted(render.renderWorld(tmp, tiles, processes=0)) == [
+            (-2, 0), (0, 0)]
+        with open(path.join(tiles, 'r.0.0.png'), mode='rb') as file:
+            assert file.read(8) == b'\x89PNG\r\n\x1a\n'
+        # nothing to render, without starting any worker processes
+        assert render.renderWorld(tmp, tiles) == []
+        # rewritten in place, likely within the same second
+        world.setBlock(1, 0, 0, mclevel.Block(1, 0))
+        world.writeAll()
+        world.close()
+        assert render.renderWorld(tmp, tiles, processes=0) == [(0, 0)]
+        assert len(render.renderWorld(tmp, tiles, processes=0,
+                                      force=True)) == 2
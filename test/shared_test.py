@@ -0,0 +1,71 @@
+import sys
+import os
+import os.path as path
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+import shared
+from benchmark import makeChunk, makeRegion
+
+def sharedBlocks():
+    """ -> names of the shared memory blocks that exist, where they can be
+        listed
+    """
+    if not path.isdir('/dev/shm'):
+        return set()
+    return set(os.listdir('/dev/shm'))
+
+def testLoadWorld():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(mclevel.regionPath(tmp, 0, 0), mode='wb') as file:
+            file.write(makeRegion(3))
+        world = mclevel.MinecraftWorld(tmp)
+        world.setBlock(-1, 5, -1, mclevel.Block(7, 0))
+        world.writeAll()
+        world.close()
+        with shared.loadWorld(tmp, processes=0) as loaded:
+            assert sorted(loaded.regions) == [(-1, -1), (0, 0)]
+            assert len(list(loaded.sections())) == 3*5 + 1
+            for x in range(3):
+                expected = makeChunk(x, 0)
+                for y, section in expected.sections.items():
+                    got = loaded.getSection(x, 0, y)
+                    assert got.ids.tobytes() == section.ids.tobytes()
+                    assert bytes(got.data) == bytes(section.data)
+            assert loaded.getSection(-1, -1, 0).ids[5*256 + 15*16 + 15] == 7
+            assert loaded.getSection(5, 5, 0) is None
+            # the sections are views that can be written through
+            loaded.getSection(0, 0, 0).ids[0] = 9
+            assert loaded.getSection(0, 0, 0).ids[0] == 9
+
+def testWorkerProcesses():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(mclevel.regionPath(tmp, 0, 0), mode='wb') as file:
+            file.write(makeRegion(2))
+        with shared.loadWorld(tmp, processes=1) as loaded:
+            section = loaded.getSection(1, 0, 2)
+            assert section.ids.tobytes() == \
+                makeChunk(1, 0).sections[2].ids.tobytes()
+
+def testNothingIsLeftBehind():
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(mclevel.regionPath(tmp, 0, 0), mode='wb') as file:
+            file.write(makeRegion(2))
+        region = bytearray(makeRegion(1))
+        # a chunk whose data is not zlib
+        region[4096*2 + 5:4096*2 + 64] = bytes(59)
+        with open(mclevel.regionPath(tmp, 1, 0), mode='wb') as file:
+            file.write(region)
+        before = sharedBlocks()
+        try:
+            shared.loadWorld(tmp, processes=0)
+        except Exception:
+            pass
+        else:
+            assert False, 'a broken region was loaded'
+        assert sharedBlocks() == before
+        with shared.loadWorld(tmp, regions=[(0, 0)], processes=0) as loaded:
+            assert len(list(loaded.sections())) == 2*5
+            assert path.isdir('/dev/shm') == (sharedBlocks() != before)
+        assert sharedBlocks() == before
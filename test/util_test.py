@@ -0,0 +1,61 @@
+import sys
+import os.path as path
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+from util import Stats, stats
+
+def testDisabledStatsDoNothing():
+    s = Stats()
+    calls = []
+    s.addHook(lambda name, value: calls.append(name))
+    s.count('a')
+    with s.timer('t'):
+        pass
+    assert s.snapshot() == {'counters': {}, 'timers': {}}
+    assert calls == []
+
+def testCountersTimersAndHooks():
+    s = Stats()
+    calls = []
+    hook = lambda name, value: calls.append((name, value))
+    s.addHook(hook)
+    s.enable()
+    s.count('a')
+    s.count('a', 4)
+    with s.timer('t'):
+        pass
+    snapshot = s.snapshot()
+    assert snapshot['counters'] == {'a': 5}
+    assert snapshot['timers']['t']['calls'] == 1
+    assert calls[:2] == [('a', 1), ('a', 4)]
+    s.removeHook(hook)
+    s.reset()
+    s.count('b')
+    assert s.snapshot()['counters'] == {'b': 1}
+    assert len(calls) == 3
+
+def testWorldIsInstrumented():
+    stats.reset()
+    stats.enable()
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            world = mclevel.MinecraftWorld(tmp)
+            world.setBlock(0, 0, 0, mclevel.Block(1, 0))
+            world.setBlock(1, 0, 0, mclevel.Block(1, 0))
+            world.writeAll()
+            world.clearCache()
+            world.getChunk(0, 0)
+            world.closeAll()
+        counters = stats.snapshot()['counters']
+        timers = stats.snapshot()['timers']
+    finally:
+        stats.disable()
+        stats.reset()
+    assert counters['chunkCacheMisses'] == 2
+    assert counters['chunkCacheHits'] == 1
+    assert counters['bytesWritten'] > 0
+    assert counters['bytesRead'] > 0
+    assert timers['compress']['calls'] == 1
+    assert timers['decompress']['calls'] == 1
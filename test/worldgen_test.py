@@ -0,0 +1,53 @@
+import sys
+import os.path as path
+import tempfile
+# add the parent directory
+sys.path.append(path.dirname(path.dirname(path.realpath(__file__))))
+import mclevel
+import worldgen
+
+def flatPipeline(processes=0):
+    return worldgen.GenerationPipeline(
+        [worldgen.FlatTerrain([(mclevel.Block(7, 0), 1),
+                               (mclevel.Block(1, 0), 59),
+                               (mclevel.Block(2, 0), 1)]),
+         worldgen.UniformBiome(4)],
+        processes=processes)
+
+def testFlatArea():
+    with tempfile.TemporaryDirectory() as tmp:
+        # crosses the corner of four regions
+        flatPipeline().run(tmp, -2, -2, 4, 4)
+        assert sorted(mclevel.listRegions(tmp)) == [
+            (-1, -1), (-1, 0), (0, -1), (0, 0)]
+        world = mclevel.MinecraftWorld(tmp)
+        for x, z in ((-20, -20), (0, 0), (31, 31)):
+            assert world.getBlock(x, 0, z).id == 7
+            assert world.getBlock(x, 30, z).id == 1
+            assert world.getBlock(x, 60, z).id == 2
+            assert world.getBlock(x, 61, z).id == 0
+        chunk = world.getChunk(1, 1)
+        assert chunk.biomes == [4] * 256
+        assert chunk.getHeightmap() == [60] * 256
+        # lit on the workers
+        section = chunk.sections[3]
+        assert section.skyLight[(61 & 15)*256] == 15
+
+def testRerunReplacesChunks():
+    with tempfile.TemporaryDirectory() as tmp:
+        flatPipeline().run(tmp, 0, 0, 2, 2)
+        pipeline = worldgen.GenerationPipeline(
+            [worldgen.FlatTerrain([(mclevel.Block(3, 0), 10)])],
+            processes=0)
+        pipeline.run(tmp, 0, 0, 1, 1)
+        world = mclevel.MinecraftWorld(tmp)
+        assert world.getBlock(0, 5, 0).id == 3
+        # the old sections are gone, not just overwritten
+        assert world.getBlock(0, 30, 0) is None
+        assert world.getBlock(16, 30, 16).id == 1
+
+def testWorkerProcesses():
+    with tempfile.TemporaryDirectory() as tmp:
+        flatPipeline(processes=2).run(tmp, 30, 0, 4, 1)
+        world = mclevel.MinecraftWorld(tmp)
+        assert world.getBlock(33*16, 60, 0).id == 2
@@ -1,3 +1,5 @@
+import time
+
 def _retainFilePos(fileAttr=None, fileArg=None, fileKwArg=None):
     """ Prevent file/buffer/stream object's position from changing.
         fileAttr - implies that we are wrapping a method and that argument[0]
@@ -27,3 +29,75 @@ def _retainFilePos(fileAttr=None, fileArg=None, fileKwArg=None):
             return res
         return wrapped
     return wrapper
+
+class Stats:
+    """ Opt in counters and timers for the hot paths of region and chunk I/O.
+
+        Everything is a no-op until enable() is called, so leaving the calls
+        in place costs next to nothing. Hooks are functions hook(name, value)
+        which are called with every counter increment and every timing.
+
+        Stats are per process; worker processes keep their own.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.counters = {}
+        self.timers = {}
+        self.hooks = []
+    def enable(self):
+        self.enabled = True
+    def disable(self):
+        self.enabled = False
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+    def addHook(self, hook):
+        self.hooks.append(hook)
+    def removeHook(self, hook):
+        self.hooks.remove(hook)
+    def count(self, name, n=1):
+        if not self.enabled:
+            return
+        self.counters[name] = self.counters.get(name, 0) + n
+        for hook in self.hooks:
+            hook(name, n)
+    def addTime(self, name, seconds):
+        if not self.enabled:
+            return
+        total, calls = self.timers.get(name, (0.0, 0))
+        self.timers[name] = (total + seconds, calls + 1)
+        for hook in self.hooks:
+            hook(name, seconds)
+    def timer(self, name):
+        """ -> a context manager which times its body under name """
+        if not self.enabled:
+            return _nullTimer
+        return _Timer(self, name)
+    def snapshot(self):
+        """ -> dict of counters and timers ({name: {seconds, calls}}) """
+        return {
+            'counters': dict(self.counters),
+            'timers': dict((k, {'seconds': t, 'calls': n})
+                           for k, (t, n) in self.timers.items())
+        }
+
+class _Timer:
+    def __init__(self, stats, name):
+        self.stats = stats
+        self.name = name
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+    def __exit__(self, *args):
+        self.stats.addTime(self.name, time.perf_counter() - self.start)
+
+class _NullTimer:
+    def __enter__(self):
+        return self
+    def __exit__(self, *args):
+        pass
+
+_nullTimer = _NullTimer()
+
+# the stats shared by nbt and mclevel
+stats = Stats()
@@ -0,0 +1,168 @@
+"""
+    A pipeline for generating new areas of a world.
+
+    Chunks are generated one at a time by a list of stages, which are run in
+    worker processes. The finished chunks are compressed by the workers and
+    streamed straight into region files by the parent process, so memory use
+    does not depend on the size of the area.
+"""
+import os
+import os.path
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import mclevel
+
+class GenerationPipeline:
+    """ Runs a list of stages over every chunk of an area.
+
+        A stage is a function stage(chunk, seed) which edits a new, empty
+        mclevel.Chunk in place (terrain, biomes, decoration, ...). Stages are
+        run in the order they were added. Since stages are sent to other
+        processes they must be picklable, i.e. module level functions or
+        instances of module level classes such as FlatTerrain.
+    """
+    def __init__(self, stages=None, seed=0, light=True, processes=None,
+                 maxPending=256):
+        """
+            seed - passed to every stage
+            light - light each chunk once its stages have run. Chunks are lit
+            on their own, light does not cross chunk borders.
+            processes - worker processes, see mclevel.mapRegions
+            maxPending - most chunks that may be queued or waiting to be
+            written at once
+        """
+        self.stages = list(stages) if stages is not None else []
+        self.seed = seed
+        self.light = light
+        self.processes = processes
+        self.maxPending = maxPending
+    def addStage(self, stage):
+        self.stages.append(stage)
+        return self
+    def generateChunk(self, x, z):
+        """ -> a new chunk which has been through every stage """
+        chunk = mclevel.Chunk(x, z)
+        for stage in self.stages:
+            stage(chunk, self.seed)
+        if self.light:
+            mclevel.lightChunks({(x, z): chunk})
+        return chunk
+    def run(self, regionPath, xMin, zMin, xSize, zSize):
+        """ Generate an area, in chunk coordinates, into the region files in
+            regionPath. Chunks already in the area are replaced.
+        """
+        if not os.path.exists(regionPath):
+            os.makedirs(regionPath)
+        coords = _regionMajor(xMin, zMin, xSize, zSize)
+        if self.processes == 0:
+            _initWorker(self)
+            results = map(_generate, coords)
+            self._write(regionPath, results)
+            return
+        with ProcessPoolExecutor(self.processes, initializer=_initWorker,
+                                 initargs=(self,)) as pool:
+            self._write(regionPath, _stream(pool, coords, self.maxPending))
+    def _write(self, regionPath, results):
+        """ Write (x, z, compressed chunk) results, which arrive one region
+            at a time, to the region files.
+        """
+        region = None
+        writer = None
+        try:
+            for x, z, zipped in results:
+                if mclevel.getRegionPos(x, z) != region:
+                    if writer is not None:
+                        writer.close()
+                    region = mclevel.getRegionPos(x, z)
+                    writer = _openRegion(regionPath, *region)
+                writer.writeCompressedChunk(x, z, zipped)
+        finally:
+            if writer is not None:
+                writer.close()
+
+class _RegionFile:
+    """ Adapts a region file so both new and existing regions can be written
+        to with writeCompressedChunk.
+    """
+    def __init__(self, path, regionX, regionZ):
+        if os.path.exists(path):
+            self.file = open(path, mode='r+b')
+            self.writer = None
+            self.header = mclevel.RegionHeader(regionX, regionZ, self.file)
+        else:
+            # a new region can be written front to back
+            self.file = open(path, mode='w+b')
+            self.writer = mclevel.RegionWriter(regionX, regionZ, self.file)
+    def writeCompressedChunk(self, x, z, zipped):
+        if self.writer is not None:
+            self.writer.writeCompressedChunk(x, z, zipped)
+        else:
+            mclevel.writeCompressedChunk(x, z, zipped, self.header)
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.file.close()
+
+def _openRegion(regionPath, x, z):
+    return _RegionFile(mclevel.regionPath(regionPath, x, z), x, z)
+
+def _regionMajor(xMin, zMin, xSize, zSize):
+    """ -> chunk coordinates of an area, grouped by region """
+    rxMin, rzMin = mclevel.getRegionPos(xMin, zMin)
+    rxMax, rzMax = mclevel.getRegionPos(xMin + xSize - 1, zMin + zSize - 1)
+    for rz in range(rzMin, rzMax + 1):
+        for rx in range(rxMin, rxMax + 1):
+            for z in range(max(zMin, rz*32), min(zMin + zSize, rz*32 + 32)):
+                for x in range(max(xMin, rx*32), min(xMin + xSize, rx*32 + 32)):
+                    yield x, z
+
+def _stream(pool, coords, maxPending):
+    """ Like pool.map, but never has more than maxPending chunks in flight """
+    pending = deque()
+    for c in coords:
+        pending.append(pool.submit(_generate, c))
+        if len(pending) >= maxPending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+# the pipeline being run by this worker process
+_pipeline = None
+
+def _initWorker(pipeline):
+    global _pipeline
+    _pipeline = pipeline
+
+def _generate(coords):
+    x, z = coords
+    chunk = _pipeline.generateChunk(x, z)
+    return x, z, mclevel.compressChunk(mclevel.chunkToNbt(chunk))
+
+class FlatTerrain:
+    """ Stage which fills every column with the same layers of blocks.
+        layers - list of (block, thickness) from the bottom up
+    """
+    def __init__(self, layers):
+        self.layers = layers
+    def __call__(self, chunk, seed):
+        y = 0
+        for block, thickness in self.layers:
+            for sectionY in range(y//16, (y + thickness - 1)//16 + 1):
+                if sectionY not in chunk.sections:
+                    chunk.addSection(sectionY, mclevel.Section())
+            for layer in range(y, y + thickness):
+                section = chunk.sections[layer//16]
+                start = (layer & 15) * 256
+                section.ids[start:start + 256] = array(
+                    'H', [block.id]*256)
+                section.data[start:start + 256] = bytes([block.data & 0x0F])*256
+            y += thickness
+        chunk.heightmap = None
+
+class UniformBiome:
+    """ Stage which sets the whole chunk to one biome. """
+    def __init__(self, biomeId):
+        self.biomeId = biomeId
+    def __call__(self, chunk, seed):
+        chunk.fillBiome(self.biomeId)